@@ -0,0 +1,101 @@
+import logging
+from functools import partial
+import dbus
+from vedbus import wrap_dbus_value, unwrap_dbus_value
+from settingsdevice import SettingsDevice, PATH, VALUE, MINIMUM, MAXIMUM, SILENT
+
+logger = logging.getLogger(__name__)
+
+class SettingItem(object):
+	""" Stands in for the VeDbusItemImport that SettingsDevice keeps for
+	    each setting. It is created from a value that was already read, so
+	    it costs no round trip, and it is told about changes by its
+	    BulkSettingsDevice. """
+	exists = True
+
+	def __init__(self, bus, service, path, value, callback=None):
+		self._bus = bus
+		self._proxy = None
+		self._value = value
+		self._callback = callback
+		self.serviceName = service
+		self.path = path
+
+	def get_value(self):
+		return self._value
+
+	def set_value(self, value):
+		if self._proxy is None:
+			self._proxy = self._bus.get_object(self.serviceName, self.path, introspect=False)
+		r = self._proxy.SetValue(wrap_dbus_value(value), dbus_interface='com.victronenergy.BusItem')
+		if r == 0:
+			self._value = value
+		return r
+
+	def changed(self, changes):
+		changes = dict(changes)
+		changes['Value'] = self._value = unwrap_dbus_value(changes['Value'])
+		if self._callback is not None:
+			self._callback(self.serviceName, self.path, changes)
+
+class BulkSettingsDevice(SettingsDevice):
+	""" SettingsDevice that adds the supported settings to localsettings
+	    with a single AddSettings call, reads all of them back with a
+	    single GetItems call, and follows changes through the ItemsChanged
+	    signal. Without that, every setting costs several round trips at
+	    startup. If localsettings does not support AddSettings, the
+	    settings are added one by one as before. Settings added later
+	    with addSetting always go the usual way. """
+	def addSettings(self, settings):
+		try:
+			failed = self._add_settings_bulk(settings)
+		except dbus.exceptions.DBusException as e:
+			logger.info("Adding settings in bulk failed (%s), adding them one by one", e.get_dbus_name())
+			SettingsDevice.addSettings(self, settings)
+		else:
+			if failed:
+				logger.warning("Adding %d settings in bulk failed, adding them one by one", len(failed))
+				SettingsDevice.addSettings(self, failed)
+
+	def _add_settings_bulk(self, settings):
+		root = self._bus.get_object(self._dbus_name, '/', introspect=False)
+		items = []
+		for options in settings.values():
+			item = {'path': options[PATH], 'default': wrap_dbus_value(options[VALUE])}
+			if not isinstance(options[VALUE], str):
+				item['min'] = wrap_dbus_value(options[MINIMUM])
+				item['max'] = wrap_dbus_value(options[MAXIMUM])
+			if len(options) > SILENT and options[SILENT]:
+				item['silent'] = dbus.Boolean(True)
+			items.append(item)
+
+		errors = {str(r['path']): int(r['error'])
+			for r in root.AddSettings(items, dbus_interface='com.victronenergy.Settings')}
+
+		# Listen for changes before reading, so that none are missed
+		if not hasattr(self, '_items'):
+			self._items = {}
+			self._bus.add_signal_receiver(self._items_changed,
+				dbus_interface='com.victronenergy.BusItem', signal_name='ItemsChanged',
+				path='/', bus_name=self._dbus_name)
+		values = root.GetItems(dbus_interface='com.victronenergy.BusItem')
+
+		failed = {}
+		for setting, options in settings.items():
+			path = options[PATH]
+			if errors.get(path, 0) != 0 or path not in values:
+				failed[setting] = options
+				continue
+			value = unwrap_dbus_value(values[path]['Value'])
+			item = SettingItem(self._bus, self._dbus_name, path, value,
+				partial(self.handleChangedSetting, setting))
+			self._items[path] = item
+			self._settings[setting] = item
+			self._values[setting] = value
+		return failed
+
+	def _items_changed(self, items):
+		for path, changes in items.items():
+			item = self._items.get(str(path))
+			if item is not None and 'Value' in changes:
+				item.changed(changes)
@@ -0,0 +1,300 @@
+from functools import partial
+
+PHASES = ('L1', 'L2', 'L3')
+_N = (0, 1, 2)
+_BITS = (1, 2, 4)
+
+# Per source, grid and genset, the service types on the AC-input that make
+# it the active source, and the paths, per phase, of the values read or
+# written.
+SOURCES = ('Grid', 'Genset')
+_TYPES = ((1, 3), (2, ))
+_PV_P = tuple(tuple('/Ac/PvOn%s/%s/Power' % (s, ph) for ph in PHASES) for s in SOURCES)
+_PV_I = tuple(tuple('/Ac/PvOn%s/%s/Current' % (s, ph) for ph in PHASES) for s in SOURCES)
+_OUT_P = tuple(tuple('/Ac/%s/%s/Power' % (s, ph) for ph in PHASES) for s in SOURCES)
+_OUT_I = tuple(tuple('/Ac/%s/%s/Current' % (s, ph) for ph in PHASES) for s in SOURCES)
+_PHASE_COUNT = tuple('/Ac/%s/NumberOfPhases' % s for s in SOURCES)
+_PRODUCT_ID = tuple('/Ac/%s/ProductId' % s for s in SOURCES)
+_DEVICE_TYPE = tuple('/Ac/%s/DeviceType' % s for s in SOURCES)
+_ACTIVEIN_P = tuple('/Ac/ActiveIn/%s/Power' % ph for ph in PHASES)
+_ACTIVEIN_I = tuple('/Ac/ActiveIn/%s/Current' % ph for ph in PHASES)
+_PVOUT_P = tuple('/Ac/PvOnOutput/%s/Power' % ph for ph in PHASES)
+_PVOUT_I = tuple('/Ac/PvOnOutput/%s/Current' % ph for ph in PHASES)
+_CONS_P = tuple('/Ac/Consumption/%s/Power' % ph for ph in PHASES)
+_CONS_I = tuple('/Ac/Consumption/%s/Current' % ph for ph in PHASES)
+_CONS_OUT_P = tuple('/Ac/ConsumptionOnOutput/%s/Power' % ph for ph in PHASES)
+_CONS_OUT_I = tuple('/Ac/ConsumptionOnOutput/%s/Current' % ph for ph in PHASES)
+_CONS_IN_P = tuple('/Ac/ConsumptionOnInput/%s/Power' % ph for ph in PHASES)
+_CONS_IN_I = tuple('/Ac/ConsumptionOnInput/%s/Current' % ph for ph in PHASES)
+
+class ConsumptionEngine(object):
+	""" Computes the power and current of the grid and genset, and the AC
+	    consumption on the input and output of the inverters, per phase.
+
+	    The reads from the dbusmonitor are resolved once, in bind, into
+	    handles that take no arguments. Per tick no paths are formatted and
+	    no lists are made: the consumption on the input side is kept in
+	    fixed length vectors, with a bit mask telling which phases hold a
+	    value. A phase without a value is None in the output, the same as
+	    with safeadd and safemax. The number of phases follows from the
+	    masks. """
+	def __init__(self, dbusmonitor):
+		self._dbusmonitor = dbusmonitor
+		self._cons_p = [0, 0, 0]
+		self._cons_i = [0, 0, 0]
+		self._cons_valid_p = 0
+		self._cons_valid_i = 0
+		self.bind(None, (), None, None)
+
+	def _handle(self, service, path):
+		return partial(self._dbusmonitor.get_value, service, path)
+
+	def _phase_handles(self, service, fmt):
+		if service is None:
+			return None
+		return tuple(self._handle(service, fmt % ph) for ph in PHASES)
+
+	def bind(self, multi, inverters, gridmeter, gensetmeter):
+		""" Resolves the handles for the VE.Bus system multi, the other
+		    inverters and the services of the grid and genset meters. Must
+		    be called when any of these change. """
+		h = self._handle
+		self._meter_p = tuple(self._phase_handles(m, '/Ac/%s/Power') for m in (gridmeter, gensetmeter))
+		self._meter_i = tuple(self._phase_handles(m, '/Ac/%s/Current') for m in (gridmeter, gensetmeter))
+		self._multi_in_p = self._phase_handles(multi, '/Ac/ActiveIn/%s/P')
+		self._multi_in_i = self._phase_handles(multi, '/Ac/ActiveIn/%s/I')
+		self._multi_out_p = self._phase_handles(multi, '/Ac/Out/%s/P')
+		self._multi_out_i = self._phase_handles(multi, '/Ac/Out/%s/I')
+		self._multi_productid = None if multi is None else h(multi, '/ProductId')
+		self._multi_assistant = None if multi is None else h(multi, '/Hub4/AssistantId')
+		self._inverter_productid = h(inverters[0], '/ProductId') if inverters else None
+
+		# Per AC-input, then per phase, the power and current of each inverter
+		self._inverter_in = tuple(tuple(tuple(
+			(h(i, '/Ac/In/%d/%s/P' % (n, ph)), h(i, '/Ac/In/%d/%s/I' % (n, ph)))
+				for i in inverters) for ph in PHASES) for n in (1, 2))
+		self._inverter_out = tuple(tuple(
+			(h(i, '/Ac/Out/%s/P' % ph), h(i, '/Ac/Out/%s/I' % ph),
+				h(i, '/Ac/Out/%s/S' % ph), h(i, '/Ac/Out/%s/V' % ph))
+			for i in inverters) for ph in PHASES)
+		self._runwithoutgridmeter = h('com.victronenergy.settings',
+			'/Settings/CGwacs/RunWithoutGridMeter')
+
+	def update(self, newvalues, gridmeter, gensetmeter, ac_in_source, active_input,
+			has_ac_in_system, use_ac_out):
+		""" Adds the values to newvalues. gridmeter and gensetmeter are the
+		    meters passed to bind, or None. """
+		# Make an educated guess as to what is being consumed from an AC source. If ac_in_source
+		# indicates grid, genset or shore, we use that. If the Multi is off, or disconnected through
+		# a relay assistant or otherwise, then assume the presence of a .grid or .genset service indicates
+		# presence of that AC source. If both are available, then give up. This decision making is here
+		# so the GUI has something to present even if the Multi is off.
+		ac_in_guess = ac_in_source
+		if ac_in_guess in (None, 0xF0):
+			if gensetmeter is None and gridmeter is not None:
+				ac_in_guess = 1
+			elif gridmeter is None and gensetmeter is not None:
+				ac_in_guess = 2
+
+		self._cons_valid_p = self._cons_valid_i = 0
+		newvalues['/Ac/ActiveIn/NumberOfPhases'] = None
+		self._update_source(0, gridmeter, newvalues, ac_in_source, ac_in_guess, active_input)
+		self._update_source(1, gensetmeter, newvalues, ac_in_source, ac_in_guess, active_input)
+		self._update_consumption(newvalues, has_ac_in_system, use_ac_out)
+
+	def _update_source(self, k, em, newvalues, ac_in_source, ac_in_guess, active_input):
+		# If a grid meter is present we use values from it. If not, we look at the multi. If it has
+		# AcIn1 or AcIn2 connected to the grid, we use those values.
+		# com.victronenergy.grid.??? indicates presence of an energy meter used as grid meter.
+		# com.victronenergy.vebus.???/Ac/ActiveIn/ActiveInput: decides which whether we look at AcIn1
+		# or AcIn2 as possible grid connection.
+		uses_active_input = ac_in_source in _TYPES[k]
+		activein = ac_in_guess in _TYPES[k]
+		multi_p = self._multi_in_p if uses_active_input else None
+		multi_i = self._multi_in_i
+		inverters = self._inverter_in[active_input] if uses_active_input and \
+			active_input in (0, 1) else None
+		meter_p = self._meter_p[k]
+		meter_i = self._meter_i[k]
+		pv_p = _PV_P[k]
+		pv_i = _PV_I[k]
+		out_p = _OUT_P[k]
+		out_i = _OUT_I[k]
+		cons_p = self._cons_p
+		cons_i = self._cons_i
+		valid = 0
+
+		for n in _N:
+			bit = _BITS[n]
+			pvpower = newvalues.get(pv_p[n])
+			pvcurrent = newvalues.get(pv_i[n])
+			if em is not None:
+				p = meter_p[n]()
+				mc = meter_i[n]()
+
+				# Compute consumption between energy meter and multi (meter power - multi AC in) and
+				# add an optional PV inverter on input to the mix.
+				c = cc = None
+				if multi_p is not None:
+					v = multi_p[n]()
+					if v is not None:
+						c = -v
+						v = multi_i[n]()
+						if v is not None:
+							cc = -v
+				if inverters is not None:
+					for hp, hi in inverters[n]:
+						v = hp()
+						if v is not None:
+							c = -v if c is None else c - v
+							v = hi()
+							if v is not None:
+								cc = -v if cc is None else cc - v
+
+				# If there's any power coming from a PV inverter in the inactive AC in (which is unlikely),
+				# it will still be used, because there may also be a load in the same ACIn consuming
+				# power, or the power could be fed back to the net.
+				if p is not None:
+					c = p if c is None else c + p
+				if pvpower is not None:
+					c = pvpower if c is None else c + pvpower
+				if mc is not None:
+					cc = mc if cc is None else cc + mc
+				if pvcurrent is not None:
+					cc = pvcurrent if cc is None else cc + pvcurrent
+				if c is not None:
+					if self._cons_valid_p & bit:
+						cons_p[n] += max(0, c)
+					else:
+						cons_p[n] = max(0, c)
+						self._cons_valid_p |= bit
+				if cc is not None:
+					if self._cons_valid_i & bit:
+						cons_i[n] += max(0, cc)
+					else:
+						cons_i[n] = max(0, cc)
+						self._cons_valid_i |= bit
+			else:
+				p = mc = None
+				if multi_p is not None:
+					v = multi_p[n]()
+					if v is not None:
+						p = v
+						mc = multi_i[n]()
+				if inverters is not None:
+					for hp, hi in inverters[n]:
+						v = hp()
+						if v is not None:
+							p = v if p is None else p + v
+						v = hi()
+						if v is not None:
+							mc = v if mc is None else mc + v
+				if p is not None:
+					if not self._cons_valid_p & bit:
+						cons_p[n] = 0
+						self._cons_valid_p |= bit
+					if not self._cons_valid_i & bit:
+						cons_i[n] = 0
+						self._cons_valid_i |= bit
+
+				# No relevant energy meter present. Assume there is no load between the grid and the multi.
+				# There may be a PV inverter present though (Hub-3 setup).
+				if pvpower is not None:
+					p = -pvpower if p is None else p - pvpower
+					if pvcurrent is not None:
+						mc = -pvcurrent if mc is None else mc - pvcurrent
+
+			if p is not None:
+				valid |= bit
+			newvalues[out_p[n]] = p
+			newvalues[out_i[n]] = mc
+			if activein:
+				newvalues[_ACTIVEIN_P[n]] = p
+				newvalues[_ACTIVEIN_I[n]] = mc
+
+		newvalues[_PHASE_COUNT[k]] = valid.bit_length() or None
+		if activein:
+			newvalues['/Ac/ActiveIn/NumberOfPhases'] = valid.bit_length() or None
+
+		product_id = None
+		device_type_id = None
+		if em is not None:
+			product_id = em.product_id
+			device_type_id = em.device_type
+		if product_id is None and uses_active_input:
+			if self._multi_productid is not None:
+				product_id = self._multi_productid()
+			elif self._inverter_productid is not None:
+				product_id = self._inverter_productid()
+		newvalues[_PRODUCT_ID[k]] = product_id
+		newvalues[_DEVICE_TYPE[k]] = device_type_id
+
+	def _update_consumption(self, newvalues, has_ac_in_system, use_ac_out):
+		# If we have an ESS system and RunWithoutGridMeter is set, there cannot be load on the AC-In, so it
+		# must be on AC-Out. Hence we do calculate AC-Out consumption even if 'useacout' is disabled.
+		# Similarly all load are by definition on the output if this is not an ESS system.
+		use_ac_out = \
+			not has_ac_in_system or \
+			use_ac_out or \
+			(self._multi_assistant is not None and self._multi_assistant() not in (4, 5)) or \
+			self._runwithoutgridmeter() == 1
+		multi_p = self._multi_out_p
+		multi_i = self._multi_out_i
+		cons_p = self._cons_p
+		cons_i = self._cons_i
+		valid_p = self._cons_valid_p
+		valid_i = self._cons_valid_i
+		valid_out = valid_total = 0
+
+		for n in _N:
+			bit = _BITS[n]
+			c = a = None
+			if use_ac_out:
+				c = newvalues.get(_PVOUT_P[n])
+				a = newvalues.get(_PVOUT_I[n])
+				if multi_p is not None:
+					v = multi_p[n]()
+					if v is not None:
+						c = v if c is None else c + v
+					v = multi_i[n]()
+					if v is not None:
+						a = v if a is None else a + v
+				for hp, hi, hs, hu in self._inverter_out[n]:
+					ac_out = hp()
+					i = hi()
+
+					# Some models don't show power, try apparent power,
+					# else calculate it
+					if ac_out is None:
+						ac_out = hs()
+						if ac_out is None and i is not None:
+							u = hu()
+							if u is not None:
+								ac_out = i * u
+					if ac_out is not None:
+						c = ac_out if c is None else c + ac_out
+					if i is not None:
+						a = i if a is None else a + i
+				if c is not None:
+					c = max(0, c)
+					valid_out |= bit
+				if a is not None:
+					a = max(0, a)
+			newvalues[_CONS_OUT_P[n]] = c
+			newvalues[_CONS_OUT_I[n]] = a
+
+			p = cons_p[n] if valid_p & bit else None
+			i = cons_i[n] if valid_i & bit else None
+			total = p if c is None else (c if p is None else p + c)
+			if total is not None:
+				valid_total |= bit
+			newvalues[_CONS_P[n]] = total
+			newvalues[_CONS_I[n]] = i if a is None else (a if i is None else i + a)
+			if has_ac_in_system:
+				newvalues[_CONS_IN_P[n]] = p
+				newvalues[_CONS_IN_I[n]] = i
+
+		newvalues['/Ac/Consumption/NumberOfPhases'] = valid_total.bit_length() or None
+		newvalues['/Ac/ConsumptionOnOutput/NumberOfPhases'] = valid_out.bit_length() or None
+		newvalues['/Ac/ConsumptionOnInput/NumberOfPhases'] = \
+			(valid_p.bit_length() or None) if has_ac_in_system else None
@@ -9,7 +9,7 @@ import os
 import json
 import time
 import re
-import itertools
+from itertools import chain
 from gi.repository import GLib
 
 # Victron packages
@@ -17,38 +17,158 @@ sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'ext', 'velib_python'
 from vedbus import VeDbusService
 from ve_utils import get_vrm_portal_id, exit_on_error
 from dbusmonitor import AsyncDbusMonitor
-from settingsdevice import SettingsDevice
+from bulksettings import BulkSettingsDevice
 from logger import setup_logging
 import delegates
-from sc_utils import safeadd as _safeadd, safemax as _safemax
+from recorder import Recorder
+from sc_utils import safeadd as _safeadd, safemax as _safemax, service_base_name, \
+	DependencyGraph, ServiceIndex, Profiler
+from scheduler import Scheduler
+from writequeue import WriteQueue
+from consumption import ConsumptionEngine
 
 softwareVersion = '2.256'
 
-# Pre-computed path strings for the hot path in _updatevalues().
-# Avoids repeated % string formatting every 1-second tick.
 _PHASES = ('L1', 'L2', 'L3')
-_AC_PATHS = {}
-for _dt in ('Grid', 'Genset'):
-	for _ph in _PHASES:
-		_AC_PATHS[(_dt, _ph, 'pvpower')] = '/Ac/PvOn%s/%s/Power' % (_dt, _ph)
-		_AC_PATHS[(_dt, _ph, 'pvcurrent')] = '/Ac/PvOn%s/%s/Current' % (_dt, _ph)
-		_AC_PATHS[(_dt, _ph, 'em_p')] = '/Ac/%s/Power' % _ph
-		_AC_PATHS[(_dt, _ph, 'em_i')] = '/Ac/%s/Current' % _ph
-		_AC_PATHS[(_dt, _ph, 'ain_p')] = '/Ac/ActiveIn/%s/P' % _ph
-		_AC_PATHS[(_dt, _ph, 'ain_i')] = '/Ac/ActiveIn/%s/I' % _ph
-		_AC_PATHS[(_dt, _ph, 'out_p')] = '/Ac/%s/%s/Power' % (_dt, _ph)
-		_AC_PATHS[(_dt, _ph, 'out_i')] = '/Ac/%s/%s/Current' % (_dt, _ph)
-		_AC_PATHS[(_dt, _ph, 'activein_p')] = '/Ac/ActiveIn/%s/Power' % _ph
-		_AC_PATHS[(_dt, _ph, 'activein_i')] = '/Ac/ActiveIn/%s/Current' % _ph
-for _ph in _PHASES:
-	_AC_PATHS[(_ph, 'cons_out_p')] = '/Ac/ConsumptionOnOutput/%s/Power' % _ph
-	_AC_PATHS[(_ph, 'cons_out_i')] = '/Ac/ConsumptionOnOutput/%s/Current' % _ph
-	_AC_PATHS[(_ph, 'cons_p')] = '/Ac/Consumption/%s/Power' % _ph
-	_AC_PATHS[(_ph, 'cons_i')] = '/Ac/Consumption/%s/Current' % _ph
-	_AC_PATHS[(_ph, 'cons_in_p')] = '/Ac/ConsumptionOnInput/%s/Power' % _ph
-	_AC_PATHS[(_ph, 'cons_in_i')] = '/Ac/ConsumptionOnInput/%s/Current' % _ph
-	_AC_PATHS[(_ph, 'pvout_p')] = '/Ac/PvOnOutput/%s/Power' % _ph
-	_AC_PATHS[(_ph, 'pvout_i')] = '/Ac/PvOnOutput/%s/Current' % _ph
+
+def _phase_paths(prefix, *quantities):
+	return ['%s/%s/%s' % (prefix, phase, q) for phase in _PHASES for q in quantities]
+
+def _inputs(classes, *paths):
+	return [(c, p) for c in classes for p in paths]
+
+_INVERTERS = ('com.victronenergy.multi', 'com.victronenergy.inverter')
+_BATTERY_SERVICES = ('com.victronenergy.battery', 'com.victronenergy.vebus') + \
+	_INVERTERS + ('com.victronenergy.acsystem',)
+
+# The values computed in _updatevalues(), as a graph of nodes. Each node
+# lists its inputs, being the (service class, path) pairs it reads from the
+# monitor and the outputs of other nodes, and the outputs it produces.
+# Outputs without a leading slash are intermediate results, they are not
+# published. A node is only evaluated when one of its inputs changed.
+_NODES = (
+	('pvinverters',
+		_inputs(('com.victronenergy.pvinverter',), '/Position',
+			*('/Ac/%s/%s' % (phase, q) for phase in _PHASES for q in ('Power', 'Current'))) +
+		_inputs(('com.victronenergy.settings',),
+			'/Settings/SystemSetup/AcInput1', '/Settings/SystemSetup/AcInput2'),
+		[p for pos in ('/Ac/PvOnGrid', '/Ac/PvOnOutput', '/Ac/PvOnGenset')
+			for p in _phase_paths(pos, 'Power', 'Current') + [pos + '/NumberOfPhases']]),
+	('vebuspower',
+		_inputs(('com.victronenergy.vebus',), '/Dc/0/Voltage', '/Dc/0/Current'),
+		['vebuspower']),
+	('solarchargers',
+		_inputs(('com.victronenergy.solarcharger',), '/Dc/0/Voltage', '/Dc/0/Current', '/Load/I') +
+		_inputs(_INVERTERS, '/Yield/Power', '/Dc/0/Voltage'),
+		['/Dc/Pv/ChargeCurrent', '/Dc/Pv/Power', '/Dc/Pv/Current',
+			'solarchargers_charge_power', 'solarchargers_total_power',
+			'solarchargers_loadoutput_power', 'solarcharger_batteryvoltage',
+			'solarcharger_batteryvoltage_service']),
+	('fuelcells',
+		_inputs(('com.victronenergy.fuelcell',), '/Dc/0/Voltage', '/Dc/0/Current'),
+		['/Dc/FuelCell/Power', 'fuelcell_batteryvoltage', 'fuelcell_batteryvoltage_service']),
+	('alternators',
+		_inputs(('com.victronenergy.alternator',), '/Dc/0/Power') +
+		_inputs(('com.victronenergy.dcgenset',), '/Dc/0/Power', '/Dc/0/Voltage', '/Dc/0/Current'),
+		['/Dc/Alternator/Power']),
+	('chargers',
+		_inputs(('com.victronenergy.charger',), '/Dc/0/Voltage', '/Dc/0/Current'),
+		['/Dc/Charger/Power', 'charger_batteryvoltage', 'charger_batteryvoltage_service']),
+	('battery',
+		_inputs(_BATTERY_SERVICES, '/TimeToGo', '/ConsumedAmphours', '/ProductId',
+			'/Dc/0/Voltage', '/Dc/0/Current', '/Dc/0/Power', '/Dc/0/Capacity',
+			'/Mgmt/InsecureConnection', '/InstalledCapacity', '/Capacity', '/State') +
+		_inputs(('com.victronenergy.dcsystem',), '/Dc/0/Voltage', '/Dc/0/Power') +
+		['/Dc/Charger/Power', 'vebuspower', 'solarchargers_charge_power',
+			'solarcharger_batteryvoltage', 'solarcharger_batteryvoltage_service',
+			'fuelcell_batteryvoltage', 'fuelcell_batteryvoltage_service',
+			'charger_batteryvoltage', 'charger_batteryvoltage_service'],
+		['/Dc/Battery/TimeToGo', '/Dc/Battery/ConsumedAmphours', '/Dc/Battery/ProductId',
+			'/Dc/Battery/Voltage', '/Dc/Battery/VoltageService', '/Dc/Battery/Current',
+			'/Dc/Battery/Power', '/Dc/Battery/Capacity', '/Dc/Battery/State',
+			'batteryservicetype']),
+	('dcsystem',
+		_inputs(('com.victronenergy.dcsystem',), '/Dc/0/Power', '/Dc/0/Current') +
+		_inputs(_INVERTERS, '/Dc/0/Current', '/Dc/0/Voltage', '/Ac/Out/L1/V', '/Ac/Out/L1/I') +
+		['/Dc/Battery/Power', '/Dc/Battery/Voltage', '/Dc/Charger/Power',
+			'/Dc/FuelCell/Power', '/Dc/Alternator/Power', 'vebuspower',
+			'solarchargers_total_power', 'solarchargers_loadoutput_power',
+			'batteryservicetype'],
+		['/Dc/System/MeasurementType', '/Dc/System/Power', '/Dc/System/Current']),
+	('acinsource',
+		_inputs(('com.victronenergy.vebus',) + _INVERTERS, '/Ac/ActiveIn/ActiveInput') +
+		_inputs(_INVERTERS, '/Ac/In/1/Type', '/Ac/In/2/Type') +
+		_inputs(('com.victronenergy.settings',),
+			'/Settings/SystemSetup/AcInput1', '/Settings/SystemSetup/AcInput2'),
+		['/Ac/ActiveIn/Source', 'active_input']),
+	('acconsumption',
+		_inputs(('com.victronenergy.grid', 'com.victronenergy.genset'),
+			'/ProductId', '/DeviceType', *_phase_paths('/Ac', 'Power', 'Current')) +
+		_inputs(('com.victronenergy.vebus',), '/ProductId', '/Hub4/AssistantId',
+			*_phase_paths('/Ac/ActiveIn', 'P', 'I') + _phase_paths('/Ac/Out', 'P', 'I')) +
+		_inputs(_INVERTERS, '/ProductId', *_phase_paths('/Ac/In/1', 'P', 'I') +
+			_phase_paths('/Ac/In/2', 'P', 'I') + _phase_paths('/Ac/Out', 'P', 'I', 'S', 'V')) +
+		_inputs(('com.victronenergy.settings',), '/Settings/CGwacs/RunWithoutGridMeter') +
+		_phase_paths('/Ac/PvOnGrid', 'Power', 'Current') +
+		_phase_paths('/Ac/PvOnGenset', 'Power', 'Current') +
+		_phase_paths('/Ac/PvOnOutput', 'Power', 'Current') +
+		['/Ac/ActiveIn/Source', 'active_input'],
+		[p for prefix in ('/Ac/Grid', '/Ac/Genset', '/Ac/ActiveIn', '/Ac/Consumption',
+				'/Ac/ConsumptionOnOutput', '/Ac/ConsumptionOnInput')
+			for p in _phase_paths(prefix, 'Power', 'Current') + [prefix + '/NumberOfPhases']] +
+		['/Ac/Grid/ProductId', '/Ac/Grid/DeviceType',
+			'/Ac/Genset/ProductId', '/Ac/Genset/DeviceType']),
+)
+
+# Settings holding the publish deadband for values of each unit, as found
+# at the end of their gettext format.
+_DEADBAND_SETTINGS = {
+	'W': 'deadbandpower',
+	'A': 'deadbandcurrent',
+	'V': 'deadbandvoltage',
+	'%': 'deadbandpercent'}
+_GETTEXT_UNIT = re.compile(r'%[-+ #0]*\d*(?:\.\d+)?[a-zA-Z]\s*(.*?)\s*$')
+
+# Paths that don't take the deadband of their unit. None means every change
+# is published. Deadbands of single paths can also be set in localsettings,
+# see _parse_deadbands.
+_DEADBAND_PATHS = {
+	# Generator start/stop and relay conditions compare against the soc
+	'/Dc/Battery/Soc': None,
+}
+
+# Delegates are updated at this interval (in ms), unless nothing changes, in
+# which case ticks back off to a slower interval. Changes to these paths are
+# relevant to ESS control, they also schedule fast ticks that only update
+# the graph in between.
+_TICK_INTERVAL = 1000
+_FAST_TICK_INPUTS = frozenset(
+	_inputs(('com.victronenergy.grid',), '/Ac/Power', *('/Ac/%s/Power' % phase for phase in _PHASES)) +
+	_inputs(('com.victronenergy.battery',), '/Info/MaxChargeCurrent',
+		'/Info/MaxChargeVoltage', '/Info/MaxDischargeCurrent'))
+
+# Settings read by the nodes above. The battery service setting is not
+# listed, a change in the selected battery service is detected separately.
+_NODE_SETTINGS = ('hasdcsystem', 'useacout', 'hasacinloads', 'batterybank')
+
+def _isnumber(v):
+	return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+def _parse_deadbands(v):
+	""" Parses the per-path deadbands from settings, path=deadband pairs
+	    separated by spaces or commas, for example
+	    "/Dc/Battery/Power=10 /Ac/Grid/L1/Power=5". A deadband of 0 publishes
+	    every change. Pairs that don't parse are skipped. """
+	deadbands = {}
+	for pair in re.split(r'[\s,]+', v or ''):
+		if not pair:
+			continue
+		path, _, deadband = pair.partition('=')
+		try:
+			deadbands[path] = max(0.0, float(deadband))
+		except ValueError:
+			logger.warning("Ignoring publish deadband %r", pair)
+	return deadbands
 
 class SystemCalc:
 	STATE_IDLE = 0
@@ -56,6 +176,7 @@ class SystemCalc:
 	STATE_DISCHARGING = 2
 	BATSERVICE_DEFAULT = 'default'
 	BATSERVICE_NOBATTERY = 'nobattery'
+	_get_time = lambda s: time.monotonic()
 	def __init__(self):
 		# Why this dummy? Because DbusMonitor expects these values to be there, even though we don't
 		# need them. So just add some dummy data. This can go away when DbusMonitor is more generic.
@@ -267,6 +388,7 @@ class SystemCalc:
 			delegates.SocSync(self),
 			delegates.PvInverters(),
 			delegates.BatteryService(self),
+			delegates.BatteryBank(),
 			delegates.CanBatterySense(),
 			delegates.InverterCharger(),
 			delegates.DynamicEss(),
@@ -282,6 +404,17 @@ class SystemCalc:
 				for path in paths:
 					s[path] = dummy
 
+		# Delegates to tell when one of their trigger paths changed, see
+		# SystemCalcDelegate.get_triggers
+		self._triggers = {}
+		self._triggered = {}
+		for m in self._modules:
+			for service, paths in m.get_triggers():
+				s = dbus_tree.setdefault(service, {})
+				for path in paths:
+					s[path] = dummy
+					self._triggers.setdefault((service, path), []).append(m)
+
 		# Connect to localsettings
 		supported_settings = {
 			'batteryservice': ['/Settings/SystemSetup/BatteryService', self.BATSERVICE_DEFAULT, 0, 0],
@@ -303,14 +436,28 @@ class SystemCalc:
 			'motordriverpmmax': ['/Settings/Gui/Gauges/MotorDrive/RPM/Max', float(0), 0, float("inf")],
 			'gpsspeedmax': ['/Settings/Gui/Gauges/Speed/Max', float(0), 0, float("inf")],
 			'electricpropulsionenabled': ['/Settings/Gui/ElectricPropulsionUI/Enabled', 0, 0, 1],
+			'deadbandpower': ['/Settings/SystemSetup/PublishDeadband/Power', 1.0, 0, 1000],
+			'deadbandcurrent': ['/Settings/SystemSetup/PublishDeadband/Current', 0.1, 0, 100],
+			'deadbandvoltage': ['/Settings/SystemSetup/PublishDeadband/Voltage', 0.01, 0, 10],
+			'deadbandpercent': ['/Settings/SystemSetup/PublishDeadband/Percent', 0.1, 0, 10],
+			'deadbandpaths': ['/Settings/SystemSetup/PublishDeadband/Paths', '', 0, 0],
+			'publishrefresh': ['/Settings/SystemSetup/PublishRefreshInterval', 30, 1, 3600],
+			'tickfast': ['/Settings/SystemSetup/TickInterval/Fast', 200, 50, _TICK_INTERVAL],
+			'tickslow': ['/Settings/SystemSetup/TickInterval/Slow', 4000, _TICK_INTERVAL, 60000],
+			'profiledelegates': ['/Settings/SystemSetup/ProfileDelegates', 1, 0, 1],
 			}
 
 		for m in self._modules:
 			for setting in m.get_settings():
 				supported_settings[setting[0]] = list(setting[1:])
 
+		start = time.monotonic()
 		self._settings = self._create_settings(supported_settings, self._handlechangedsetting)
+		settings_time = int((time.monotonic() - start) * 1000)
+		logger.info("Added %d settings in %d ms", len(supported_settings), settings_time)
+		self._setting_names = list(supported_settings)
 		self._dbusservice = self._create_dbus_service()
+		self._dbusservice.add_path('/Debug/SettingsStartupTime', value=settings_time)
 
 		# At this moment, VRM portal ID is the MAC address of the CCGX. Anyhow, it should be string uniquely
 		# identifying the CCGX.
@@ -382,8 +529,8 @@ class SystemCalc:
 			'/Dc/Battery/ConsumedAmphours': {'gettext': '%.1F Ah'},
 			'/Dc/Battery/ProductId': {'gettext': '0x%x'},
 			'/Dc/Battery/Capacity': {'gettext': '%.0F Ah'},
-			'/Dc/Charger/Power': {'gettext': '%.0F %%'},
-			'/Dc/FuelCell/Power': {'gettext': '%.0F %%'},
+			'/Dc/Charger/Power': {'gettext': '%.0F W'},
+			'/Dc/FuelCell/Power': {'gettext': '%.0F W'},
 			'/Dc/Alternator/Power': {'gettext': '%.0F W'},
 			'/Dc/System/Power': {'gettext': '%.0F W'},
 			'/Dc/System/Current': {'gettext': '%.1F A'},
@@ -404,14 +551,77 @@ class SystemCalc:
 		for path in self._summeditems.keys():
 			self._dbusservice.add_path(path, value=None, gettextcallback=self._gettext)
 
+		# Publish state. The last published value of each path, the setting
+		# holding its deadband, the deadbands set for single paths, and
+		# since when a change has been held back for being inside the
+		# deadband.
+		self._published = dict.fromkeys(self._summeditems)
+		self._deadbands = {}
+		for path, item in self._summeditems.items():
+			if path in _DEADBAND_PATHS:
+				setting = _DEADBAND_PATHS[path]
+			else:
+				gettext = item.get('gettext')
+				m = _GETTEXT_UNIT.search(gettext) if isinstance(gettext, str) else None
+				setting = m and _DEADBAND_SETTINGS.get(m.group(1).replace('%%', '%'))
+			if setting:
+				self._deadbands[path] = setting
+		self._path_deadbands = _parse_deadbands(self._settings['deadbandpaths'])
+		self._held = {}
+
+		# Tick scheduling
+		self._tick_timer = None
+		self._tick_interval = _TICK_INTERVAL
+		self._fast_timer = None
+		self._fast_pending = False
+		self._dbusservice.add_path('/Debug/TickInterval', value=None)
+		self._dbusservice.add_path('/Debug/TickDuration', value=None)
+
+		# Service changes waiting to be handled
+		self._servicechange_timer = None
+		self._servicechanges_folded = 0
+		self._dbusservice.add_path('/Debug/ServiceChangesFolded', value=0)
+
+		# Run time of the delegate hooks, published under /Debug/Delegates
+		self._profiler = Profiler()
+		self._profiler.enabled = self._settings['profiledelegates'] == 1
+		self._profile_paths = set()
+
+		# Values written to other services by the delegates, sent once per
+		# tick
+		self._writequeue = WriteQueue(dbusservice=self._dbusservice)
+
+		# Periodic jobs of the delegates run off a shared timer
+		self._scheduler = Scheduler(self._dbusservice, self._profiler,
+			self._writequeue.flush)
+
+		# Graph of the values computed in _updatevalues. Changed (service
+		# class, path) pairs are collected between ticks, so that only the
+		# nodes reading from them are evaluated.
+		self._graph = DependencyGraph()
+		for name, inputs, outputs in _NODES:
+			self._graph.add_node(name, getattr(self, '_update_' + name), inputs, outputs)
+		self._imperative_paths = [p for p in self._summeditems if p not in self._graph.outputs]
+		self._dirty_paths = set()
+		self._graph_structure = None
+		self._graph_valid = False
+
+		# Services per service class, maintained from the device added and
+		# removed events.
+		self._services = ServiceIndex()
+
 		# Now start monitoring services, and complete initialisation of
 		# delegates
 		self._batteryservice = None
+		self._recorder = None
+		self._dbus_tree = dbus_tree
 		self._dbusmonitor = self._create_dbus_monitor(dbus_tree,
 			valueChangedCallback=self._dbus_value_changed,
 			deviceAddedCallback=self._device_added_early,
 			deviceRemovedCallback=self._device_removed,
 			scanCompleteCallback=self._scan_complete)
+		self._writequeue.dbusmonitor = self._dbusmonitor
+		self._consumption = ConsumptionEngine(self._dbusmonitor)
 
 		# Perform second phase of delegate initialisation
 		for m in self._modules:
@@ -431,16 +641,30 @@ class SystemCalc:
 	def _handlechangedsetting(self, setting, oldvalue, newvalue):
 		self._determinebatteryservice()
 		self._changed = True
+		self._wake()
+		if setting in _NODE_SETTINGS:
+			self._graph_valid = False
+		if self._recorder is not None:
+			self._recorder.setting_changed(setting, newvalue)
+		if setting == 'deadbandpaths':
+			self._path_deadbands = _parse_deadbands(newvalue)
+		if setting == 'profiledelegates':
+			self._profiler.enabled = newvalue == 1
+			if not self._profiler.enabled:
+				self._profiler.clear()
+				with self._dbusservice as s:
+					for path in self._profile_paths:
+						s[path] = None
 
 		# Give our delegates a chance to react on a settings change
 		for m in self._modules:
 			m.settings_changed(setting, oldvalue, newvalue)
 
 	def _find_device_instance(self, serviceclass, instance):
-		""" Gets a mapping of services vs DeviceInstance using
-		    get_service_list.  Then searches for the specified DeviceInstance
+		""" Gets a mapping of services vs DeviceInstance from the service
+		    index.  Then searches for the specified DeviceInstance
 		    and returns the service name. """
-		services = self._dbusmonitor.get_service_list(classfilter=serviceclass)
+		services = self._services.get(serviceclass)
 
 		for k, v in services.items():
 			if v == instance:
@@ -452,10 +676,10 @@ class SystemCalc:
 		auto_battery_measurement = None
 		auto_selected = False
 		if auto_battery_service is not None:
-			services = self._dbusmonitor.get_service_list()
-			if auto_battery_service in services:
+			instance = self._services.device_instance(auto_battery_service)
+			if instance is not None:
 				auto_battery_measurement = \
-					self._get_instance_service_name(auto_battery_service, services[auto_battery_service])
+					self._get_instance_service_name(auto_battery_service, instance)
 				auto_battery_measurement = auto_battery_measurement.replace('.', '_').replace('/', '_') + '/Dc/0'
 		self._dbusservice['/AutoSelectedBatteryMeasurement'] = auto_battery_measurement
 
@@ -485,8 +709,7 @@ class SystemCalc:
 			newbatteryservice = self._find_device_instance(serviceclass, instance)
 
 		if newbatteryservice != self._batteryservice:
-			services = self._dbusmonitor.get_service_list()
-			instance = services.get(newbatteryservice, None)
+			instance = self._services.device_instance(newbatteryservice)
 			if instance is None:
 				battery_service = None
 			else:
@@ -554,13 +777,53 @@ class SystemCalc:
 	def batteryservice(self):
 		return self._batteryservice
 
-	# Called on a one second timer
+	def _schedule_tick(self, interval):
+		if self._tick_timer is not None:
+			GLib.source_remove(self._tick_timer)
+		self._tick_interval = interval
+		self._tick_timer = GLib.timeout_add(interval, exit_on_error, self._handletimertick)
+		if self._fast_timer is None:
+			self._dbusservice['/Debug/TickInterval'] = interval
+
+	def _wake(self):
+		# Something changed. If ticks backed off, return to the normal rate.
+		if self._tick_interval > _TICK_INTERVAL and self._tick_timer is not None:
+			self._schedule_tick(_TICK_INTERVAL)
+
+	# Called on a timer, normally every second
 	def _handletimertick(self):
-		if self._changed:
+		self._flush_servicechange()
+
+		# Values held back by a deadband must still be refreshed eventually
+		if self._changed or self._held:
+			start = self._get_time()
 			self._updatevalues()
+			self._dbusservice['/Debug/TickDuration'] = round(1000 * (self._get_time() - start), 1)
+			interval = _TICK_INTERVAL
+		else:
+			# Nothing happened since the last tick, back off
+			interval = min(2 * self._tick_interval, self._settings['tickslow'])
 		self._changed = False
 
-		return True  # keep timer running
+		if interval == self._tick_interval:
+			return True  # keep timer running
+
+		self._tick_timer = None
+		self._schedule_tick(interval)
+		return False
+
+	# Called on a fast timer while ESS relevant inputs are changing
+	def _handlefasttick(self):
+		if self._fast_pending:
+			self._fast_pending = False
+			self._publish(self._evaluate_graph(), self._graph.values)
+			self._run_triggered()
+			self._writequeue.flush()
+			return True
+
+		self._fast_timer = None
+		self._dbusservice['/Debug/TickInterval'] = self._tick_interval
+		return False
 
 	def _updatevalues(self):
 		# ==== PREPARATIONS ====
@@ -573,15 +836,179 @@ class SystemCalc:
 				os.environ['TZ'] = tz
 				time.tzset()
 
-		# Determine values used in logic below
-		vebusses = self._dbusmonitor.get_service_list('com.victronenergy.vebus')
-		vebuspower = 0
-		for vebus in vebusses:
-			v = self._dbusmonitor.get_value(vebus, '/Dc/0/Voltage')
-			i = self._dbusmonitor.get_value(vebus, '/Dc/0/Current')
-			if v is not None and i is not None:
-				vebuspower += v * i
+		# ==== GRAPH ====
+		modified = self._evaluate_graph()
+		newvalues.update((k, v) for k, v in self._graph.values.items() if k.startswith('/'))
+
+		profile = self._profiler.call
+		for m in self._modules:
+			profile(type(m).__name__, 'UpdateValues', m.update_values, newvalues)
+
+		# ==== UPDATE MINIMUM AND MAXIMUM LEVELS ====
+		if (self._settings['gaugeautomax']):
+			# min/max values are stored and updated in localsettings
+			# values are stored under /Settings/Gui/Briefview
+			# /Settings/Gui/Gauges/AutoMax:
+			#	1-> Automatic: Gauge limits are updated automatically and stored in localsettings
+			# 	0-> Manual: Gauge limits are entered manually by the user
+			# The gui pulls the gauge limits from localsettings and provides
+			# a means for the user to set them if Automax is off.
+
+			# AC output
+			# This maximum is maintained for 3 situations:
+			# 1: AC input 1 is connected
+			# 2: AC input 2 is connected
+			# 3: No AC input is connected
+			# All 3 scenarios may lead to different maximum values since the capabilities of the system changes.
+			# So 3 different maxima are stored and relayed to /Ac/Consumption/Current/Max based on the active scenario.
+			activeIn = 'acin1' if (self._dbusservice['/Ac/In/0/Connected'] == 1) else \
+						'acin2' if (self._dbusservice['/Ac/In/1/Connected'] == 1) else \
+						'noacin'
+
+			# Quattro has 2 AC inputs which cannot be active simultaneously.
+			# activeIn needs to 1 when 'Ac/In/1/Connected' is 1 and can be 0 otherwise.
+			activeInNr = int(activeIn[-1]) -1 if activeIn != 'noacin' else None
+
+			# AC input
+			# Minimum values occur when feeding back to the grid.
+			# For the minimum value, make sure it is 0 at its maximum.
+			# Update correct '/Ac/In/..' based on the current active input.
+			# When no inputs are active, paths '/Ac/In/[0/1]/Current/[Min/Max] will all be invalidated.
+			if(activeInNr != None):
+				self._settings['acin%smin' % activeInNr] = min(0,
+																	self._settings['acin%smin' % activeInNr] or float("inf"),
+																	newvalues.get('/Ac/ActiveIn/L1/Current') or float("inf"),
+																	newvalues.get('/Ac/ActiveIn/L2/Current') or float("inf"),
+																	newvalues.get('/Ac/ActiveIn/L3/Current') or float("inf"))
+
+				self._settings['acin%smax' % activeInNr] = max(self._settings['acin%smax' % activeInNr] or 0,
+																	newvalues.get('/Ac/ActiveIn/L1/Current') or 0,
+																	newvalues.get('/Ac/ActiveIn/L2/Current') or 0,
+																	newvalues.get('/Ac/ActiveIn/L3/Current') or 0)
+
+			self._settings['%sconnmax' % activeIn] = max(self._settings['%sconnmax' % activeIn],
+																newvalues.get('/Ac/Consumption/L1/Current') or 0,
+																newvalues.get('/Ac/Consumption/L2/Current') or 0,
+																newvalues.get('/Ac/Consumption/L3/Current') or 0)
+
+			# DC input
+			self._settings['dcinmax'] = max(self._settings['dcinmax'] or 0,
+													sum([newvalues.get('/Dc/Charger/Power') or 0,
+														newvalues.get('/Dc/FuelCell/Power') or 0,
+														newvalues.get('/Dc/Alternator/Power') or 0]))
+
+			# DC output
+			self._settings['dcsysmax'] = _safemax(self._settings['dcsysmax'] or 0,
+															newvalues.get('/Dc/System/Power') or 0)
+
+			# PV power
+			self._settings['pvmax'] = _safemax(self._settings['pvmax'] or 0,
+													_safeadd(newvalues.get('/Dc/Pv/Power') or 0,
+													self._dbusservice['/Ac/PvOnGrid/L1/Power'],
+													self._dbusservice['/Ac/PvOnGrid/L2/Power'],
+													self._dbusservice['/Ac/PvOnGrid/L3/Power'],
+													self._dbusservice['/Ac/PvOnGenset/L1/Power'],
+													self._dbusservice['/Ac/PvOnGenset/L2/Power'],
+													self._dbusservice['/Ac/PvOnGenset/L3/Power'],
+													self._dbusservice['/Ac/PvOnOutput/L1/Power'],
+													self._dbusservice['/Ac/PvOnOutput/L2/Power'],
+													self._dbusservice['/Ac/PvOnOutput/L3/Power']))
 
+			# Electric propulsion
+			if self._settings['electricpropulsionenabled'] == 1:
+				self._settings['motordrivepowermax'] = max(self._settings['motordrivepowermax'] or 0,
+																newvalues.get('/MotorDrive/Power') or 0)
+				self._settings['motordriverpmmax'] = max(self._settings['motordriverpmmax'] or 0,
+															newvalues.get('/MotorDrive/0/RPM') or 0)
+				self._settings['gpsspeedmax'] = max(self._settings['gpsspeedmax'] or 0,
+													newvalues.get('/GpsSpeed') or 0)
+
+		# ==== UPDATE DBUS ITEMS ====
+		# Outputs of the graph are only considered when they changed, the
+		# rest on every tick, along with the values held back earlier.
+		self._publish(chain(modified, self._imperative_paths, list(self._held)), newvalues)
+		self._run_triggered()
+		self._writequeue.flush()
+
+	def _run_triggered(self):
+		# Once the values derived from them are published, tell the
+		# delegates whose trigger paths changed.
+		triggered, self._triggered = self._triggered, {}
+		profile = self._profiler.call
+		for m in triggered:
+			profile(type(m).__name__, 'Triggered', m.triggered)
+
+	def _evaluate_graph(self):
+		""" Evaluates the graph, and returns the set of outputs that
+		    changed. """
+		# Devices the nodes of the graph are built around. If any of these
+		# changed, all nodes have to be evaluated.
+		multi_path = getattr(delegates.Multi.instance.multi, 'service', None)
+		_other_inverters = sorted((di, s) for s, di in self._services.get('com.victronenergy.multi').items()) + \
+			sorted((di, s) for s, di in self._services.get('com.victronenergy.inverter').items())
+		non_vebus_inverters = [x[1] for x in _other_inverters]
+		grid_meter = delegates.AcInputs.instance.gridmeter
+		genset_meter = delegates.AcInputs.instance.gensetmeter
+		ctx = {
+			'multi_path': multi_path,
+			'non_vebus_inverters': non_vebus_inverters,
+			'non_vebus_inverter': non_vebus_inverters[0] if non_vebus_inverters else None,
+			'grid_meter': grid_meter,
+			'genset_meter': genset_meter}
+
+		structure = (self._batteryservice, multi_path, tuple(non_vebus_inverters),
+			getattr(grid_meter, 'service', None), getattr(genset_meter, 'service', None))
+		if structure != self._graph_structure:
+			self._graph_structure = structure
+			self._graph_valid = False
+			self._consumption.bind(*structure[1:])
+
+		# Evaluate only the nodes downstream of a path that changed since the
+		# last tick. The others keep their results from before.
+		modified = self._graph.evaluate(
+			self._dirty_paths if self._graph_valid else None, ctx)
+		self._dirty_paths = set()
+		self._graph_valid = True
+		return modified
+
+	def _publish(self, paths, values):
+		""" Publish the values of paths, if they changed by more than their
+		    deadband. """
+		now = self._get_time()
+		deadbands = {s: self._settings[s] for s in _DEADBAND_SETTINGS.values()}
+		refresh = self._settings['publishrefresh']
+		with self._dbusservice as sss:
+			for path in paths:
+				if path not in self._summeditems:
+					continue
+				# Why the None? Because we want to invalidate things we don't have anymore.
+				value = values.get(path, None)
+				if self._publish_needed(path, value, deadbands, refresh, now):
+					sss[path] = self._published[path] = value
+
+	def _publish_needed(self, path, value, deadbands, refresh, now):
+		""" Returns True if value differs enough from what was published
+		    for path, or if the difference was held back for longer than
+		    the refresh interval. Transitions from or to None are always
+		    published. """
+		published = self._published[path]
+		if value == published:
+			self._held.pop(path, None)
+			return False
+
+		try:
+			deadband = self._path_deadbands[path]
+		except KeyError:
+			deadband = deadbands.get(self._deadbands.get(path))
+		if deadband and _isnumber(value) and _isnumber(published) and \
+				abs(value - published) < deadband:
+			if now - self._held.setdefault(path, now) < refresh:
+				return False
+
+		self._held.pop(path, None)
+		return True
+
+	def _update_pvinverters(self, newvalues, ctx):
 		# ==== PVINVERTERS ====
 		# Work is done in pv-inverter delegate. Ideally all of this should
 		# happen in update_values in the delegate, but these values are
@@ -594,8 +1021,19 @@ class SystemCalc:
 		self._compute_number_of_phases('/Ac/PvOnOutput', newvalues)
 		self._compute_number_of_phases('/Ac/PvOnGenset', newvalues)
 
+	def _update_vebuspower(self, newvalues, ctx):
+		vebusses = self._services.get('com.victronenergy.vebus')
+		vebuspower = 0
+		for vebus in vebusses:
+			v = self._dbusmonitor.get_value(vebus, '/Dc/0/Voltage')
+			i = self._dbusmonitor.get_value(vebus, '/Dc/0/Current')
+			if v is not None and i is not None:
+				vebuspower += v * i
+		newvalues['vebuspower'] = vebuspower
+
+	def _update_solarchargers(self, newvalues, ctx):
 		# ==== SOLARCHARGERS ====
-		solarchargers = self._dbusmonitor.get_service_list('com.victronenergy.solarcharger')
+		solarchargers = self._services.get('com.victronenergy.solarcharger')
 		solarcharger_batteryvoltage = None
 		solarcharger_batteryvoltage_service = None
 		solarchargers_charge_power = 0.0
@@ -637,8 +1075,30 @@ class SystemCalc:
 				newvalues['/Dc/Pv/Power'] += v * total_current
 				newvalues['/Dc/Pv/Current'] += total_current
 
+		# ==== Other Inverters and Inverter/Chargers ====
+		# For RS Smart and Multi RS, add PV to the yield
+		for i in ctx['non_vebus_inverters']:
+			if (pv_yield := self._dbusmonitor.get_value(i, "/Yield/Power")) is not None:
+				newvalues['/Dc/Pv/Power'] = newvalues.get('/Dc/Pv/Power', 0) + pv_yield
+
+				# Also calculate and update DC current contribution of this
+				# inverter/charger.
+				try:
+					newvalues['/Dc/Pv/Current'] = newvalues.get(
+						'/Dc/Pv/Current', 0) + (
+						pv_yield / self._dbusmonitor.get_value(i, "/Dc/0/Voltage"))
+				except (TypeError, ZeroDivisionError):
+					pass
+
+		newvalues['solarchargers_charge_power'] = solarchargers_charge_power
+		newvalues['solarchargers_total_power'] = solarchargers_total_power
+		newvalues['solarchargers_loadoutput_power'] = solarchargers_loadoutput_power
+		newvalues['solarcharger_batteryvoltage'] = solarcharger_batteryvoltage
+		newvalues['solarcharger_batteryvoltage_service'] = solarcharger_batteryvoltage_service
+
+	def _update_fuelcells(self, newvalues, ctx):
 		# ==== FUELCELLS ====
-		fuelcells = self._dbusmonitor.get_service_list('com.victronenergy.fuelcell')
+		fuelcells = self._services.get('com.victronenergy.fuelcell')
 		fuelcell_batteryvoltage = None
 		fuelcell_batteryvoltage_service = None
 		for fuelcell in fuelcells:
@@ -659,8 +1119,12 @@ class SystemCalc:
 			else:
 				newvalues['/Dc/FuelCell/Power'] += v * i
 
+		newvalues['fuelcell_batteryvoltage'] = fuelcell_batteryvoltage
+		newvalues['fuelcell_batteryvoltage_service'] = fuelcell_batteryvoltage_service
+
+	def _update_alternators(self, newvalues, ctx):
 		# ==== ALTERNATOR ====
-		alternators = self._dbusmonitor.get_service_list('com.victronenergy.alternator')
+		alternators = self._services.get('com.victronenergy.alternator')
 		for alternator in alternators:
 			# Assume the battery connected to output 0 is the main battery
 			p = self._dbusmonitor.get_value(alternator, '/Dc/0/Power')
@@ -673,7 +1137,7 @@ class SystemCalc:
 				newvalues['/Dc/Alternator/Power'] += p
 
 		# DC gensets are alternators connected to an engine, add their power too
-		dcgensets = self._dbusmonitor.get_service_list('com.victronenergy.dcgenset')
+		dcgensets = self._services.get('com.victronenergy.dcgenset')
 		for dcgenset in dcgensets:
 			p = self._dbusmonitor.get_value(dcgenset, '/Dc/0/Power')
 			if p is None:
@@ -688,8 +1152,9 @@ class SystemCalc:
 			else:
 				newvalues['/Dc/Alternator/Power'] += p
 
+	def _update_chargers(self, newvalues, ctx):
 		# ==== CHARGERS ====
-		chargers = self._dbusmonitor.get_service_list('com.victronenergy.charger')
+		chargers = self._services.get('com.victronenergy.charger')
 		charger_batteryvoltage = None
 		charger_batteryvoltage_service = None
 		for charger in chargers:
@@ -710,33 +1175,20 @@ class SystemCalc:
 			else:
 				newvalues['/Dc/Charger/Power'] += v * i
 
-		# ==== Other Inverters and Inverter/Chargers ====
-		_other_inverters = sorted((di, s) for s, di in self._dbusmonitor.get_service_list('com.victronenergy.multi').items()) + \
-			sorted((di, s) for s, di in self._dbusmonitor.get_service_list('com.victronenergy.inverter').items())
-		non_vebus_inverters = [x[1] for x in _other_inverters]
-		non_vebus_inverter = None
-		if non_vebus_inverters:
-			non_vebus_inverter = non_vebus_inverters[0]
-
-			# For RS Smart and Multi RS, add PV to the yield
-			for i in itertools.chain(
-					self._dbusmonitor.get_service_list('com.victronenergy.multi').keys(),
-					self._dbusmonitor.get_service_list('com.victronenergy.inverter').keys()):
-				if (pv_yield := self._dbusmonitor.get_value(i, "/Yield/Power")) is not None:
-					newvalues['/Dc/Pv/Power'] = newvalues.get('/Dc/Pv/Power', 0) + pv_yield
-
-					# Also calculate and update DC current contribution of this
-					# inverter/charger.
-					try:
-						newvalues['/Dc/Pv/Current'] = newvalues.get(
-							'/Dc/Pv/Current', 0) + (
-							pv_yield / self._dbusmonitor.get_value(i, "/Dc/0/Voltage"))
-					except (TypeError, ZeroDivisionError):
-						pass
-
-
-		# Used lower down, possibly needed for battery values as well
-		dcsystems = self._dbusmonitor.get_service_list('com.victronenergy.dcsystem')
+		newvalues['charger_batteryvoltage'] = charger_batteryvoltage
+		newvalues['charger_batteryvoltage_service'] = charger_batteryvoltage_service
+
+	def _update_battery(self, newvalues, ctx):
+		vebuspower = newvalues['vebuspower']
+		solarchargers_charge_power = newvalues['solarchargers_charge_power']
+		solarcharger_batteryvoltage = newvalues['solarcharger_batteryvoltage']
+		solarcharger_batteryvoltage_service = newvalues['solarcharger_batteryvoltage_service']
+		fuelcell_batteryvoltage = newvalues['fuelcell_batteryvoltage']
+		fuelcell_batteryvoltage_service = newvalues['fuelcell_batteryvoltage_service']
+		charger_batteryvoltage = newvalues['charger_batteryvoltage']
+		charger_batteryvoltage_service = newvalues['charger_batteryvoltage_service']
+		non_vebus_inverter = ctx['non_vebus_inverter']
+		dcsystems = self._services.get('com.victronenergy.dcsystem')
 
 		# ==== BATTERY ====
 		if self._batteryservice is not None:
@@ -766,6 +1218,10 @@ class SystemCalc:
 						capacity if capacity is not None else
 						self._dbusmonitor.get_value(self._batteryservice, '/Capacity'))
 
+					# With several batteries in a bank, use all of them
+					if delegates.BatteryBank.instance.enabled:
+						newvalues.update(delegates.BatteryBank.instance.get_totals())
+
 			elif batteryservicetype == 'vebus':
 				vebus_voltage = self._dbusmonitor.get_value(self._batteryservice, '/Dc/0/Voltage')
 				vebus_current = self._dbusmonitor.get_value(self._batteryservice, '/Dc/0/Current')
@@ -805,7 +1261,7 @@ class SystemCalc:
 			# try a solar charger, a charger, a vedirect inverter or a dcsource
 			# as fallbacks.
 			batteryservicetype = None
-			vebusses = self._dbusmonitor.get_service_list('com.victronenergy.vebus')
+			vebusses = self._services.get('com.victronenergy.vebus')
 			for vebus in vebusses:
 				v = self._dbusmonitor.get_value(vebus, '/Dc/0/Voltage')
 				s = self._dbusmonitor.get_value(vebus, '/State')
@@ -851,6 +1307,16 @@ class SystemCalc:
 					newvalues['/Dc/Battery/Current'] = p / voltage if voltage > 0 else None
 					newvalues['/Dc/Battery/Power'] = p
 
+		newvalues['batteryservicetype'] = batteryservicetype
+
+	def _update_dcsystem(self, newvalues, ctx):
+		vebuspower = newvalues['vebuspower']
+		solarchargers_total_power = newvalues['solarchargers_total_power']
+		solarchargers_loadoutput_power = newvalues['solarchargers_loadoutput_power']
+		batteryservicetype = newvalues['batteryservicetype']
+		non_vebus_inverters = ctx['non_vebus_inverters']
+		dcsystems = self._services.get('com.victronenergy.dcsystem')
+
 		# ==== SYSTEM POWER ====
 		# Look for dcsytem devices, add them together. Otherwise, if enabled,
 		# calculate it
@@ -908,8 +1374,11 @@ class SystemCalc:
 			except (KeyError, ZeroDivisionError, TypeError):
 				pass
 
+	def _update_acinsource(self, newvalues, ctx):
+		multi_path = ctx['multi_path']
+		non_vebus_inverter = ctx['non_vebus_inverter']
+
 		# ===== AC IN SOURCE =====
-		multi_path = getattr(delegates.Multi.instance.multi, 'service', None)
 		ac_in_source = None
 		active_input = None
 		if multi_path is None:
@@ -930,263 +1399,47 @@ class SystemCalc:
 				settings_path = '/Settings/SystemSetup/AcInput%s' % (active_input + 1)
 				ac_in_source = self._dbusmonitor.get_value('com.victronenergy.settings', settings_path)
 		newvalues['/Ac/ActiveIn/Source'] = ac_in_source
+		newvalues['active_input'] = active_input
 
+	def _update_acconsumption(self, newvalues, ctx):
 		# ===== GRID METERS & CONSUMPTION ====
-		grid_meter = delegates.AcInputs.instance.gridmeter
-		genset_meter = delegates.AcInputs.instance.gensetmeter
-
-		# Make an educated guess as to what is being consumed from an AC source. If ac_in_source
-		# indicates grid, genset or shore, we use that. If the Multi is off, or disconnected through
-		# a relay assistant or otherwise, then assume the presence of a .grid or .genset service indicates
-		# presence of that AC source. If both are available, then give up. This decision making is here
-		# so the GUI has something to present even if the Multi is off.
-		ac_in_guess = ac_in_source
-		if ac_in_guess in (None, 0xF0):
-			if genset_meter is None and grid_meter is not None:
-				ac_in_guess = 1
-			elif grid_meter is None and genset_meter is not None:
-				ac_in_guess = 2
-
-		consumption = { "L1" : None, "L2" : None, "L3" : None }
-		currentconsumption = { "L1" : None, "L2" : None, "L3" : None }
-		for device_type, em, _types in (('Grid', grid_meter, (1, 3)), ('Genset', genset_meter, (2,))):
-			# If a grid meter is present we use values from it. If not, we look at the multi. If it has
-			# AcIn1 or AcIn2 connected to the grid, we use those values.
-			# com.victronenergy.grid.??? indicates presence of an energy meter used as grid meter.
-			# com.victronenergy.vebus.???/Ac/ActiveIn/ActiveInput: decides which whether we look at AcIn1
-			# or AcIn2 as possible grid connection.
-			uses_active_input = ac_in_source in _types
-			for phase in consumption:
-				p = None
-				mc = None
-				pvpower = newvalues.get(_AC_PATHS[(device_type, phase, 'pvpower')])
-				pvcurrent = newvalues.get(_AC_PATHS[(device_type, phase, 'pvcurrent')])
-				if em is not None:
-					p = self._dbusmonitor.get_value(em.service, _AC_PATHS[(device_type, phase, 'em_p')])
-					mc = self._dbusmonitor.get_value(em.service, _AC_PATHS[(device_type, phase, 'em_i')])
-					# Compute consumption between energy meter and multi (meter power - multi AC in) and
-					# add an optional PV inverter on input to the mix.
-					c = None
-					cc = None
-					if uses_active_input:
-						if multi_path is not None:
-							try:
-								c = _safeadd(c, -self._dbusmonitor.get_value(multi_path, _AC_PATHS[(device_type, phase, 'ain_p')]))
-								cc = _safeadd(cc, -self._dbusmonitor.get_value(multi_path, _AC_PATHS[(device_type, phase, 'ain_i')]))
-							except TypeError:
-								pass
-						if non_vebus_inverter is not None and active_input in (0, 1):
-							for i in non_vebus_inverters:
-								try:
-									c = _safeadd(c, -self._dbusmonitor.get_value(i, '/Ac/In/%d/%s/P' % (active_input+1, phase)))
-									cc = _safeadd(cc, -self._dbusmonitor.get_value(i, '/Ac/In/%d/%s/I' % (active_input+1, phase)))
-								except TypeError:
-									pass
-
-					# If there's any power coming from a PV inverter in the inactive AC in (which is unlikely),
-					# it will still be used, because there may also be a load in the same ACIn consuming
-					# power, or the power could be fed back to the net.
-					c = _safeadd(c, p, pvpower)
-					cc = _safeadd(cc, mc, pvcurrent)
-					consumption[phase] = _safeadd(consumption[phase], _safemax(0, c))
-					currentconsumption[phase] = _safeadd(currentconsumption[phase], _safemax(0, cc))
-				else:
-					if uses_active_input:
-						if multi_path is not None:
-							vebus_ain_p = self._dbusmonitor.get_value(multi_path, _AC_PATHS[(device_type, phase, 'ain_p')])
-							if vebus_ain_p is not None:
-								p = _safeadd(p, vebus_ain_p)
-								mc = _safeadd(mc, self._dbusmonitor.get_value(multi_path, _AC_PATHS[(device_type, phase, 'ain_i')]))
-						if non_vebus_inverter is not None and active_input in (0, 1):
-							for i in non_vebus_inverters:
-								p = _safeadd(p,
-									self._dbusmonitor.get_value(i, '/Ac/In/%d/%s/P' % (active_input + 1, phase)))
-								mc = _safeadd(mc,
-									self._dbusmonitor.get_value(i, '/Ac/In/%d/%s/I' % (active_input + 1, phase)))
-						if p is not None:
-							consumption[phase] = _safeadd(0, consumption[phase])
-							currentconsumption[phase] = _safeadd(0, currentconsumption[phase])
-
-					# No relevant energy meter present. Assume there is no load between the grid and the multi.
-					# There may be a PV inverter present though (Hub-3 setup).
-					try:
-						p = _safeadd(p, -pvpower)
-						mc = _safeadd(mc, -pvcurrent)
-					except TypeError:
-						pass
-
-				newvalues[_AC_PATHS[(device_type, phase, 'out_p')]] = p
-				newvalues[_AC_PATHS[(device_type, phase, 'out_i')]] = mc
-				if ac_in_guess in _types:
-					newvalues[_AC_PATHS[(device_type, phase, 'activein_p')]] = p
-					newvalues[_AC_PATHS[(device_type, phase, 'activein_i')]] = mc
-
-			self._compute_number_of_phases('/Ac/' + device_type, newvalues)
-			self._compute_number_of_phases('/Ac/ActiveIn', newvalues)
-
-			product_id = None
-			device_type_id = None
-			if em is not None:
-				product_id = em.product_id
-				device_type_id = em.device_type
-			if product_id is None and uses_active_input:
-				if multi_path is not None:
-					product_id = self._dbusmonitor.get_value(multi_path, '/ProductId')
-				elif non_vebus_inverter is not None:
-					product_id = self._dbusmonitor.get_value(non_vebus_inverter, '/ProductId')
-			newvalues['/Ac/' + device_type + '/ProductId'] = product_id
-			newvalues['/Ac/' + device_type + '/DeviceType'] = device_type_id
-
-		# If a system has no loads/generation on the input side, we can
-		# assume ConsumptionOnInput to be invalid. This also implies that
-		# everything must be on AC-out then.
-		has_ac_in_system = self._settings['hasacinloads'] == 1
-
-		# If we have an ESS system and RunWithoutGridMeter is set, there cannot be load on the AC-In, so it
-		# must be on AC-Out. Hence we do calculate AC-Out consumption even if 'useacout' is disabled.
-		# Similarly all load are by definition on the output if this is not an ESS system.
-		use_ac_out = \
-			not has_ac_in_system or \
-			self._settings['useacout'] == 1 or \
-			(multi_path is not None and self._dbusmonitor.get_value(multi_path, '/Hub4/AssistantId') not in (4, 5)) or \
-			self._dbusmonitor.get_value('com.victronenergy.settings', '/Settings/CGwacs/RunWithoutGridMeter') == 1
-		for phase in consumption:
-			c = None
-			a = None
-			if use_ac_out:
-				c = newvalues.get(_AC_PATHS[(phase, 'pvout_p')])
-				a = newvalues.get(_AC_PATHS[(phase, 'pvout_i')])
-				if multi_path is not None:
-					ac_out = self._dbusmonitor.get_value(multi_path, '/Ac/Out/%s/P' % phase)
-					c = _safeadd(c, ac_out)
-					i_out = self._dbusmonitor.get_value(multi_path, '/Ac/Out/%s/I' % phase)
-					a = _safeadd(a, i_out)
-				for inv in non_vebus_inverters:
-					ac_out = self._dbusmonitor.get_value(inv, '/Ac/Out/%s/P' % phase)
-					i = self._dbusmonitor.get_value(inv, '/Ac/Out/%s/I' % phase)
-
-					# Some models don't show power, try apparent power,
-					# else calculate it
-					if ac_out is None:
-						ac_out = self._dbusmonitor.get_value(inv, '/Ac/Out/%s/S' % phase)
-						if ac_out is None:
-							u = self._dbusmonitor.get_value(inv, '/Ac/Out/%s/V' % phase)
-							if None not in (i, u):
-								ac_out = i * u
-					c = _safeadd(c, ac_out)
-					a = _safeadd(a, i)
-				c = _safemax(0, c)
-				a = _safemax(0, a)
-			newvalues[_AC_PATHS[(phase, 'cons_out_p')]] = c
-			newvalues[_AC_PATHS[(phase, 'cons_out_i')]] = a
-			newvalues[_AC_PATHS[(phase, 'cons_p')]] = _safeadd(consumption[phase], c)
-			newvalues[_AC_PATHS[(phase, 'cons_i')]] = _safeadd(currentconsumption[phase], a)
-			if has_ac_in_system:
-				newvalues[_AC_PATHS[(phase, 'cons_in_p')]] = consumption[phase]
-				newvalues[_AC_PATHS[(phase, 'cons_in_i')]] = currentconsumption[phase]
-
-		self._compute_number_of_phases('/Ac/Consumption', newvalues)
-		self._compute_number_of_phases('/Ac/ConsumptionOnOutput', newvalues)
-		self._compute_number_of_phases('/Ac/ConsumptionOnInput', newvalues)
-
-		for m in self._modules:
-			m.update_values(newvalues)
-
-		# ==== UPDATE MINIMUM AND MAXIMUM LEVELS ====
-		if (self._settings['gaugeautomax']):
-			# min/max values are stored and updated in localsettings
-			# values are stored under /Settings/Gui/Briefview
-			# /Settings/Gui/Gauges/AutoMax:
-			#	1-> Automatic: Gauge limits are updated automatically and stored in localsettings
-			# 	0-> Manual: Gauge limits are entered manually by the user
-			# The gui pulls the gauge limits from localsettings and provides
-			# a means for the user to set them if Automax is off.
-
-			# AC output
-			# This maximum is maintained for 3 situations:
-			# 1: AC input 1 is connected
-			# 2: AC input 2 is connected
-			# 3: No AC input is connected
-			# All 3 scenarios may lead to different maximum values since the capabilities of the system changes.
-			# So 3 different maxima are stored and relayed to /Ac/Consumption/Current/Max based on the active scenario.
-			activeIn = 'acin1' if (self._dbusservice['/Ac/In/0/Connected'] == 1) else \
-						'acin2' if (self._dbusservice['/Ac/In/1/Connected'] == 1) else \
-						'noacin'
-
-			# Quattro has 2 AC inputs which cannot be active simultaneously.
-			# activeIn needs to 1 when 'Ac/In/1/Connected' is 1 and can be 0 otherwise.
-			activeInNr = int(activeIn[-1]) -1 if activeIn != 'noacin' else None
-
-			# AC input
-			# Minimum values occur when feeding back to the grid.
-			# For the minimum value, make sure it is 0 at its maximum.
-			# Update correct '/Ac/In/..' based on the current active input.
-			# When no inputs are active, paths '/Ac/In/[0/1]/Current/[Min/Max] will all be invalidated.
-			if(activeInNr != None):
-				self._settings['acin%smin' % activeInNr] = min(0,
-																	self._settings['acin%smin' % activeInNr] or float("inf"),
-																	newvalues.get('/Ac/ActiveIn/L1/Current') or float("inf"),
-																	newvalues.get('/Ac/ActiveIn/L2/Current') or float("inf"),
-																	newvalues.get('/Ac/ActiveIn/L3/Current') or float("inf"))
-
-				self._settings['acin%smax' % activeInNr] = max(self._settings['acin%smax' % activeInNr] or 0,
-																	newvalues.get('/Ac/ActiveIn/L1/Current') or 0,
-																	newvalues.get('/Ac/ActiveIn/L2/Current') or 0,
-																	newvalues.get('/Ac/ActiveIn/L3/Current') or 0)
-
-			self._settings['%sconnmax' % activeIn] = max(self._settings['%sconnmax' % activeIn],
-																newvalues.get('/Ac/Consumption/L1/Current') or 0,
-																newvalues.get('/Ac/Consumption/L2/Current') or 0,
-																newvalues.get('/Ac/Consumption/L3/Current') or 0)
-
-			# DC input
-			self._settings['dcinmax'] = max(self._settings['dcinmax'] or 0,
-													sum([newvalues.get('/Dc/Charger/Power') or 0,
-														newvalues.get('/Dc/FuelCell/Power') or 0,
-														newvalues.get('/Dc/Alternator/Power') or 0]))
-
-			# DC output
-			self._settings['dcsysmax'] = _safemax(self._settings['dcsysmax'] or 0,
-															newvalues.get('/Dc/System/Power') or 0)
-
-			# PV power
-			self._settings['pvmax'] = _safemax(self._settings['pvmax'] or 0,
-													_safeadd(newvalues.get('/Dc/Pv/Power') or 0,
-													self._dbusservice['/Ac/PvOnGrid/L1/Power'],
-													self._dbusservice['/Ac/PvOnGrid/L2/Power'],
-													self._dbusservice['/Ac/PvOnGrid/L3/Power'],
-													self._dbusservice['/Ac/PvOnGenset/L1/Power'],
-													self._dbusservice['/Ac/PvOnGenset/L2/Power'],
-													self._dbusservice['/Ac/PvOnGenset/L3/Power'],
-													self._dbusservice['/Ac/PvOnOutput/L1/Power'],
-													self._dbusservice['/Ac/PvOnOutput/L2/Power'],
-													self._dbusservice['/Ac/PvOnOutput/L3/Power']))
+		self._consumption.update(newvalues, ctx['grid_meter'], ctx['genset_meter'],
+			newvalues['/Ac/ActiveIn/Source'], newvalues['active_input'],
+			self._settings['hasacinloads'] == 1, self._settings['useacout'] == 1)
+
+	def _servicechanged(self):
+		# Service changes tend to come in bursts, at startup or when a
+		# VE.Can bus resets. Handle them all at once when the main loop is
+		# idle, or at the next tick, whichever comes first.
+		if self._servicechange_timer is None:
+			self._servicechange_timer = GLib.idle_add(exit_on_error, self._on_servicechange_idle)
+		else:
+			self._servicechanges_folded += 1
 
-			# Electric propulsion
-			if self._settings['electricpropulsionenabled'] == 1:
-				self._settings['motordrivepowermax'] = max(self._settings['motordrivepowermax'] or 0,
-																newvalues.get('/MotorDrive/Power') or 0)
-				self._settings['motordriverpmmax'] = max(self._settings['motordriverpmmax'] or 0,
-															newvalues.get('/MotorDrive/0/RPM') or 0)
-				self._settings['gpsspeedmax'] = max(self._settings['gpsspeedmax'] or 0,
-													newvalues.get('/GpsSpeed') or 0)
+	def _on_servicechange_idle(self):
+		self._servicechange_timer = None
+		self._handleservicechange()
+		return False
 
-		# ==== UPDATE DBUS ITEMS ====
-		with self._dbusservice as sss:
-			for path in self._summeditems.keys():
-				# Why the None? Because we want to invalidate things we don't have anymore.
-				sss[path] = newvalues.get(path, None)
+	def _flush_servicechange(self):
+		if self._servicechange_timer is not None:
+			self._handleservicechange()
 
 	def _handleservicechange(self):
+		if self._servicechange_timer is not None:
+			GLib.source_remove(self._servicechange_timer)
+			self._servicechange_timer = None
+		self._dbusservice['/Debug/ServiceChangesFolded'] = self._servicechanges_folded
+
 		# Update the available battery monitor services, used to populate the dropdown in the settings.
 		# Below code makes a dictionary. The key is [dbuserviceclass]/[deviceinstance]. For example
 		# "battery/245". The value is the name to show to the user in the dropdown. The full dbus-
 		# servicename, ie 'com.victronenergy.vebus.ttyO1' is not used, since the last part of that is not
 		# fixed. dbus-serviceclass name and the device instance are already fixed, so best to use those.
 
-		services = self._get_connected_service_list('com.victronenergy.vebus')
+		services = dict(self._get_connected_service_list('com.victronenergy.vebus'))
 		services.update(self._get_connected_service_list('com.victronenergy.battery'))
-		services.update(self._dbusmonitor.get_service_list('com.victronenergy.acsystem'))
+		services.update(self._services.get('com.victronenergy.acsystem'))
 		services.update({k: v for k, v in self._get_connected_service_list(
 			'com.victronenergy.multi').items() if self._dbusmonitor.get_value(k, '/Soc') is not None})
 		services.update({k: v for k, v in self._get_connected_service_list(
@@ -1209,6 +1462,8 @@ class SystemCalc:
 		self._determinebatteryservice()
 
 		self._changed = True
+		self._graph_valid = False
+		self._wake()
 
 	def _get_readable_service_name(self, servicename):
 		cn = self._dbusmonitor.get_value(servicename, '/CustomName')
@@ -1222,25 +1477,45 @@ class SystemCalc:
 	def _get_instance_service_name(self, service, instance):
 		return '%s/%s' % ('.'.join(service.split('.')[0:3]), instance)
 
-	def _remove_unconnected_services(self, services):
+	def _update_connected(self, servicename):
 		# Workaround: because com.victronenergy.vebus is available even when there is no vebus product
-		# connected, remove any service that is not connected. Previously we used
+		# connected, a service only counts as connected if all of these are valid. Previously we used
 		# /State since mandatory path /Connected is not implemented in mk2dbus,
 		# but this has since been resolved.
-		for servicename in list(services.keys()):
-			if (self._dbusmonitor.get_value(servicename, '/Connected') != 1
-				or self._dbusmonitor.get_value(servicename, '/ProductName') is None
-				or self._dbusmonitor.get_value(servicename, '/Mgmt/Connection') is None):
-				del services[servicename]
+		self._services.set_connected(servicename,
+			self._dbusmonitor.get_value(servicename, '/Connected') == 1
+			and self._dbusmonitor.get_value(servicename, '/ProductName') is not None
+			and self._dbusmonitor.get_value(servicename, '/Mgmt/Connection') is not None)
 
 	def _dbus_value_changed(self, dbusServiceName, dbusPath, dict, changes, deviceInstance):
 		self._changed = True
+		key = (service_base_name(dbusServiceName), dbusPath)
+		self._dirty_paths.add(key)
+		self._wake()
+		if self._recorder is not None:
+			self._recorder.value_changed(dbusServiceName, dbusPath,
+				self._dbusmonitor.get_value(dbusServiceName, dbusPath))
+
+		triggered = self._triggers.get(key)
+		if triggered is not None:
+			for m in triggered:
+				self._triggered[m] = None
+
+		if triggered is not None or key in _FAST_TICK_INPUTS:
+			self._fast_pending = True
+			if self._fast_timer is None and self._tick_timer is not None:
+				interval = self._settings['tickfast']
+				self._fast_timer = GLib.timeout_add(interval, exit_on_error, self._handlefasttick)
+				self._dbusservice['/Debug/TickInterval'] = interval
+
+		if dbusPath in ('/Connected', '/ProductName', '/Mgmt/Connection'):
+			self._update_connected(dbusServiceName)
 
 		# Workaround because com.victronenergy.vebus is available even when there is no vebus product
 		# connected.
 		if (dbusPath in ['/Connected', '/ProductName', '/Mgmt/Connection', '/CustomName'] or
 			(dbusPath == '/State' and dbusServiceName.split('.')[0:3] == ['com', 'victronenergy', 'vebus'])):
-			self._handleservicechange()
+			self._servicechanged()
 
 		# Track the timezone changes
 		if dbusPath == '/Settings/System/TimeZone':
@@ -1250,16 +1525,31 @@ class SystemCalc:
 				time.tzset()
 
 	def _device_added_early(self, service, instance):
+		self._services.add(service, instance)
+		if self._recorder is not None:
+			self._recorder.service_added(service)
+		self._update_connected(service)
+		self._graph_valid = False
+		profile = self._profiler.call
 		for m in self._modules:
-			m.device_added(service, instance)
+			profile(type(m).__name__, 'DeviceAdded', m.device_added, service, instance)
 
 	def _device_added(self, service, instance):
-		self._handleservicechange()
+		self._services.add(service, instance)
+		if self._recorder is not None:
+			self._recorder.service_added(service)
+		self._update_connected(service)
+		self._servicechanged()
+		profile = self._profiler.call
 		for m in self._modules:
-			m.device_added(service, instance)
+			profile(type(m).__name__, 'DeviceAdded', m.device_added, service, instance)
 
 	def _device_removed(self, service, instance):
-		self._handleservicechange()
+		self._services.remove(service)
+		self._writequeue.forget(service)
+		if self._recorder is not None:
+			self._recorder.service_removed(service)
+		self._servicechanged()
 
 		for m in self._modules:
 			m.device_removed(service, instance)
@@ -1278,9 +1568,30 @@ class SystemCalc:
 		self._handleservicechange()
 		self._updatevalues()
 		self._dbusservice.register()
-		GLib.timeout_add_seconds(1, exit_on_error, self._handletimertick)
+		self._schedule_tick(_TICK_INTERVAL)
+		GLib.timeout_add_seconds(10, exit_on_error, self._publish_profile)
 		logger.info("Startup scan complete")
 
+	def _publish_profile(self):
+		# All of it goes out as one ItemsChanged
+		with self._dbusservice as s:
+			for name, hook, stats in self._profiler.changed():
+				prefix = '/Debug/Delegates/{}/{}/'.format(name, hook)
+				for label, v in zip(('P50', 'P99', 'Max'), stats):
+					path = prefix + label
+					if path not in self._profile_paths:
+						self._profile_paths.add(path)
+						s.add_path(path, value=None)
+					s[path] = None if v is None else round(v, 3)
+		return True
+
+	def record(self, path):
+		""" Start writing the monitored services and all changes to
+		    their values to path, for replaying with tests/replay.py. """
+		settings = {k: self._settings[k] for k in self._setting_names}
+		self._recorder = Recorder(path, self._dbusmonitor, self._dbus_tree, settings)
+		logger.info("Recording to %s", path)
+
 	def _gettext(self, path, value):
 		item = self._summeditems.get(path)
 		if item is not None:
@@ -1302,27 +1613,16 @@ class SystemCalc:
 				number_of_phases = phase
 		newvalues[path + '/NumberOfPhases'] = number_of_phases
 
-	def _get_connected_service_list(self, classfilter=None):
-		services = self._dbusmonitor.get_service_list(classfilter=classfilter)
-		self._remove_unconnected_services(services)
-		return services
+	def _get_connected_service_list(self, classfilter):
+		return self._services.connected(classfilter)
 
 	# returns a servicename string
 	def _get_first_connected_service(self, classfilter):
-		services = self._get_connected_service_list(classfilter=classfilter)
-		if len(services) == 0:
-			return None
-		return next(iter(services.items()), (None,))[0]
+		return next(iter(self._get_connected_service_list(classfilter)), None)
 
 	# returns a tuple (servicename, instance)
-	def _get_service_having_lowest_instance(self, classfilter=None):
-		services = self._get_connected_service_list(classfilter=classfilter)
-		if len(services) == 0:
-			return None
-
-		# sort the dict by value; returns list of tuples: (value, key)
-		s = sorted((value, key) for (key, value) in services.items())
-		return (s[0][1], s[0][0])
+	def _get_service_having_lowest_instance(self, classfilter):
+		return self._services.lowest_connected(classfilter)
 
 
 class DbusSystemCalc(SystemCalc):
@@ -1331,7 +1631,7 @@ class DbusSystemCalc(SystemCalc):
 
 	def _create_settings(self, *args, **kwargs):
 		bus = dbus.SessionBus(private=True) if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus(private=True)
-		return SettingsDevice(bus, *args, timeout=10, **kwargs)
+		return BulkSettingsDevice(bus, *args, timeout=10, **kwargs)
 
 	def _create_dbus_service(self):
 		venusversion, venusbuildtime = self._get_venus_versioninfo()
@@ -1369,6 +1669,8 @@ if __name__ == "__main__":
 
 	parser.add_argument("-d", "--debug", help="set logging level to debug",
 					action="store_true")
+	parser.add_argument("--record", metavar="FILE",
+					help="record all monitored values to FILE, see tests/replay.py")
 
 	args = parser.parse_args()
 
@@ -1379,6 +1681,8 @@ if __name__ == "__main__":
 	DBusGMainLoop(set_as_default=True)
 
 	systemcalc = DbusSystemCalc()
+	if args.record:
+		systemcalc.record(args.record)
 
 	# Start and run the mainloop
 	logger.info("Starting mainloop, responding only on events")
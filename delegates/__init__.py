@@ -26,6 +26,7 @@ from delegates.genset import GensetStartStop
 from delegates.socsync import SocSync
 from delegates.pvinverter import PvInverters
 from delegates.batteryservice import BatteryService
+from delegates.batterybank import BatteryBank
 from delegates.canbatterysense import CanBatterySense
 from delegates.invertercharger import InverterCharger
 from delegates.dynamicess import DynamicEss
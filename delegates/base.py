@@ -39,6 +39,18 @@ class SystemCalcDelegate(object, metaclass=TrackInstance):
 		"""
 		return []
 
+	def get_triggers(self):
+		"""In derived classes this function can return D-Bus paths, in the same form as get_input, that
+		should be acted on as soon as they change rather than on the next tick. After such a change, once
+		the values derived from it are published, triggered is called.
+		"""
+		return []
+
+	def triggered(self):
+		""" Called after one or more of the paths returned by get_triggers
+		    changed. """
+		pass
+
 	def get_settings(self):
 		"""In derived classes this function should return all settings (from com.victronenergy.settings)
 		that are used in this class. The return value will be used to populate self._settings.
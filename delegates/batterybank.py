@@ -0,0 +1,202 @@
+from collections import namedtuple
+from delegates.base import SystemCalcDelegate
+from scheduler import Scheduler
+from sc_utils import OptionalSum, ExtremeIndex
+
+# Victron packages
+from ve_utils import exit_on_error
+from vedbus import unwrap_dbus_value
+
+PREFIX = '/Dc/Battery/Bank'
+
+# Paths that are summed over all batteries
+SUMMED = ('/Dc/0/Current', '/Dc/0/Power')
+
+# Paths that make up the capacity weighted state of charge
+CAPACITY = ('/Soc', '/InstalledCapacity', '/Capacity')
+
+# Paths of which the lowest or highest value is kept, the name it is
+# published under, its format, whether the highest value is kept, and the
+# path that holds the id of the cell
+EXTREMES = {
+	'/System/MinCellVoltage': ('/MinCellVoltage', '%.3F V', False, '/System/MinVoltageCellId'),
+	'/System/MaxCellVoltage': ('/MaxCellVoltage', '%.3F V', True, '/System/MaxVoltageCellId'),
+	'/System/MinCellTemperature': ('/MinCellTemperature', '%.1F C', False, '/System/MinTemperatureCellId'),
+	'/System/MaxCellTemperature': ('/MaxCellTemperature', '%.1F C', True, '/System/MaxTemperatureCellId'),
+}
+
+# Cell id path -> the path of the value it belongs to
+CELLIDS = {x[3]: path for path, x in EXTREMES.items()}
+
+# How often the sums are recomputed, in milliseconds
+RECOMPUTE_INTERVAL = 60000
+
+PATHS = SUMMED + CAPACITY + tuple(EXTREMES) + tuple(CELLIDS)
+
+Cell = namedtuple('Cell', ('value', 'service', 'id'))
+
+class BatteryBank(SystemCalcDelegate):
+	""" Combines all connected battery services into one bank: the current
+	    and power are summed, the state of charge is weighted by capacity,
+	    and the lowest and highest cell voltages and temperatures are kept,
+	    along with the battery and cell they come from. Everything is
+	    updated from value changes, so that the work per tick does not grow
+	    with the size of the bank. The sums are recomputed once a minute, to
+	    keep rounding errors from adding up. The result is published under
+	    /Dc/Battery/Bank.
+	    If aggregation is enabled, and a battery service is the battery
+	    monitor, it is also used for /Dc/Battery. """
+	def __init__(self):
+		super(BatteryBank, self).__init__()
+		self._batteries = {} # service -> {path: value}, connected batteries only
+		self._sums = {path: OptionalSum() for path in SUMMED}
+		self._capacity = OptionalSum()
+		self._charge = OptionalSum() # Sum of soc * capacity
+		self._charge_capacity = OptionalSum() # Capacity of batteries with a soc
+		self._extremes = {path: ExtremeIndex(highest) \
+			for path, (_, _, highest, _) in EXTREMES.items()}
+
+	def set_sources(self, dbusmonitor, settings, dbusservice):
+		super(BatteryBank, self).set_sources(dbusmonitor, settings, dbusservice)
+		self._timer = Scheduler.instance.add_job('BatteryBank', RECOMPUTE_INTERVAL,
+			exit_on_error, self._recompute)
+
+	def get_input(self):
+		return [('com.victronenergy.battery', ['/Connected'] + list(PATHS))]
+
+	def get_output(self):
+		return [
+			(PREFIX + '/Count', {'gettext': '%d'}),
+			(PREFIX + '/Current', {'gettext': '%.1F A'}),
+			(PREFIX + '/Power', {'gettext': '%.0F W'}),
+			(PREFIX + '/Soc', {'gettext': '%.1F %%'}),
+			(PREFIX + '/Capacity', {'gettext': '%.0F Ah'})] + [
+			x for name, gettext, _, _ in EXTREMES.values() for x in (
+				(PREFIX + name, {'gettext': gettext}),
+				(PREFIX + name + 'Service', {'gettext': '%s'}),
+				(PREFIX + name + 'CellId', {'gettext': '%s'}))]
+
+	def get_settings(self):
+		return [
+			('batterybank', '/Settings/SystemSetup/BatteryBank', 0, 0, 1)
+		]
+
+	@property
+	def enabled(self):
+		return bool(self._settings['batterybank'])
+
+	@property
+	def soc(self):
+		try:
+			return self._charge.value / self._charge_capacity.value
+		except (TypeError, ZeroDivisionError):
+			return None
+
+	def cell(self, path):
+		""" Returns the Cell with the extreme value of path, one of the
+		    keys of EXTREMES, across all batteries. For example,
+		    cell('/System/MaxCellVoltage') is the highest cell in the bank.
+		    Returns None if no battery has a value. """
+		top = self._extremes[path].top()
+		if top is None:
+			return None
+		service, value, cellid = top
+		return Cell(value, service, cellid)
+
+	def get_totals(self):
+		""" The values that replace those of the battery monitor, when
+		    aggregation is enabled. """
+		return {
+			'/Dc/Battery/Current': self._sums['/Dc/0/Current'].value,
+			'/Dc/Battery/Power': self._sums['/Dc/0/Power'].value,
+			'/Dc/Battery/Capacity': self._capacity.value}
+
+	def device_added(self, service, instance, *args):
+		if service.startswith('com.victronenergy.battery.'):
+			for path in ('/Connected', ) + PATHS:
+				self._dbusmonitor.track_value(service, path, self._value_changed, service, path)
+			if self._dbusmonitor.get_value(service, '/Connected') == 1:
+				self._add(service)
+
+	def device_removed(self, service, instance):
+		self._remove(service)
+
+	def _value_changed(self, service, path, changes, *args, **kwargs):
+		# An invalid value arrives as an empty array
+		value = unwrap_dbus_value(changes.get('Value'))
+		if path == '/Connected':
+			if value == 1:
+				self._add(service)
+			else:
+				self._remove(service)
+		elif service in self._batteries:
+			self._set(service, path, value)
+
+	def _add(self, service):
+		if service not in self._batteries:
+			self._batteries[service] = dict.fromkeys(PATHS)
+			for path in PATHS:
+				self._set(service, path, self._dbusmonitor.get_value(service, path))
+
+	def _remove(self, service):
+		if service in self._batteries:
+			for path in PATHS:
+				self._set(service, path, None)
+			del self._batteries[service]
+
+	@staticmethod
+	def _weights(values):
+		""" Returns the capacity of a battery, and its charge and capacity
+		    for the weighted state of charge. """
+		capacity = values['/InstalledCapacity']
+		if capacity is None:
+			capacity = values['/Capacity']
+		soc = values['/Soc']
+		if capacity is None or soc is None:
+			return capacity, None, None
+		return capacity, soc * capacity, capacity
+
+	def _set(self, service, path, value):
+		values = self._batteries[service]
+		old = values[path]
+		if value == old:
+			return
+
+		if path in CAPACITY:
+			before = self._weights(values)
+			values[path] = value
+			after = self._weights(values)
+			for s, b, a in zip((self._capacity, self._charge, self._charge_capacity), before, after):
+				s.replace(b, a)
+		else:
+			values[path] = value
+			if path in self._sums:
+				self._sums[path].replace(old, value)
+			elif path in CELLIDS:
+				path = CELLIDS[path]
+				self._extremes[path].update(service, values[path], value)
+			else:
+				self._extremes[path].update(service, value, values[EXTREMES[path][3]])
+
+	def _recompute(self):
+		""" Sums everything from scratch, dropping the rounding errors that
+		    the running sums pick up. """
+		batteries = list(self._batteries.values())
+		for path, s in self._sums.items():
+			s.reset(values[path] for values in batteries)
+		weights = [self._weights(values) for values in batteries]
+		for i, s in enumerate((self._capacity, self._charge, self._charge_capacity)):
+			s.reset(w[i] for w in weights)
+		return True
+
+	def update_values(self, newvalues):
+		newvalues[PREFIX + '/Count'] = len(self._batteries)
+		newvalues[PREFIX + '/Current'] = self._sums['/Dc/0/Current'].value
+		newvalues[PREFIX + '/Power'] = self._sums['/Dc/0/Power'].value
+		newvalues[PREFIX + '/Soc'] = self.soc
+		newvalues[PREFIX + '/Capacity'] = self._capacity.value
+		for path, (name, _, _, _) in EXTREMES.items():
+			cell = self.cell(path) or Cell(None, None, None)
+			newvalues[PREFIX + name] = cell.value
+			newvalues[PREFIX + name + 'Service'] = cell.service
+			newvalues[PREFIX + name + 'CellId'] = cell.id
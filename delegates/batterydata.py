@@ -1,4 +1,4 @@
-from gi.repository import GLib
+from scheduler import Scheduler
 import json
 from collections import defaultdict
 from itertools import chain
@@ -8,6 +8,7 @@ from delegates.base import SystemCalcDelegate
 
 # Victron packages
 from ve_utils import exit_on_error
+from vedbus import unwrap_dbus_value
 
 class BatteryConfiguration(object):
 	""" Holds custom mapping information about a service that corresponds to a
@@ -40,6 +41,19 @@ class BatteryConfiguration(object):
 		self.parent.changed = True
 
 
+# Keys of the /Batteries entries that are also published on a path of their
+# own, /Batteries/<id>/<name>, if enabled.
+FLAT_PATHS = {
+	'voltage': 'Voltage',
+	'current': 'Current',
+	'power': 'Power',
+	'temperature': 'Temperature',
+	'soc': 'Soc',
+	'timetogo': 'TimeToGo',
+	'state': 'State',
+	'bmsstate': 'BmsState',
+	'name': 'Name'}
+
 class BatteryTracker(object):
 	_paths = (
 		'/Dc/0/Voltage',
@@ -56,6 +70,7 @@ class BatteryTracker(object):
 		self.monitor = monitor
 		self.channel = None
 		self._tracked = { k: None for k in self._paths }
+		self._on_change = None
 
 	@property
 	def valid(self):
@@ -66,6 +81,11 @@ class BatteryTracker(object):
 	def name(self):
 		return self.monitor.get_value(self.service, '/CustomName') or self.monitor.get_value(self.service, '/ProductName')
 
+	@reify
+	def flat_id(self):
+		""" The service_id in a form that can be used in a dbus path. """
+		return self.service_id.replace('.', '_').replace('/', '_')
+
 	@reify
 	def service_type(self):
 		""" Return the third item in the dbus service, eg battery for
@@ -78,6 +98,21 @@ class BatteryTracker(object):
 			of service and the instance. """
 		return "{}/{}".format('.'.join(self.service.split('.')[:3]), self.instance)
 
+	def track(self, on_change):
+		""" Reads the tracked values, and keeps them up to date from then
+		    on. on_change is called with this tracker whenever one of them, or
+		    the name, changes. """
+		self._on_change = on_change
+		for k in chain(self._paths, ('/CustomName', )):
+			self.monitor.track_value(self.service, k, self._value_changed, k)
+		self.update()
+
+	def _value_changed(self, path, changes, *args, **kwargs):
+		if path in self._tracked:
+			# An invalid value arrives as an empty array
+			self._tracked[path] = unwrap_dbus_value(changes.get('Value'))
+		self._on_change(self)
+
 	def update(self):
 		changed = False
 		for k, v in self._tracked.items():
@@ -183,6 +218,11 @@ class MultiTracker(BatteryTracker):
 		return True
 
 class BatteryData(SystemCalcDelegate):
+	""" Publishes the batteries in the system, and the values of each, on
+	    /Batteries. The trackers keep their values up to date from value
+	    changes, and only the entries of trackers that changed are replaced.
+	    The list is rebuilt in full when batteries come or go, or when the
+	    configuration or active battery changes. """
 	def __init__(self):
 		SystemCalcDelegate.__init__(self)
 		self.batteries = defaultdict(list)
@@ -190,6 +230,10 @@ class BatteryData(SystemCalcDelegate):
 		self.deviceschanged = False
 		self.configured_batteries = {}
 		self.active_battery_service = None
+		self._dirty = set()
+		self._entries = [] # As published on /Batteries
+		self._index = {} # tracker -> index into _entries
+		self._flat = {} # flat_id -> paths
 
 	def set_sources(self, dbusmonitor, settings, dbusservice):
 		SystemCalcDelegate.set_sources(self, dbusmonitor, settings, dbusservice)
@@ -197,7 +241,7 @@ class BatteryData(SystemCalcDelegate):
 		# Publish the battery configuration
 		self._dbusservice.add_path('/Batteries', value=None)
 		self._dbusservice.add_path('/AvailableBatteries', value=None)
-		self._timer = GLib.timeout_add_seconds(5, exit_on_error, self._on_timer)
+		self._timer = Scheduler.instance.add_job('BatteryData', 5000, exit_on_error, self._on_timer)
 
 	def get_input(self):
 		return [
@@ -212,6 +256,15 @@ class BatteryData(SystemCalcDelegate):
 				'/ProductName'])
 		]
 
+	def get_settings(self):
+		return [
+			('flatpaths', '/Settings/SystemSetup/Batteries/FlatPaths', 0, 0, 1)
+		]
+
+	def settings_changed(self, setting, oldvalue, newvalue):
+		if setting == 'flatpaths':
+			self.changed = True
+
 	def device_added(self, service, instance, *args, **kwargs):
 		self.deviceschanged = True
 		self.changed = True
@@ -246,13 +299,14 @@ class BatteryData(SystemCalcDelegate):
 
 	def device_removed(self, service, instance):
 		if service in self.batteries:
-			del self.batteries[service]
+			self._dirty.difference_update(self.batteries.pop(service))
 			self.changed = True
 			self.deviceschanged = True
 
 	def add_trackers(self, service, *args):
 		self.batteries[service].extend(args)
 		for t in args:
+			t.track(self._dirty.add)
 			if t.service_id not in self.configured_batteries:
 				# Set dedicated battery monitors visible by default.
 				self.add_configured_battery(t.service_id, type(t) is BatteryTracker)
@@ -267,29 +321,82 @@ class BatteryData(SystemCalcDelegate):
 		except (KeyError, AttributeError):
 			return None
 
-	def update_values(self, newvalues=None):
-		self.changed = any([tracker.update() for tracker in chain.from_iterable(
-			self.batteries.values())]) or self.changed
-
 	def add_configured_battery(self, service, default_visibility):
 		self.configured_batteries[service] = BatteryConfiguration(
 			self, service, default_visibility)
 
+	def _listed(self, tracker, active):
+		return (tracker.valid and self.is_enabled(tracker)) or active == tracker.service_id
+
+	def _entry(self, tracker, active):
+		entry = tracker.data()
+		entry['active_battery_service'] = active == tracker.service_id
+		name = self.config_name(tracker)
+		if name is not None:
+			entry['name'] = name
+		return entry
+
+	def _publish_flat(self, tracker, entry):
+		paths = self._flat.get(tracker.flat_id)
+		if paths is None:
+			paths = self._flat[tracker.flat_id] = {k: '/Batteries/{}/{}'.format(
+				tracker.flat_id, n) for k, n in FLAT_PATHS.items()}
+			for k, path in paths.items():
+				self._dbusservice.add_path(path, value=entry.get(k))
+		else:
+			for k, path in paths.items():
+				self._dbusservice[path] = entry.get(k)
+
+	def _remove_flat(self, keep=()):
+		for flat_id in [f for f in self._flat if f not in keep]:
+			for path in self._flat.pop(flat_id).values():
+				del self._dbusservice[path]
+
+	def _rebuild(self, active):
+		trackers = [t for t in chain.from_iterable(self.batteries.values()) \
+			if self._listed(t, active)]
+		self._entries = [self._entry(t, active) for t in trackers]
+		self._index = {t: i for i, t in enumerate(trackers)}
+		self._dbusservice['/Batteries'] = self._entries
+
+		if self._settings['flatpaths']:
+			for t, i in self._index.items():
+				self._publish_flat(t, self._entries[i])
+		self._remove_flat(keep=set(t.flat_id for t in trackers) \
+			if self._settings['flatpaths'] else ())
+
+	def _patch(self, active):
+		""" Replaces the entries of the trackers that changed. Returns False
+		    if a tracker has to be added to or removed from the list, then
+		    the list has to be rebuilt. """
+		changed = []
+		for t in self._dirty:
+			i = self._index.get(t)
+			if (i is not None) != self._listed(t, active):
+				return False
+			if i is not None:
+				changed.append((t, i))
+
+		if changed:
+			self._entries = list(self._entries)
+			for t, i in changed:
+				self._entries[i] = self._entry(t, active)
+				if self._settings['flatpaths']:
+					self._publish_flat(t, self._entries[i])
+			self._dbusservice['/Batteries'] = self._entries
+		return True
+
 	def _on_timer(self):
 		active = self._dbusservice['/ActiveBatteryService']
-		if self.changed or self.active_battery_service != active:
-			# Update the summary
-			is_active = lambda x: active == x.service_id
-			kwargs = lambda x: {k: v for k, v in (('active_battery_service', is_active(x)),
-				('name', self.config_name(x))) if v is not None}
-
-			self._dbusservice['/Batteries'] = [
-				dict(tracked.data(), **kwargs(tracked)) \
-					for tracked in chain.from_iterable(self.batteries.values()) \
-					if (tracked.valid and self.is_enabled(tracked)) or is_active(tracked)
-			]
-
-		if self.deviceschanged or self.active_battery_service != active:
+		if self.active_battery_service != active:
+			self.changed = self.deviceschanged = True
+
+		if self.changed or (self._dirty and not self._patch(active)):
+			self._rebuild(active)
+		self._dirty.clear()
+		self.changed = False
+
+		if self.deviceschanged:
 			# This is returned as JSON, because QML won't let us pass
 			# lists of objects.
 			self._dbusservice['/AvailableBatteries'] = json.dumps({
@@ -300,7 +407,5 @@ class BatteryData(SystemCalcDelegate):
 				} for b in chain.from_iterable(self.batteries.values()) if b.valid })
 			self.deviceschanged = False
 
-			self.changed = False
-
 		self.active_battery_service = active
 		return True
@@ -1,5 +1,5 @@
 import logging
-from gi.repository import GLib
+from scheduler import Scheduler
 from datetime import datetime, timedelta
 
 # Victron packages
@@ -67,7 +67,7 @@ class BatteryLife(SystemCalcDelegate):
 		super(BatteryLife, self).set_sources(dbusmonitor, settings, dbusservice)
 		self._dbusservice.add_path('/Control/ActiveSocLimit', value=None)
 		self._dbusservice.add_path('/Control/EssState', value=None)
-		self._timer = GLib.timeout_add_seconds(900, exit_on_error, self._on_timer)
+		self._timer = Scheduler.instance.add_job('BatteryLife', 900000, exit_on_error, self._on_timer)
 
 	def get_input(self):
 		# We need to check the assistantid to know if we should even be active.
@@ -1,6 +1,8 @@
 from collections import namedtuple
 from itertools import chain
 from gi.repository import GLib
+from scheduler import Scheduler
+from writequeue import WriteQueue
 from delegates.base import SystemCalcDelegate
 from delegates.dvcc import Dvcc
 
@@ -10,6 +12,17 @@ from ve_utils import exit_on_error
 # Write temperature this often (in 3-second units)
 TEMPERATURE_INTERVAL = 3
 
+# Sense values are only written again once they move by this much, or when
+# they need to be refreshed for the external control timeouts on the
+# chargers. See writequeue.REFRESH.
+DEADBANDS = {
+	'/Link/VoltageSense': 0.01,
+	'/BatterySense/Voltage': 0.01,
+	'/Link/BatteryCurrent': 0.1,
+	'/Link/TemperatureSense': 0.5,
+	'/BatterySense/Temperature': 0.5,
+}
+
 def safe_float(v):
 	""" Return a floating point value for v, unless it is None/invalid. """
 	try:
@@ -111,7 +124,9 @@ class BatterySense(SystemCalcDelegate):
 		self._dbusservice.add_path('/Dc/Battery/TemperatureService', value=None)
 		self._dbusservice.add_path('/Dc/Battery/Temperature', value=None, gettextcallback=lambda p, v: '{:.1F} C'.format(v))
 		self._dbusservice.add_path('/Debug/DisableBatterySense', value=0, writeable=True)
-		self._timer = GLib.timeout_add_seconds(3, exit_on_error, self._on_timer)
+		self._dbusservice.add_path('/Debug/BatterySense/Sent', value=0)
+		self._dbusservice.add_path('/Debug/BatterySense/Suppressed', value=0)
+		self._timer = Scheduler.instance.add_job('BatterySense', 3000, exit_on_error, self._on_timer)
 
 	@property
 	def temperature_service(self):
@@ -253,8 +268,15 @@ class BatterySense(SystemCalcDelegate):
 				int(self.has_tsense and Dvcc.instance.has_dvcc) and \
 				self._distribute_sense_temperature()
 		self.tick = (self.tick - 1) % TEMPERATURE_INTERVAL
+
+		self._dbusservice['/Debug/BatterySense/Sent'], \
+		self._dbusservice['/Debug/BatterySense/Suppressed'] = \
+			WriteQueue.instance.counts(DEADBANDS)
 		return True
 
+	def _write(self, service, path, value):
+		WriteQueue.instance.write(service, path, value, DEADBANDS[path])
+
 	def _service_is_battery(self, service):
 		return service.split('.')[2] == 'battery'
 
@@ -275,7 +297,7 @@ class BatterySense(SystemCalcDelegate):
 		if has_vsense and vebus_path is not None and \
 			vebus_path != sense_voltage_service and \
 			self._dbusmonitor.get_value(vebus_path, '/FirmwareFeatures/BolUBatAndTBatSense') == 1:
-			self._dbusmonitor.set_value_async(vebus_path, '/BatterySense/Voltage',
+			self._write(vebus_path, '/BatterySense/Voltage',
 				sense_voltage)
 			multi_written = self.VSENSE_ON
 
@@ -298,7 +320,7 @@ class BatterySense(SystemCalcDelegate):
 				continue
 			if not self._dbusmonitor.seen(service, '/Link/VoltageSense'):
 				continue
-			self._dbusmonitor.set_value_async(service, '/Link/VoltageSense', sense_voltage)
+			self._write(service, '/Link/VoltageSense', sense_voltage)
 			charger_written = self.VSENSE_ON
 
 		# Only forward to the VE.Can if the voltage is not coming from it, or
@@ -306,7 +328,7 @@ class BatterySense(SystemCalcDelegate):
 		vecan = self._dbusmonitor.get_service_list('com.victronenergy.vecan')
 		if len(vecan) and (self._service_is_battery(sense_voltage_service) or not self._service_on_vecan(sense_voltage_service)):
 			for _ in vecan.keys():
-				self._dbusmonitor.set_value_async(_, '/Link/VoltageSense', sense_voltage)
+				self._write(_, '/Link/VoltageSense', sense_voltage)
 			charger_written = self.VSENSE_ON
 
 		return multi_written, charger_written
@@ -338,7 +360,7 @@ class BatterySense(SystemCalcDelegate):
 			# Skip for old firmware versions to save some dbus traffic
 			if not self._dbusmonitor.seen(service, '/Link/BatteryCurrent'):
 				continue # No such feature on this charger
-			self._dbusmonitor.set_value_async(service, '/Link/BatteryCurrent', battery_current)
+			self._write(service, '/Link/BatteryCurrent', battery_current)
 			sent = BatterySense.ISENSE_ENABLED
 
 		# Forward isense to VE.Can only if it doesn't come from there
@@ -346,7 +368,7 @@ class BatterySense(SystemCalcDelegate):
 		if vecan:
 			if not self._service_on_vecan(sense_voltage_service):
 				for service in vecan.keys():
-					self._dbusmonitor.set_value_async(service, '/Link/BatteryCurrent', battery_current)
+					self._write(service, '/Link/BatteryCurrent', battery_current)
 					sent = BatterySense.ISENSE_ENABLED
 
 		return sent
@@ -372,7 +394,7 @@ class BatterySense(SystemCalcDelegate):
 
 			# VE.Can chargers don't have this path, so only set it when it has been seen
 			if self._dbusmonitor.seen(charger, '/Link/TemperatureSense'):
-				self._dbusmonitor.set_value_async(charger, '/Link/TemperatureSense', sense_temp)
+				self._write(charger, '/Link/TemperatureSense', sense_temp)
 			written = 1
 
 		# Write to supporting inverters
@@ -385,13 +407,13 @@ class BatterySense(SystemCalcDelegate):
 				continue
 
 			if self._dbusmonitor.seen(charger, '/Link/TemperatureSense'):
-				self._dbusmonitor.set_value_async(charger, '/Link/TemperatureSense', sense_temp)
+				self._write(charger, '/Link/TemperatureSense', sense_temp)
 			written = 1
 
 		# Also update the multi
 		vebus = self._dbusservice['/VebusService']
 		if vebus is not None and vebus != sense_temp_service and self._dbusmonitor.seen(vebus, '/BatterySense/Temperature'):
-			self._dbusmonitor.set_value_async(vebus, '/BatterySense/Temperature',
+			self._write(vebus, '/BatterySense/Temperature',
 				sense_temp)
 			written = 1
 
@@ -399,7 +421,7 @@ class BatterySense(SystemCalcDelegate):
 		vecan = self._dbusmonitor.get_service_list('com.victronenergy.vecan')
 		if len(vecan) and (self._service_is_battery(sense_temp_service) or not self._service_on_vecan(sense_temp_service)):
 			for _ in vecan.keys():
-				self._dbusmonitor.set_value_async(_, '/Link/TemperatureSense', sense_temp)
+				self._write(_, '/Link/TemperatureSense', sense_temp)
 			written = 1
 
 		return written
@@ -98,6 +98,7 @@ class BatteryService(SystemCalcDelegate):
 		self.bms = None
 		self._bms_changed_callbacks = []
 		self._voltage_changed_callbacks = []
+		self._limits_changed_callbacks = []
 
 	def set_sources(self, dbusmonitor, settings, dbusservice):
 		super(BatteryService, self).set_sources(dbusmonitor, settings, dbusservice)
@@ -135,6 +136,8 @@ class BatteryService(SystemCalcDelegate):
 		if service.startswith('com.victronenergy.battery.'):
 			self._batteries[instance] = Battery(self._dbusmonitor, service, instance)
 			self._dbusmonitor.track_value(service, "/Info/MaxChargeVoltage", partial(self._charge_voltage_changed, service))
+			self._dbusmonitor.track_value(service, "/Info/MaxChargeCurrent", partial(self._limits_changed, service))
+			self._dbusmonitor.track_value(service, "/Info/MaxDischargeCurrent", partial(self._limits_changed, service))
 			self._dbusmonitor.track_value(service, "/CustomName", self._set_bms)
 			# If you call _set_bms directly now, changes to MaxChargeVoltage
 			# that is still in the pipeline will not reflect yet. Instead
@@ -179,6 +182,11 @@ class BatteryService(SystemCalcDelegate):
 	def add_voltage_changed_callback(self, cb):
 		self._voltage_changed_callbacks.append(cb)
 
+	def add_limits_changed_callback(self, cb):
+		""" cb is called whenever the charge voltage, charge current or
+		    discharge current limit of the active BMS changes. """
+		self._limits_changed_callbacks.append(cb)
+
 	def __set_bms(self, service, instance):
 		self._dbusservice['/ActiveBmsService'] = service
 		self._dbusservice['/ActiveBmsInstance'] = instance
@@ -247,5 +255,12 @@ class BatteryService(SystemCalcDelegate):
 				for cb in self._voltage_changed_callbacks:
 					cb(v)
 
+		self._limits_changed(service, changes)
+
 		# (Re)set BMS if it has changed.
 		self._set_bms()
+
+	def _limits_changed(self, service, changes, *args, **kwargs):
+		if self.bms is not None and service == self.bms.service:
+			for cb in self._limits_changed_callbacks:
+				cb()
@@ -1,4 +1,5 @@
 from delegates.base import SystemCalcDelegate
+from delegates.batterybank import BatteryBank
 
 class BatterySoc(SystemCalcDelegate):
 	def __init__(self, sc):
@@ -11,6 +12,9 @@ class BatterySoc(SystemCalcDelegate):
 	@property
 	def soc(self):
 		if self.systemcalc.batteryservice is not None:
+			if BatteryBank.instance.enabled and \
+					self.systemcalc.batteryservice.startswith('com.victronenergy.battery.'):
+				return BatteryBank.instance.soc
 			return self._dbusmonitor.get_value(self.systemcalc.batteryservice, '/Soc')
 		return None
 
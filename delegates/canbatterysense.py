@@ -1,5 +1,6 @@
 from delegates.base import SystemCalcDelegate
 from delegates.batteryservice import BatteryService
+from writequeue import WriteQueue
 
 class CanBatterySense(SystemCalcDelegate):
 	def get_input(self):
@@ -28,8 +29,8 @@ class CanBatterySense(SystemCalcDelegate):
 				bms.service != batteryservice.service and \
 				batteryservice.soc is not None:
 			# Copy sense data across
-			self._dbusmonitor.set_value_async(bms.service, '/Sense/Voltage', batteryservice.voltage)
-			self._dbusmonitor.set_value_async(bms.service, '/Sense/Current', batteryservice.current)
+			WriteQueue.instance.write(bms.service, '/Sense/Voltage', batteryservice.voltage)
+			WriteQueue.instance.write(bms.service, '/Sense/Current', batteryservice.current)
 			if batteryservice.temperature is not None:
-				self._dbusmonitor.set_value_async(bms.service, '/Sense/Temperature', batteryservice.temperature)
-			self._dbusmonitor.set_value_async(bms.service, '/Sense/Soc', batteryservice.soc)
+				WriteQueue.instance.write(bms.service, '/Sense/Temperature', batteryservice.temperature)
+			WriteQueue.instance.write(bms.service, '/Sense/Soc', batteryservice.soc)
@@ -1,13 +1,16 @@
 import dbus
+import time
 from dbus.exceptions import DBusException
 from gi.repository import GLib
+from scheduler import Scheduler
+from writequeue import WriteQueue
 from math import pi, ceil
 from itertools import count, chain
 from functools import partial
 
 # Victron packages
 from vedbus import VeDbusItemExport
-from sc_utils import safeadd, copy_dbus_value, ExpiringValue, reify
+from sc_utils import safeadd, ExpiringValue, reify
 from ve_utils import exit_on_error
 
 from delegates.base import SystemCalcDelegate
@@ -22,10 +25,23 @@ from delegates.multi import Multi as MultiService
 # above.
 ADJUST = 3
 
+# In fast control mode, a change in the limits of the BMS is passed on
+# immediately, but not more often than this (in seconds).
+FAST_INTERVAL = 0.25
+
 VEBUS_FIRMWARE_REQUIRED = 0x422
 VEDIRECT_FIRMWARE_REQUIRED = 0x129
 VECAN_FIRMWARE_REQUIRED = 0x10200 # 1.02, 24-bit version
 
+# When distributing charge current, a charger making clearly less than its
+# limit is held back by something else, such as shade. It is given what it
+# makes plus this fraction of its size, at least half an amp, so that it can
+# ramp up, and the rest goes to the other chargers.
+HEADROOM = 0.02
+
+# Charge current limits are only changed by at least this many amps
+CURRENT_DEADBAND = 0.25
+
 # This is a place to account for some BMS quirks where we may have to ignore
 # the BMS value and substitute our own.
 class BatteryBehaviour(object):
@@ -216,7 +232,7 @@ class BaseCharger(object):
 
 	def _set_path(self, path, v):
 		if self.monitor.seen(self.service, path):
-			self.monitor.set_value_async(self.service, path, v)
+			WriteQueue.instance.write(self.service, path, v)
 
 	@property
 	def firmwareversion(self):
@@ -287,11 +303,10 @@ class BaseCharger(object):
 	def maximize_charge_current(self):
 		""" Max out the charge current of this solar charger by setting
 		    ChargeCurrent to the configured limit in settings. """
-		if self.monitor.seen(self.service, '/Link/ChargeCurrent'):
-			copy_dbus_value(self.monitor,
-				self.service, '/Settings/ChargeCurrentLimit',
-				self.service, '/Link/ChargeCurrent')
-		return self.currentlimit
+		limit = self.currentlimit
+		if limit is not None:
+			self._set_path('/Link/ChargeCurrent', limit)
+		return limit
 
 	@property
 	def smoothed_current(self):
@@ -390,7 +405,7 @@ class InverterCharger(SolarCharger):
 
 	@maxdischargecurrent.setter
 	def maxdischargecurrent(self, limit):
-		self.monitor.set_value_async(self.service, '/Link/DischargeCurrent', limit)
+		WriteQueue.instance.write(self.service, '/Link/DischargeCurrent', limit)
 
 	def set_maxdischargecurrent(self, limit):
 		""" Write the maximum discharge limit across. The firmware
@@ -718,44 +733,68 @@ class ChargerSubsystem(object):
 			return self._distribute_current(chargers, max_charge_current)
 
 	@staticmethod
-	def _distribute_current(chargers, max_charge_current):
-		# For all chargers, the (a)ctual vs (l)imit vs (c)apacity
-		# is such that a <= l <= c. This is also true for the total
-		# actual current, vs limit, vs capacity. To make all the
-		# chargers the same, first calculate what the ratio of the
-		# requested limit max_charge_current is to the overal actual
-		# current and capacity, and then set all chargers to have
-		# the same ratio, which should result in a fair spread.
-		# The individual limits should then also add up to the total
-		# because of the distributive law.
-		#
-		# The ratio P = (l-a)/(c-a), with c < a. The function is
-		# not defined when c=a, but that will only happen if the chargers
-		# are running flat out, and can be handled separately.
-
-		capacity = sum(c.currentlimit for c in chargers)
-		limit = sum(c.maxchargecurrent for c in chargers)
-		actual = min(sum(c.smoothed_current for c in chargers), limit)
+	def _waterfill(weights, caps, budget):
+		""" Splits budget over a number of consumers in proportion to
+		    weights, without giving any more than its cap. What cannot be
+		    placed with one is spread over the rest. Returns the allocations,
+		    which add up to budget unless all caps are reached. """
+		alloc = [0.0] * len(weights)
+		total = sum(weights)
+
+		# In order of the level at which they saturate, so that once a
+		# consumer is below its cap, all remaining ones are too.
+		for i in sorted(range(len(weights)),
+				key=lambda i: caps[i] / weights[i] if weights[i] > 0 else 0):
+			share = budget * weights[i] / total if total > 0 else 0.0
+			alloc[i] = x = max(0.0, min(caps[i], share))
+			budget -= x
+			total -= weights[i]
+		return alloc
 
-		try:
-			P = (max_charge_current - actual) / max(capacity - actual, 0.0)
-		except ZeroDivisionError:
-			# Already at capacity, leave it alone for now
-			return min(max_charge_current, capacity)
-		else:
-			assigned = 0.0
-			spillover = 0.0
-			for charger in chargers:
-				l = max((a := charger.smoothed_current) + P * (
-					charger.currentlimit - a) + spillover, 0.0)
-
-				# The vreg is only capable of the nearest 100mA, so round
-				# it, and keep the remainder for the next iteration,
-				# so the max error is 100mA at the last charger.
-				spillover = l - (r := round(l, 1))
-				charger.maxchargecurrent = r
-				assigned += r
-			return min(max_charge_current, assigned)
+	@staticmethod
+	def _distribute_current(chargers, max_charge_current):
+		# Water-filling: max_charge_current is shared out in proportion to
+		# the size of the chargers, but a charger making clearly less than
+		# its limit is held back by something else, usually shade, and
+		# cannot use its share. It gets what it makes plus some headroom,
+		# and what it leaves goes to the chargers that can use it. What
+		# remains when all chargers have what they can use is spread over
+		# the spare capacity, first in proportion to what the chargers
+		# make, as those doing most are most likely to make more.
+		capacity = [c.currentlimit for c in chargers]
+		limits = [c.maxchargecurrent for c in chargers]
+		actual = [min(c.smoothed_current, cap) for c, cap in zip(chargers, capacity)]
+		demand = []
+		for cap, l, a in zip(capacity, limits, actual):
+			# Chargers lag behind a new limit, so one that uses more than
+			# a quarter of its headroom is ramping up rather than held
+			# back.
+			h = max(0.5, cap * HEADROOM)
+			demand.append(min(cap, a + h) if a + h * 0.75 < l else cap)
+
+		alloc = ChargerSubsystem._waterfill(capacity, demand, max_charge_current)
+		for weights in (actual, capacity):
+			rest = max_charge_current - sum(alloc)
+			if rest <= 0:
+				break
+			alloc = [x + y for x, y in zip(alloc, ChargerSubsystem._waterfill(
+				weights, [cap - x for cap, x in zip(capacity, alloc)], rest))]
+
+		assigned = 0.0
+		spillover = 0.0
+		for charger, l, x in zip(chargers, limits, alloc):
+			# The vreg is only capable of the nearest 100mA, so round
+			# it, and keep the remainder for the next charger, so the
+			# max error is 100mA at the last charger. Small changes
+			# are carried over in the same way, and the old limit is
+			# written again, which the write queue suppresses.
+			r = round(x + spillover, 1)
+			if abs(r - l) < CURRENT_DEADBAND:
+				r = l
+			charger.maxchargecurrent = r
+			spillover += x - r
+			assigned += r
+		return min(max_charge_current, assigned)
 
 	def update_values(self):
 		# This is called periodically from a timer to update contained
@@ -780,7 +819,7 @@ class BatteryOperationalLimits(object):
 		# None of these values can be negative
 		if v is not None:
 			v = max(0, v)
-		self._multi.monitor.set_value_async(self._multi.service, path, v)
+		WriteQueue.instance.write(self._multi.service, path, v)
 
 	chargevoltage = property(
 		partial(_property, '/BatteryOperationalLimits/MaxChargeVoltage'),
@@ -915,11 +954,13 @@ class AcSystem(object):
 
 	@discharge_setpoint.setter
 	def discharge_setpoint(self, v):
-		self.monitor.set_value_async(self.service,
+		WriteQueue.instance.write(self.service,
 			'/Ess/BatteryDischargeSetpoint', v)
 
 class Dvcc(SystemCalcDelegate):
 	""" This is the main DVCC delegate object. """
+	_get_time = lambda s: time.monotonic()
+
 	def __init__(self, sc):
 		super(Dvcc, self).__init__()
 		self.systemcalc = sc
@@ -929,6 +970,9 @@ class Dvcc(SystemCalcDelegate):
 		self._tickcount = ADJUST
 		self._dcsyscurrent = LowPassFilter((2 * pi)/20, 0.0)
 		self._internal_mcp = ExpiringValue(3, None) # Max charging power
+		self._fast_timer = None
+		self._last_fast = None
+		self._limits_changed_at = None
 
 	def get_input(self):
 		return [
@@ -1026,7 +1070,8 @@ class Dvcc(SystemCalcDelegate):
 			('maxchargecurrent', '/Settings/SystemSetup/MaxChargeCurrent', -1, -1, 10000),
 			('maxchargevoltage', '/Settings/SystemSetup/MaxChargeVoltage', 0.0, 0.0, 80.0),
 			('bol', '/Settings/Services/Bol', 0, 0, 7),
-			('bolsecondary', '/Settings/SystemSetup/DvccControlAllMultis', 0, 0, 1)
+			('bolsecondary', '/Settings/SystemSetup/DvccControlAllMultis', 0, 0, 1),
+			('fastcontrol', '/Settings/SystemSetup/DvccFastControl', 0, 0, 1)
 		]
 
 	def set_sources(self, dbusmonitor, settings, dbusservice):
@@ -1047,11 +1092,18 @@ class Dvcc(SystemCalcDelegate):
 		self._dbusservice.add_path('/Debug/BatteryOperationalLimits/CurrentOffset', value=0, writeable=True)
 		self._dbusservice.add_path('/Dvcc/Alarms/FirmwareInsufficient', value=0)
 		self._dbusservice.add_path('/Dvcc/Alarms/MultipleBatteries', value=0)
+		self._dbusservice.add_path('/Debug/Dvcc/FastAdjustments', value=0)
+		self._dbusservice.add_path('/Debug/Dvcc/LimitsLatency', value=None)
+		self._dbusservice.add_path('/Debug/Dvcc/MaxLimitsLatency', value=None)
 
 		# If the charge voltage changes, do a quick voltage adjustment
 		# for systems where that is supported.
 		BatteryService.instance.add_voltage_changed_callback(self._quick_adjust)
 
+		# In fast control mode, any change in the BMS limits is passed on
+		# right away.
+		BatteryService.instance.add_limits_changed_callback(self._limits_changed)
+
 	def device_added(self, service, instance, *args, **kwargs):
 		service_type = service.split('.')[2]
 		if service_type == 'solarcharger':
@@ -1077,7 +1129,7 @@ class Dvcc(SystemCalcDelegate):
 			return
 
 		if self._timer is None:
-			self._timer = GLib.timeout_add(1000, exit_on_error, self._on_timer)
+			self._timer = Scheduler.instance.add_job('Dvcc', 1000, exit_on_error, self._on_timer)
 
 	def device_removed(self, service, instance):
 		if service in self._chargesystem:
@@ -1093,7 +1145,7 @@ class Dvcc(SystemCalcDelegate):
 			pass
 		if len(self._chargesystem) == 0 and len(self._vecan_services) == 0 and \
 			len(BatteryService.instance.batteries) == 0 and self._timer is not None:
-			GLib.source_remove(self._timer)
+			Scheduler.instance.remove_job(self._timer)
 			self._timer = None
 
 	def _property(path, self):
@@ -1115,6 +1167,11 @@ class Dvcc(SystemCalcDelegate):
 	def internal_maxchargepower(self, v):
 		self._internal_mcp.set(v)
 
+	def peek_internal_maxchargepower(self):
+		""" Returns the internal max charge power without using up one of
+		    the reads it is valid for. """
+		return self._internal_mcp.peek()
+
 	@property
 	def dcsyscurrent(self):
 		""" Return non-zero DC system current, if it is based on
@@ -1161,19 +1218,64 @@ class Dvcc(SystemCalcDelegate):
 				bms_charge_voltage, effective_charge_voltage, vecan_voltage)
 			self._update_multi_chargevoltage(bms_charge_voltage)
 
-	def _on_timer(self):
-		def update_solarcharger_control_flags(voltage_written, current_written, chargevoltage):
-			self._dbusservice['/Control/SolarChargeVoltage'] = voltage_written
-			self._dbusservice['/Control/SolarChargeCurrent'] = current_written
-			self._dbusservice['/Control/EffectiveChargeVoltage'] = chargevoltage
+	def _limits_changed(self):
+		if not self.has_dvcc:
+			return
+
+		if self._limits_changed_at is None:
+			self._limits_changed_at = self._get_time()
+
+		if not self._settings['fastcontrol'] or self._fast_timer is not None:
+			return
+
+		wait = 0 if self._last_fast is None else \
+			self._last_fast + FAST_INTERVAL - self._get_time()
+		if wait > 0:
+			self._fast_timer = GLib.timeout_add(ceil(wait * 1000), exit_on_error, self._on_fast_timer)
+		else:
+			self._fast_adjust()
 
+	def _on_fast_timer(self):
+		self._fast_timer = None
+		self._fast_adjust()
+		return False
+
+	def _fast_adjust(self):
+		""" Recalculates and writes the limits outside of the regular
+		    ADJUST cycle. The filtered charger currents are not updated here,
+		    the last values from the timer are used. Values that expire
+		    after a number of reads are only peeked at, as those numbers
+		    assume one read per ADJUST cycle. """
+		self._last_fast = self._get_time()
+		self._adjust(consume=False)
+		WriteQueue.instance.flush()
+		self._dbusservice['/Debug/Dvcc/FastAdjustments'] += 1
+		self._record_latency()
+
+	def _record_latency(self):
+		""" Publishes the time in milliseconds from a change in the BMS
+		    limits to the writes that followed it. """
+		if self._limits_changed_at is None:
+			return
+		latency = round((self._get_time() - self._limits_changed_at) * 1000)
+		self._limits_changed_at = None
+		self._dbusservice['/Debug/Dvcc/LimitsLatency'] = latency
+		self._dbusservice['/Debug/Dvcc/MaxLimitsLatency'] = max(latency,
+			self._dbusservice['/Debug/Dvcc/MaxLimitsLatency'] or 0)
+
+	def _update_solarcharger_control_flags(self, voltage_written, current_written, chargevoltage):
+		self._dbusservice['/Control/SolarChargeVoltage'] = voltage_written
+		self._dbusservice['/Control/SolarChargeCurrent'] = current_written
+		self._dbusservice['/Control/EffectiveChargeVoltage'] = chargevoltage
+
+	def _on_timer(self):
 		self._tickcount -= 1; self._tickcount %= ADJUST
 
 		if not self.has_dvcc:
 			if self._tickcount > 0: return True
 
 			voltage_written, current_written = self._legacy_update_solarchargers()
-			update_solarcharger_control_flags(voltage_written, current_written, None) # Not tracking for non-DVCC case
+			self._update_solarcharger_control_flags(voltage_written, current_written, None) # Not tracking for non-DVCC case
 			self._dbusservice['/Control/BmsParameters'] = 0
 			self._dbusservice['/Control/MaxChargeCurrent'] = 0
 			self._dbusservice['/Control/Dvcc'] = 0
@@ -1191,6 +1293,11 @@ class Dvcc(SystemCalcDelegate):
 		# Below are things we only do every ADJUST seconds
 		if self._tickcount > 0: return True
 
+		self._adjust()
+		self._record_latency()
+		return True
+
+	def _adjust(self, consume=True):
 		# Alarms
 		self._dbusservice['/Dvcc/Alarms/FirmwareInsufficient'] = int(
 			not self._chargesystem.has_externalcontrol_support or (
@@ -1207,9 +1314,9 @@ class Dvcc(SystemCalcDelegate):
 		bms_service = self.bms
 		if self.bms_seen and bms_service is None and not self._multi.has_vebus_bmsv2:
 			# BMS is lost
-			update_solarcharger_control_flags(0, 0, None)
+			self._update_solarcharger_control_flags(0, 0, None)
 			self._dbusservice['/Dc/Battery/ChargeVoltage'] = None
-			return True
+			return
 
 		# If there is a BMS, get the charge voltage and current from it
 		max_charge_current = None
@@ -1285,7 +1392,8 @@ class Dvcc(SystemCalcDelegate):
 				bms_charge_voltage, effective_charge_voltage, vecan_voltage)
 
 			# check if pv is disabled.
-			pv_disabled = PvStartStopControl.instance.pv_disabled
+			pv_disabled = PvStartStopControl.instance.pv_disabled if consume \
+				else PvStartStopControl.instance.peek_pv_disabled()
 			_max_charge_current = 0 if pv_disabled else _max_charge_current
 
 			# Set current limits
@@ -1293,7 +1401,7 @@ class Dvcc(SystemCalcDelegate):
 			self._chargesystem.set_maxchargecurrent(_max_charge_current, self.feedback_allowed, stop_on_mcc0, pv_disabled)
 			current_written = int(network_mode_written and _max_charge_current is not None)
 
-		update_solarcharger_control_flags(voltage_written, current_written, effective_charge_voltage)
+		self._update_solarcharger_control_flags(voltage_written, current_written, effective_charge_voltage)
 
 		# The Multi gets the remainder after subtracting what the solar
 		# chargers made. If there is a maximum charge power from another
@@ -1302,7 +1410,9 @@ class Dvcc(SystemCalcDelegate):
 			max_charge_current = max(0.0, round(max_charge_current - self._chargesystem.smoothed_current))
 
 		try:
-			internal_mcc = self.internal_maxchargepower / self._dbusservice['/Dc/Battery/Voltage']
+			internal_mcp = self.internal_maxchargepower if consume \
+				else self.peek_internal_maxchargepower()
+			internal_mcc = internal_mcp / self._dbusservice['/Dc/Battery/Voltage']
 		except (TypeError, ZeroDivisionError, ValueError):
 			pass
 		else:
@@ -1337,8 +1447,6 @@ class Dvcc(SystemCalcDelegate):
 			bms_parameters_written |= self._update_multi_currentlimits(bms_service, max_charge_current)
 		self._dbusservice['/Control/BmsParameters'] = int(bms_parameters_written or (bms_service is not None and voltage_written))
 
-		return True
-
 	@staticmethod
 	def _battery_behaviour(bms_service):
 		return BEHAVIOURS.get(bms_service.product_id, DEFAULT_BEHAVIOUR)
@@ -1407,12 +1515,12 @@ class Dvcc(SystemCalcDelegate):
 		if self._settings['bolsecondary']:
 			if mcc is not None:
 				for m in MultiService.instance.othermultis:
-					self._dbusmonitor.set_value_async(m.service,
+					WriteQueue.instance.write(m.service,
 						'/BatteryOperationalLimits/MaxChargeCurrent', mcc)
 
 			if bms_service.maxdischargecurrent is not None:
 				for m in MultiService.instance.othermultis:
-					self._dbusmonitor.set_value_async(m.service,
+					WriteQueue.instance.write(m.service,
 						'/BatteryOperationalLimits/MaxDischargeCurrent',
 						bms_service.maxdischargecurrent)
 
@@ -1520,17 +1628,11 @@ class Dvcc(SystemCalcDelegate):
 		# us their Charge Voltage.
 		if vecan_voltage is None:
 			for service in self._vecan_services:
-				try:
-					self._dbusmonitor.set_value_async(service, '/Link/NetworkMode',
-						1 | (0 if not has_max_charge_current else 4))
-				except DBusException:
-					pass
+				WriteQueue.instance.write(service, '/Link/NetworkMode',
+					1 | (0 if not has_max_charge_current else 4))
 		else:
 			for service in self._vecan_services:
-				try:
-					self._dbusmonitor.set_value_async(service, '/Link/NetworkMode', network_mode)
-				except DBusException:
-					pass
+				WriteQueue.instance.write(service, '/Link/NetworkMode', network_mode)
 
 		return network_mode_written
 
@@ -1542,11 +1644,8 @@ class Dvcc(SystemCalcDelegate):
 		# Write the voltage to VE.Can.
 		if vecan_voltage is not None:
 			for service in self._vecan_services:
-				try:
-					self._dbusmonitor.set_value_async(service, '/Link/ChargeVoltage', vecan_voltage)
-					voltage_written = 1
-				except DBusException:
-					pass
+				WriteQueue.instance.write(service, '/Link/ChargeVoltage', vecan_voltage)
+				voltage_written = 1
 
 		return voltage_written
 
@@ -1609,15 +1708,11 @@ class Dvcc(SystemCalcDelegate):
 			# the com.victronenergy.vecan.* service instead.
 			# Writing charge current to CAN-bus solar charger is not supported yet.
 			for service in self._vecan_services:
-				try:
-					# Note: we don't check the value of charge_voltage_item because it may be invalid,
-					# for example if the D-Bus path has not been written for more than 60 (?) seconds.
-					# In case there is no path at all, the set_value below will raise an DBusException
-					# which we will ignore cheerfully.
-					self._dbusmonitor.set_value_async(service, '/Link/ChargeVoltage', charge_voltage)
-					voltage_written = 1
-				except DBusException:
-					pass
+				# Note: we don't check the value of charge_voltage_item because it may be invalid,
+				# for example if the D-Bus path has not been written for more than 60 (?) seconds.
+				# In case there is no path at all, the write queue logs the failure and carries on.
+				WriteQueue.instance.write(service, '/Link/ChargeVoltage', charge_voltage)
+				voltage_written = 1
 
 		return (voltage_written, current_written)
 
@@ -1661,10 +1756,10 @@ class PvStartStopControl(SystemCalcDelegate):
 		# property. dbus-shelly can provide shelly based inverters it can turn
 		# off.
 		self.pv_disabled = disabled
-		self._dbusmonitor.set_value_async("com.victronenergy.hub4", "/Pv/Disable", int(disabled))
-		self._dbusmonitor.set_value_async("com.victronenergy.shelly", "/Pv/Disable", int(disabled))
+		WriteQueue.instance.write("com.victronenergy.hub4", "/Pv/Disable", int(disabled))
+		WriteQueue.instance.write("com.victronenergy.shelly", "/Pv/Disable", int(disabled))
 		if self._acsystem0:
-			self._dbusmonitor.set_value_async(self._acsystem0, "/Pv/Disable", int(disabled))
+			WriteQueue.instance.write(self._acsystem0, "/Pv/Disable", int(disabled))
 
 		return True
 
@@ -1681,6 +1776,10 @@ class PvStartStopControl(SystemCalcDelegate):
 	def pv_disabled(self, v:bool):
 		self._pv_disabled.set(bool(v))
 
+	def peek_pv_disabled(self) -> bool:
+		""" Like pv_disabled, without using up one of the reads. """
+		return self._pv_disabled.peek() or False
+
 	def device_added(self, service, instance, *args, **kwargs):
 		service_type = service.split('.')[2]
 		if service_type == 'acsystem' and self._dbusmonitor.get_value(service,
@@ -1694,8 +1793,8 @@ class PvStartStopControl(SystemCalcDelegate):
 	def update_values(self, newvalues):
 		if self._dbusservice["/Pv/Disable"] == 1 and self._pv_disabled.expired:
 			# Also restore operation for hub4 and multi rs
-			self._dbusmonitor.set_value_async("com.victronenergy.hub4", "/Pv/Disable", 0)
-			self._dbusmonitor.set_value_async("com.victronenergy.shelly", "/Pv/Disable", 0)
+			WriteQueue.instance.write("com.victronenergy.hub4", "/Pv/Disable", 0)
+			WriteQueue.instance.write("com.victronenergy.shelly", "/Pv/Disable", 0)
 			if self._acsystem0 is not None:
-				self._dbusmonitor.set_value_async(self._acsystem0, "/Pv/Disable", 0)
+				WriteQueue.instance.write(self._acsystem0, "/Pv/Disable", 0)
 			self._dbusservice["/Pv/Disable"] = 0
@@ -1,5 +1,8 @@
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
 from gi.repository import GLib # type: ignore
+from scheduler import Scheduler
+from writequeue import WriteQueue
 from delegates.base import SystemCalcDelegate
 from delegates.batterysoc import BatterySoc
 from delegates.schedule import ScheduledWindow
@@ -7,9 +10,12 @@ from delegates.dvcc import Dvcc, PvStartStopControl
 from delegates.batterylife import BatteryLife
 from delegates.batterylife import State as BatteryLifeState
 from delegates.chargecontrol import ChargeControl
+from sc_utils import Trace
 from enum import Enum, IntFlag
-from time import time
+from time import time, monotonic
 import math
+import os
+import re
 import logging
 logger = logging.getLogger(__name__)
 
@@ -19,6 +25,28 @@ HUB4_SERVICE = 'com.victronenergy.hub4'
 ERROR_TIMEOUT = 60
 MAX_FEEDIN_VALUE = 96000
 TRANSITION_STATE_THRESHOLD = 90.0
+TRACE_SIZE = 24 * 3600 // INTERVAL # A day of iterations
+TRACE_NAME = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9_.-]*$')
+REACT_INTERVAL = 1 # Seconds between reactions to changed inputs, at least
+REACT_DEADBAND = 50 # Watts a power has to move before it is reacted to
+
+# What is kept of every iteration of the control loop, see
+# /Debug/DynamicEss/DumpTrace
+TRACE_FIELDS = (
+	('time', 'd'),
+	('errorcode', 'b'),
+	('soc', 'f'),
+	('targetsoc', 'f'),
+	('slot', 'h'),
+	('nextslot', 'h'),
+	('restrictions', 'b'),
+	('flags', 'b'),
+	('chargerate', 'f'),
+	('setpoint', 'f'),
+	('maxdischargepower', 'f'),
+	('maxchargepower', 'f'),
+	('forcecharge', 'b'),
+	('strategy', 'b'))
 
 MODES = {
        0: 'Off',
@@ -268,6 +296,12 @@ class EssDevice(object):
 	def deactivate(self):
 		raise NotImplementedError("deactivate")
 
+	@property
+	def setpoints(self):
+		""" The grid setpoint, discharge and charge power limits and force
+		    charge as last written to the device, for the trace. """
+		return None, None, None, None
+
 	@property
 	def acpv(self):
 		return (self.delegate._dbusservice['/Ac/PvOnGrid/L1/Power'] or 0) + \
@@ -334,7 +368,7 @@ class VebusDevice(EssDevice):
 			True = allow
 			False = restrict """
 
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/FeedInExcess', 0 if allow_feedin is None else 2 if allow_feedin else 1)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/FeedInExcess', 0 if allow_feedin is None else 2 if allow_feedin else 1)
 
 	def _set_charge_power(self, v):
 		Dvcc.instance.internal_maxchargepower = None if v is None else max(v, 50)
@@ -370,9 +404,9 @@ class VebusDevice(EssDevice):
 			self.discharge(flags, restrictions, rate * -1, allow_feedin)
 			return rate
 
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/Setpoint', None)
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/ForceCharge', 1)
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/MaxDischargePower', -1.0)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/Setpoint', None)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/ForceCharge', 1)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/MaxDischargePower', -1.0)
 
 		# Fast charge, or controlled charge?
 		fast_charge_clearance = True #Defaults to true, if we have no limit or can't determine technical limits, we just go for it (legacy behaviour).
@@ -405,51 +439,51 @@ class VebusDevice(EssDevice):
 
 		self._set_feedin(allow_feedin)
 		self._set_charge_power(None)
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/ForceCharge', 0)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/ForceCharge', 0)
 
 		if allow_feedin:
 			# Calculate how fast to sell. If exporting the battery to the grid
 			# is allowed, then export rate plus whatever DC-coupled PV is
 			# making. If exporting the battery is not allowed, then limit that
 			# to DC-coupled PV plus local consumption.
-			self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/Setpoint', self.maxfeedinpower)
+			WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/Setpoint', self.maxfeedinpower)
 
 			if Flags.FASTCHARGE in flags:
-				self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/MaxDischargePower', -1)
+				WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/MaxDischargePower', -1)
 				return None
 			else:
 				srate = max(1.0, (rate or 0) + self.pvpower) # 1.0 to allow selling overvoltage
 
 				if (batteryexport):
 					#discharging the battery by rate requires to discharge all available dcpv as well.
-					self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/MaxDischargePower', srate)
+					WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/MaxDischargePower', srate)
 				else:
 					# this may lead to feedin anyway, but it then is "feedin of solar", while battery is only backing loads.
-					self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/MaxDischargePower',
+					WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/MaxDischargePower',
 						(min (srate, self.pvpower + self.consumption + 1.0))) # +1.0 to allow selling overvoltage
 
 				return rate
 
 		else:
 			# this should never be reached, as discharge won't be entered with restrictions - leaving it here for double safety.
-			self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/Setpoint', None) # Normal ESS, no feedin
-			self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/MaxDischargePower', -1)
+			WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/Setpoint', None) # Normal ESS, no feedin
+			WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/MaxDischargePower', -1)
 			return rate
 
 	def idle(self, allow_feedin):
 		self._set_feedin(allow_feedin)
 		self._set_charge_power(None)
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/ForceCharge', 0)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/ForceCharge', 0)
 
 		if allow_feedin:
 			# This keeps battery idle by not allowing more power to be taken
 			# from the DC bus than what DC-coupled PV provides.
 			mdp = max(1.0, self.pvpower) # 1.0 to allow selling overvoltage
-			self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/MaxDischargePower', mdp)
-			self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/Setpoint', self.maxfeedinpower)
+			WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/MaxDischargePower', mdp)
+			WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/Setpoint', self.maxfeedinpower)
 		else:
-			self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/Setpoint', 0) # Normal ESS
-			self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/MaxDischargePower', max(1.0, self.pvpower))
+			WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/Setpoint', 0) # Normal ESS
+			WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/MaxDischargePower', max(1.0, self.pvpower))
 
 		return None
 
@@ -458,8 +492,8 @@ class VebusDevice(EssDevice):
 
 		self._set_feedin(allow_feedin)
 
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/Setpoint', None) # Normal ESS
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/ForceCharge', 0)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/Setpoint', None) # Normal ESS
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/ForceCharge', 0)
 
 		# If importing into battery is allowed, then no restriction, let the
 		# setpoint determine that. If disallowed, then only AC-coupled PV may
@@ -468,15 +502,22 @@ class VebusDevice(EssDevice):
 
 		# Don't limit the MaxDischargePower. If a User opts to select a negative setpoint
 		# Same behaviour as regular ESS should apply, despite a bat2grid limitation. (possible)
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/MaxDischargePower', -1.0)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/MaxDischargePower', -1.0)
 
 	def deactivate(self):
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/Setpoint', None)
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/ForceCharge', 0)
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/MaxDischargePower', -1.0)
-		self.monitor.set_value_async(HUB4_SERVICE, '/Overrides/FeedInExcess', 0)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/Setpoint', None)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/ForceCharge', 0)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/MaxDischargePower', -1.0)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/FeedInExcess', 0)
 		self._set_charge_power(None)
 
+	@property
+	def setpoints(self):
+		return (WriteQueue.instance.get_value(HUB4_SERVICE, '/Overrides/Setpoint'),
+			WriteQueue.instance.get_value(HUB4_SERVICE, '/Overrides/MaxDischargePower'),
+			Dvcc.instance.peek_internal_maxchargepower(),
+			WriteQueue.instance.get_value(HUB4_SERVICE, '/Overrides/ForceCharge'))
+
 class MultiRsDevice(EssDevice):
 	@property
 	def available(self):
@@ -500,9 +541,9 @@ class MultiRsDevice(EssDevice):
 		return 0
 
 	def charge(self, flags, restrictions:Restrictions, rate, allow_feedin):
-		self.monitor.set_value_async(self.service, '/Ess/DisableFeedIn', int(not allow_feedin) if allow_feedin is not None else 0)
-		self.monitor.set_value_async(self.service, '/Ess/DisableDischarge', 0)
-		self.monitor.set_value_async(self.service, '/Ess/DisableCharge', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableFeedIn', int(not allow_feedin) if allow_feedin is not None else 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableDischarge', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableCharge', 0)
 
 		#if the desired rate is lower than dcpv, this would come down to NOT charging from AC,
 		#but 100% of dcpv. To really achieve an overall charge-rate of what's requested, we need
@@ -513,7 +554,7 @@ class MultiRsDevice(EssDevice):
 		fast_charge_requested = Flags.FASTCHARGE in flags
 		batteryimport = Restrictions.GRID2BAT not in restrictions
 
-		self.monitor.set_value_async(self.service, '/Ess/UseInverterPowerSetpoint', 0)
+		WriteQueue.instance.write(self.service, '/Ess/UseInverterPowerSetpoint', 0)
 
 		# if fastcharge is requested, use the maximum power allowed as per user definition.
 		if fast_charge_requested:
@@ -544,17 +585,17 @@ class MultiRsDevice(EssDevice):
 			setpoint = min(setpoint, self.delegate.grid_import_limit * 1000.0)
 
 		#done, request the desired setpoint.
-		self.monitor.set_value_async(self.service, '/Ess/AcPowerSetpoint', setpoint)
+		WriteQueue.instance.write(self.service, '/Ess/AcPowerSetpoint', setpoint)
 		return rate
 
 	def discharge(self, flags, restrictions:Restrictions, rate, allow_feedin):
 		rate = rate * -1 #commes in positive
 		batteryexport = not Restrictions.BAT2GRID in restrictions
 
-		self.monitor.set_value_async(self.service, '/Ess/DisableFeedIn', int(not allow_feedin) if allow_feedin is not None else 0)
-		self.monitor.set_value_async(self.service, '/Ess/UseInverterPowerSetpoint', 0)
-		self.monitor.set_value_async(self.service, '/Ess/DisableDischarge', 0)
-		self.monitor.set_value_async(self.service, '/Ess/DisableCharge', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableFeedIn', int(not allow_feedin) if allow_feedin is not None else 0)
+		WriteQueue.instance.write(self.service, '/Ess/UseInverterPowerSetpoint', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableDischarge', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableCharge', 0)
 
 		#If we have a bat2grid restriction, the maximum amount we can send to grid is solar.
 		#In that case, we need to limit the fraction of battery discharge to consumption/0.95.
@@ -579,12 +620,12 @@ class MultiRsDevice(EssDevice):
 			setpoint = min(setpoint, self.delegate.grid_import_limit * 1000.0)
 
 		#done, request the desired setpoint.
-		self.monitor.set_value_async(self.service, '/Ess/AcPowerSetpoint', setpoint)
+		WriteQueue.instance.write(self.service, '/Ess/AcPowerSetpoint', setpoint)
 		return rate
 
 	def idle(self, allow_feedin):
-		self.monitor.set_value_async(self.service, '/Ess/DisableFeedIn', int(not allow_feedin) if allow_feedin is not None else 0)
-		self.monitor.set_value_async(self.service, '/Ess/UseInverterPowerSetpoint', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableFeedIn', int(not allow_feedin) if allow_feedin is not None else 0)
+		WriteQueue.instance.write(self.service, '/Ess/UseInverterPowerSetpoint', 0)
 
 		#idling means: Grid needs to deliver consumption - ACPV - DCPV * 0.95.
 		#if there is more solar than consumption, we don't have to mind, the feedin-setting will either allow for it or not.
@@ -596,30 +637,38 @@ class MultiRsDevice(EssDevice):
 		elif acps > 0:
 			acps = min(acps, self.delegate.grid_import_limit * 1000.0)
 
-		self.monitor.set_value_async(self.service, '/Ess/AcPowerSetpoint', acps)
+		WriteQueue.instance.write(self.service, '/Ess/AcPowerSetpoint', acps)
 
 		#when idling during 0 external mppt power, we can additionally disable discharge to improve setpoint stability.
 		if (math.ceil(self.external_pvpower or 0)) == 0:
-			self.monitor.set_value_async(self.service, '/Ess/DisableDischarge', 1)
-			self.monitor.set_value_async(self.service, '/Ess/DisableCharge', 1)
+			WriteQueue.instance.write(self.service, '/Ess/DisableDischarge', 1)
+			WriteQueue.instance.write(self.service, '/Ess/DisableCharge', 1)
 		else:
-			self.monitor.set_value_async(self.service, '/Ess/DisableDischarge', 0)
-			self.monitor.set_value_async(self.service, '/Ess/DisableCharge', 0)
+			WriteQueue.instance.write(self.service, '/Ess/DisableDischarge', 0)
+			WriteQueue.instance.write(self.service, '/Ess/DisableCharge', 0)
 
 	def self_consume(self, restrictions:Restrictions, allow_feedin):
-		self.monitor.set_value_async(self.service, '/Ess/DisableFeedIn', int(not allow_feedin) if allow_feedin is not None else 0)
-		self.monitor.set_value_async(self.service, '/Ess/AcPowerSetpoint', 0)
-		self.monitor.set_value_async(self.service, '/Ess/UseInverterPowerSetpoint', 0)
-		self.monitor.set_value_async(self.service, '/Ess/DisableDischarge', 0)
-		self.monitor.set_value_async(self.service, '/Ess/DisableCharge', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableFeedIn', int(not allow_feedin) if allow_feedin is not None else 0)
+		WriteQueue.instance.write(self.service, '/Ess/AcPowerSetpoint', 0)
+		WriteQueue.instance.write(self.service, '/Ess/UseInverterPowerSetpoint', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableDischarge', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableCharge', 0)
 
 	def deactivate(self):
-		self.monitor.set_value_async(self.service, '/Ess/DisableFeedIn', 0)
-		self.monitor.set_value_async(self.service, '/Ess/AcPowerSetpoint', 0)
-		self.monitor.set_value_async(self.service, '/Ess/UseInverterPowerSetpoint', 0)
-		self.monitor.set_value_async(self.service, '/Ess/InverterPowerSetpoint', 0)
-		self.monitor.set_value_async(self.service, '/Ess/DisableDischarge', 0)
-		self.monitor.set_value_async(self.service, '/Ess/DisableCharge', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableFeedIn', 0)
+		WriteQueue.instance.write(self.service, '/Ess/AcPowerSetpoint', 0)
+		WriteQueue.instance.write(self.service, '/Ess/UseInverterPowerSetpoint', 0)
+		WriteQueue.instance.write(self.service, '/Ess/InverterPowerSetpoint', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableDischarge', 0)
+		WriteQueue.instance.write(self.service, '/Ess/DisableCharge', 0)
+
+	@property
+	def setpoints(self):
+		# Disabled charge or discharge is traced as a limit of 0
+		return (WriteQueue.instance.get_value(self.service, '/Ess/AcPowerSetpoint'),
+			0 if WriteQueue.instance.get_value(self.service, '/Ess/DisableDischarge') else None,
+			0 if WriteQueue.instance.get_value(self.service, '/Ess/DisableCharge') else None,
+			None)
 
 class DynamicEssWindow(ScheduledWindow):
 	def __init__(self, start, duration, soc, targetsoc, allow_feedin, restrictions, strategy, flags, slot):
@@ -652,9 +701,46 @@ class DynamicEssWindow(ScheduledWindow):
 		return "Start: {}, Stop: {}, Soc: {}".format(
 			self.start, self.stop, self.soc)
 
+class DynamicEssSchedule(object):
+	""" The DynamicEss windows, sorted by start time, so that the current
+	    and next window can be found by bisection. Windows should not
+	    overlap, but if they do, the lowest slot wins, as it always did. """
+	def __init__(self, windows):
+		self._windows = sorted(windows, key=lambda w: (w.start, w.slot))
+		self._starts = [w.start for w in self._windows]
+		self._overlapping = any(a.stop > b.start
+			for a, b in zip(self._windows, self._windows[1:]))
+
+		# The window that starts last, the lowest slot if more do.
+		self.last = None
+		if self._windows:
+			self.last = self._windows[bisect_left(self._starts, self._starts[-1])]
+
+	def __len__(self):
+		return len(self._windows)
+
+	def __iter__(self):
+		return iter(self._windows)
+
+	def current(self, now):
+		""" Returns the window containing now, or None. """
+		if self._overlapping:
+			return min((w for w in self._windows if now in w),
+				key=lambda w: w.slot, default=None)
+		i = bisect_right(self._starts, now)
+		if i > 0 and now in self._windows[i - 1]:
+			return self._windows[i - 1]
+		return None
+
+	def next(self, window):
+		""" Returns the window following window, or None. """
+		return self.current(window.stop + timedelta(seconds=1))
+
 class DynamicEss(SystemCalcDelegate, ChargeControl):
 	control_priority = 0
 	_get_time = datetime.now
+	_get_monotonic = lambda s: monotonic()
+	_trace_dir = '/data/log/dynamicess' # Where traces are dumped
 
 	def __init__(self):
 		super(DynamicEss, self).__init__()
@@ -666,11 +752,18 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 		self._devices = {}
 		self._device = None
 		self._errorcode = 0
-		self._errortimer = ERROR_TIMEOUT
+		self._errorsince = None # When the error code became non-zero
 		self.iteration_change_tracker = IterationChangeTracker(self)
 		self._is_idle = False #Flag indicating if we are currently idling, resulting in a quick-update of the idle-setpoint upon value change.
 		self._idle_feedin = None #Cache the feedin-allowance of the window during idle, to quickly update the idle setpoint upon value changes.
 		self._is_pv_disabled = False #Flag indicating if PV is currently disabled.
+		self._schedule = None # Built from the settings when needed, see schedule.
+		self._schedule_tz = None
+		self.trace = Trace(TRACE_FIELDS, TRACE_SIZE)
+		self._action = None # Last action applied to the device, with its arguments
+		self._reacted = None # When changed inputs were last reacted to
+		self._reaction_inputs = None # and what they were
+		self._event_iteration = None # When the loop last ran for a changed soc
 
 		#define the four kind of deterministic states we have.
 		#SCHEDULED_SELFCONSUME is left out, it isn't part of the overall deterministic strategy tree, but a quick escape before entering.
@@ -716,10 +809,12 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 		self._dbusservice.add_path('/DynamicEss/AvailableOverhead', value=None, gettextcallback=lambda p, v: '{}W'.format(v))
 		self._dbusservice.add_path('/DynamicEss/ChargeHysteresis', value=0, gettextcallback=lambda p, v: '{}%'.format(v))
 		self._dbusservice.add_path('/DynamicEss/DischargeHysteresis', value=0, gettextcallback=lambda p, v: '{}%'.format(v))
+		self._dbusservice.add_path('/Debug/DynamicEss/DumpTrace', value=None, writeable=True,
+			onchangecallback=self._dump_trace)
 
 		if self.mode > 0:
 			self._dbusservice.add_path('/DynamicEss/ReactiveStrategy', value=None, gettextcallback=lambda p, v: ReactiveStrategy(v))
-			self._timer = GLib.timeout_add_seconds(INTERVAL, self._on_timer)
+			self._timer = Scheduler.instance.add_job('DynamicEss', INTERVAL * 1000, self._on_timer)
 		else:
 			self._dbusservice.add_path('/DynamicEss/ReactiveStrategy', value = ReactiveStrategy.DESS_DISABLED.value, gettextcallback=lambda p, v: ReactiveStrategy(v))
 
@@ -786,6 +881,13 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 				'/Yield/Power'])
 		]
 
+	def get_triggers(self):
+		return [
+			('com.victronenergy.grid', ['/Ac/Power', '/Ac/L1/Power', '/Ac/L2/Power', '/Ac/L3/Power']),
+			('com.victronenergy.battery', ['/Soc', '/Dc/0/Power']),
+			('com.victronenergy.vebus', ['/Soc'])
+		]
+
 	def get_output(self):
 		return [('/DynamicEss/Available', {'gettext': '%s'})]
 
@@ -851,9 +953,11 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 	def settings_changed(self, setting, oldvalue, newvalue):
 		if setting == 'dess_mode':
 			if oldvalue == 0 and newvalue > 0:
-				self._timer = GLib.timeout_add_seconds(INTERVAL, self._on_timer)
+				self._timer = Scheduler.instance.add_job('DynamicEss', INTERVAL * 1000, self._on_timer)
 			if newvalue == 0:
 				self._dbusservice['/DynamicEss/ReactiveStrategy'] = ReactiveStrategy.DESS_DISABLED.value
+		elif setting.startswith('dess_'):
+			self._schedule = None
 
 	def windows(self):
 		starttimes = (self._settings['dess_start_{}'.format(i)] for i in range(NUM_SCHEDULES))
@@ -870,6 +974,16 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 				yield DynamicEssWindow(
 					datetime.fromtimestamp(start), duration, soc, targetsoc, discharge, restrict, strategy, flags, slot)
 
+	@property
+	def schedule(self):
+		""" The windows, rebuilt only when a dess setting or the timezone
+		    changed since the last time. """
+		tz = os.environ.get('TZ')
+		if self._schedule is None or tz != self._schedule_tz:
+			self._schedule = DynamicEssSchedule(self.windows())
+			self._schedule_tz = tz
+		return self._schedule
+
 	@property
 	def mode(self):
 		return self._settings['dess_mode']
@@ -928,14 +1042,16 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 		if v == 0:
 			# Errors clear immediately
 			self._dbusservice['/DynamicEss/ErrorCode'] = 0
-			self._errortimer = ERROR_TIMEOUT
-		elif self._errortimer == 0:
-			# Set the error after it has been non-zero for more than
-			# ERROR_TIMEOUT
+			self._errorsince = None
+			return
+
+		# Set the error after it has been non-zero for more than
+		# ERROR_TIMEOUT seconds, however often the loop ran meanwhile
+		now = self._get_monotonic()
+		if self._errorsince is None:
+			self._errorsince = now
+		elif now - self._errorsince >= ERROR_TIMEOUT:
 			self._dbusservice['/DynamicEss/ErrorCode'] = v
-		else:
-			# Count down
-			self._errortimer = max(self._errortimer - INTERVAL, 0)
 
 	@property
 	def targetsoc(self):
@@ -1020,6 +1136,53 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 			self.chargerate = abs(self.chargerate) * -1
 
 	def _on_timer(self):
+		# The loop also runs when the soc changes, see triggered. The timer
+		# is the watchdog that makes sure it runs when the soc does not.
+		if self._event_iteration is not None and \
+				(self._get_time() - self._event_iteration).total_seconds() < INTERVAL:
+			return True
+		return self._iterate()
+
+	def triggered(self):
+		""" Grid or battery power, or the soc changed. The setpoint on the
+		    device is not a trigger, as it mostly changes because it was
+		    written here. If the soc changed, the strategy may have to change
+		    and the whole loop runs. Otherwise the last action is applied
+		    again, so that the setpoints follow the new measurements. At
+		    most once every REACT_INTERVAL, and only for power changes
+		    beyond REACT_DEADBAND. """
+		if not self.active or self._device is None:
+			return
+
+		now = self._get_time()
+		if self._reacted is not None and (now - self._reacted).total_seconds() < REACT_INTERVAL:
+			return
+
+		soc = self.soc
+		powers = (sum(self._dbusservice['/Ac/Grid/{}/Power'.format(l)] or 0 for l in ('L1', 'L2', 'L3')),
+			self._dbusservice['/Dc/Battery/Power'] or 0)
+		previous = self._reaction_inputs
+		if previous is not None and soc == previous[0] and \
+				all(abs(a - b) < REACT_DEADBAND for a, b in zip(powers, previous[1])):
+			return
+
+		self._reacted = now
+		self._reaction_inputs = (soc, powers)
+		if previous is not None and soc != previous[0]:
+			self._event_iteration = now
+			self._iterate()
+		elif self._is_idle:
+			self._device.idle(self._idle_feedin)
+		elif self._action is not None:
+			action, args = self._action
+			getattr(self._device, action)(*args)
+
+	def _act(self, action, *args):
+		""" Applies action to the device, and remembers it for triggered. """
+		self._action = (action, args)
+		getattr(self._device, action)(*args)
+
+	def _iterate(self):
 		# If DESS was disabled, deactivate and kill timer.
 		if self.mode in (0, 2, 3): # Old buy/sell states now also means off
 			self.deactivate(0) # No error
@@ -1032,6 +1195,7 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 			self.errorcode = code
 			self.targetsoc = None
 			self._dbusservice['/DynamicEss/MinimumSoc'] = None
+			self._trace_iteration()
 
 		if self.capacity == 0.0:
 			bail(5) # Capacity not set
@@ -1053,57 +1217,46 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 		now = self._get_time()
 		start = None
 		stop = None
+		current_window = None
+		next_window = None
 		self._is_idle = False
 		self._idle_feedin = None
+		self._action = None
 
-		#TODO: this always builds all 48 Windows.
-		#      can be optimized, we MOSTLY need 0 - 5
-		#      and #47 to determine maximal available schedule.
-		windows = list(self.windows())
+		schedule = self.schedule
 
 		#Whenever an error occurs that is totally unexpected, the delegate
 		#should enter self consume and not die.(try/catch around the control loop logic)
 		try:
-			for w in windows:
-				# Keep track of maximum available schedule
-				if start is None or w.start > start:
-					start = w.start
-					stop = w.stop
+			# Keep track of maximum available schedule
+			if schedule.last is not None:
+				start = schedule.last.start
+				stop = schedule.last.stop
 
 			self._dbusservice['/DynamicEss/LastScheduledStart'] = None if start is None else int(datetime.timestamp(start))
 			self._dbusservice['/DynamicEss/LastScheduledEnd'] = None if stop is None else int(datetime.timestamp(stop))
 
 			final_strategy = ReactiveStrategy.NO_WINDOW
-			current_window = None
-			next_window = None
 
 			# This is the ESS minsoc of the selected device
 			self._dbusservice['/DynamicEss/MinimumSoc'] = None if self._device is None else self._device.minsoc
 
-			#iterate through windows, find the current one. Usually it should be first,
-			#but in case of update issues may not. Also grab the next window, to perform
+			#find the current window. Also grab the next window, to perform
 			#some "look aheads" for optimizations.
-			for w in windows:
-				if self.acquire_control() and now in w:
-					self.active = 1 # Auto
-					self.errorcode = 0 # No error
+			if schedule and self.acquire_control():
+				current_window = schedule.current(now)
 
-					current_window = w
+			if current_window is not None:
+				self.active = 1 # Auto
+				self.errorcode = 0 # No error
 
-					self._dbusservice['/DynamicEss/Strategy'] = w.strategy
-					self._dbusservice['/DynamicEss/Restrictions'] = w.restrictions
-					self._dbusservice['/DynamicEss/AllowGridFeedIn'] = int(w.allow_feedin)
-					break # out of for loop
+				self._dbusservice['/DynamicEss/Strategy'] = current_window.strategy
+				self._dbusservice['/DynamicEss/Restrictions'] = current_window.restrictions
+				self._dbusservice['/DynamicEss/AllowGridFeedIn'] = int(current_window.allow_feedin)
 
-			if current_window is not None:
-				#found current window, now we need nextWindow to do some look aheads as well.
 				#next window is the one containing current.start + current.duration + 1.
 				#finding next window is not required to enter the control loop, can be None.
-				next_window_save_start = current_window.stop + timedelta(seconds = 1)
-				for w in windows:
-					if (next_window_save_start in w):
-						next_window = w
-						break # out of for loop
+				next_window = schedule.next(current_window)
 
 				# validate solar-system state
 				self._disable_pv(Flags.DISABLEPV in current_window.flags)
@@ -1138,8 +1291,49 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 			self.chargerate = None #self consume has no chargerate.
 			self.charge_hysteresis = self.discharge_hysteresis = 0
 			self._dbusservice['/DynamicEss/ChargeRate'] = 0
-			self._device.self_consume(Restrictions.NONE, None) #no schedule, no restrictions.
+			self._act('self_consume', Restrictions.NONE, None) #no schedule, no restrictions.
 
+		self._trace_iteration(now, current_window, next_window, final_strategy)
+		return True
+
+	def _trace_iteration(self, now=None, window=None, next_window=None, strategy=None):
+		setpoints = self._device.setpoints if self._device is not None else (None,) * 4
+		self.trace.append(
+			datetime.timestamp(now or self._get_time()),
+			self.errorcode,
+			self.soc,
+			self.targetsoc,
+			None if window is None else window.slot,
+			None if next_window is None else next_window.slot,
+			None if window is None else window.restrictions,
+			None if window is None else window.flags,
+			self.chargerate,
+			*setpoints,
+			None if strategy is None else strategy.value)
+
+	def _dump_trace(self, path, value):
+		""" Writing a file name to /Debug/DynamicEss/DumpTrace writes the
+		    trace to a file of that name in _trace_dir, as CSV if the name
+		    ends in .csv, else in the binary format of Trace.dump. Only the
+		    last part of a path is used, and names with anything but
+		    letters, digits, dots, dashes and underscores are refused. """
+		if not isinstance(value, str):
+			return False
+		name = os.path.basename(value)
+		if TRACE_NAME.match(name) is None:
+			logger.error("Refusing to write DynamicEss trace to %r", value)
+			return False
+		filename = os.path.join(self._trace_dir, name)
+		try:
+			os.makedirs(self._trace_dir, exist_ok=True)
+			if name.endswith('.csv'):
+				self.trace.dump_csv(filename)
+			else:
+				self.trace.dump(filename)
+		except OSError as e:
+			logger.error("Could not write DynamicEss trace to %s: %s", filename, e)
+			return False
+		logger.info("Wrote %d DynamicEss iterations to %s", len(self.trace), filename)
 		return True
 
 	@property
@@ -1202,7 +1396,7 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 			self.targetsoc = None
 			self.charge_hysteresis = self.hysteresis
 			self.discharge_hysteresis = 0
-			self._device.self_consume(restrictions, w.allow_feedin)
+			self._act('self_consume', restrictions, w.allow_feedin)
 			return ReactiveStrategy.SCHEDULED_SELFCONSUME
 
 		# Below here, strategy is any of the target soc dependent strategies
@@ -1393,13 +1587,13 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 			if reactive_strategy in self.charge_states:
 				self.charge_hysteresis = 0 #allow to reach tsoc spot on
 				self.discharge_hysteresis = self.hysteresis #avoid discharging on overshoot
-				self._device.charge(w.flags, restrictions, abs(final_chargerate), w.allow_feedin)
+				self._act('charge', w.flags, restrictions, abs(final_chargerate), w.allow_feedin)
 
 			elif reactive_strategy in self.selfconsume_states:
 				self.charge_hysteresis = self.hysteresis #avoid charge of minor tsoc raise
 				self.discharge_hysteresis = 0
 				self.chargerate = None #self consume has no chargerate.
-				self._device.self_consume(restrictions, w.allow_feedin)
+				self._act('self_consume', restrictions, w.allow_feedin)
 
 			elif reactive_strategy in self.idle_states:
 				self.charge_hysteresis = self.hysteresis #avoid charge on idle soc drop
@@ -1413,7 +1607,7 @@ class DynamicEss(SystemCalcDelegate, ChargeControl):
 				self.charge_hysteresis = self.hysteresis #avoid charging on undershoot.
 				self.discharge_hysteresis = 0 #allow to reach tsoc spot on
 				#chargerate to be send to discharge method has to be always positive.
-				self._device.discharge(w.flags, restrictions, abs(final_chargerate), w.allow_feedin)
+				self._act('discharge', w.flags, restrictions, abs(final_chargerate), w.allow_feedin)
 
 			elif reactive_strategy in self.error_selfconsume_states:
 				#errorstates are handled outside this method.
@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
-from gi.repository import GLib
+from scheduler import Scheduler
+from writequeue import WriteQueue
 from delegates.base import SystemCalcDelegate
 from delegates.schedule import ScheduledWindow
 from delegates.batterysoc import BatterySoc
@@ -50,11 +51,11 @@ class MultiRs(SwitchableDevice):
 	def connect(self):
 		if self.ac_in_type == 1: # Grid
 			# For now we use /Mode. In future this will hopefully use ignore AC.
-			self.monitor.set_value_async(self.service, '/Mode', 3)
+			WriteQueue.instance.write(self.service, '/Mode', 3)
 
 	def disconnect(self):
 		if self.ac_in_type == 1: # Grid
-			self.monitor.set_value_async(self.service, '/Mode', 2)
+			WriteQueue.instance.write(self.service, '/Mode', 2)
 
 	def prepare(self):
 		# Not supported yet. Could set /Settings/Ess/Mode to 2 (Keep charged)
@@ -86,8 +87,10 @@ class LoadShedding(SystemCalcDelegate, ChargeControl):
 		self._dbusservice.add_path('/LoadShedding/NextDisconnect', value=None,
 			gettextcallback=lambda p, v: datetime.fromtimestamp(v).isoformat())
 
+		# Not spread, the schedule is checked every INTERVAL counted from
+		# when load shedding was enabled.
 		if self.mode > 0:
-			self._timer = GLib.timeout_add_seconds(INTERVAL, self._on_timer)
+			self._timer = Scheduler.instance.add_job('LoadShedding', INTERVAL * 1000, self._on_timer, spread=False)
 
 	def get_settings(self):
 		# Settings for LoadShedding
@@ -138,7 +141,7 @@ class LoadShedding(SystemCalcDelegate, ChargeControl):
 	def settings_changed(self, setting, oldvalue, newvalue):
 		if setting == 'loadshedding_mode':
 			if oldvalue == 0 and newvalue > 0:
-				self._timer = GLib.timeout_add_seconds(INTERVAL, self._on_timer)
+				self._timer = Scheduler.instance.add_job('LoadShedding', INTERVAL * 1000, self._on_timer, spread=False)
 
 	def device_added(self, service, instance, *args):
 		if service.startswith('com.victronenergy.multi.'):
@@ -216,20 +219,20 @@ class LoadShedding(SystemCalcDelegate, ChargeControl):
 
 	@property
 	def forcecharge(self):
-		return self._dbusmonitor.get_value(HUB4_SERVICE, '/Overrides/ForceCharge')
+		return WriteQueue.instance.get_value(HUB4_SERVICE, '/Overrides/ForceCharge')
 
 	@forcecharge.setter
 	def forcecharge(self, v):
-		return self._dbusmonitor.set_value_async(HUB4_SERVICE,
+		WriteQueue.instance.write(HUB4_SERVICE,
 			'/Overrides/ForceCharge', 1 if v else 0)
 
 	@property
 	def maxdischargepower(self):
-		return self._dbusmonitor.get_value(HUB4_SERVICE, '/Overrides/MaxDischargePower')
+		return WriteQueue.instance.get_value(HUB4_SERVICE, '/Overrides/MaxDischargePower')
 
 	@maxdischargepower.setter
 	def maxdischargepower(self, v):
-		return self._dbusmonitor.set_value_async(HUB4_SERVICE, '/Overrides/MaxDischargePower', v)
+		WriteQueue.instance.write(HUB4_SERVICE, '/Overrides/MaxDischargePower', v)
 
 	def ac_available(self):
 		multi = Multi.instance.multi
@@ -1,4 +1,5 @@
 from delegates.base import SystemCalcDelegate
+from sc_utils import ServiceIndex
 
 PREFIX = "/MotorDrive"
 
@@ -50,14 +51,14 @@ class MotorDrive(SystemCalcDelegate):
             self._settings["electricpropulsionenabled"] = 1
 
     def _get_service_for_device_instance(self, instance):
-        services = self._dbusmonitor.get_service_list("com.victronenergy.motordrive")
+        services = ServiceIndex.instance.get("com.victronenergy.motordrive")
         for k, v in services.items():
             if v == instance:
                 return (k, v)
         return None
 
     def _get_service_having_lowest_instance(self):
-        services = self._dbusmonitor.get_service_list("com.victronenergy.motordrive")
+        services = ServiceIndex.instance.get("com.victronenergy.motordrive")
         if len(services) == 0:
             return None
         s = sorted((value, key) for (key, value) in services.items())
@@ -1,6 +1,7 @@
 from gi.repository import GLib
 import dbus
 from ve_utils import get_product_id
+from writequeue import WriteQueue
 from delegates.base import SystemCalcDelegate
 
 notset = object()
@@ -79,7 +80,7 @@ class Service(object):
 
 	@maxchargecurrent.setter
 	def maxchargecurrent(self, v):
-		self.monitor.set_value_async(self.service, '/Dc/0/MaxChargeCurrent', v)
+		WriteQueue.instance.write(self.service, '/Dc/0/MaxChargeCurrent', v)
 
 	@property
 	def maxchargevoltage(self):
@@ -87,12 +88,12 @@ class Service(object):
 
 	@maxchargevoltage.setter
 	def maxchargevoltage(self, v):
-		self.monitor.set_value_async(self.service, '/BatteryOperationalLimits/MaxChargeVoltage', v)
+		WriteQueue.instance.write(self.service, '/BatteryOperationalLimits/MaxChargeVoltage', v)
 
 	def set_ignore_ac(self, inp, ignore):
 		if inp not in (0, 1):
 			raise ValueError(inp)
-		self.monitor.set_value_async(self.service, '/Ac/Control/IgnoreAcIn{}'.format(inp + 1),
+		WriteQueue.instance.write(self.service, '/Ac/Control/IgnoreAcIn{}'.format(inp + 1),
 			dbus.Int32(ignore, variant_level=1))
 
 	def ac_in_available(self, inp):
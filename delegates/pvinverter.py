@@ -1,14 +1,48 @@
 from delegates.base import SystemCalcDelegate
-from sc_utils import safeadd
+from scheduler import Scheduler
+from sc_utils import safeadd, OptionalSum, ExtremeIndex
+
+# Victron packages
+from ve_utils import exit_on_error
+from vedbus import unwrap_dbus_value
+
+POSITIONS = ('/Ac/PvOnGrid', '/Ac/PvOnOutput', '/Ac/PvOnGenset')
+
+# Paths of a PV-inverter that are summed per position
+POWER = ('/Ac/L1/Power', '/Ac/L2/Power', '/Ac/L3/Power')
+CURRENT = ('/Ac/L1/Current', '/Ac/L2/Current', '/Ac/L3/Current')
+SUMMED = POWER + CURRENT
+
+ACINPUTS = ('/Settings/SystemSetup/AcInput1', '/Settings/SystemSetup/AcInput2')
+
+# How often the sums are recomputed, in milliseconds
+RECOMPUTE_INTERVAL = 60000
 
 class PvInverters(SystemCalcDelegate):
+	""" Sums the power and current of the PV-inverters per position and
+	    phase. The sums are kept up to date from value changes, and the
+	    AC-input types the positions map to are cached, so that
+	    get_totals does not grow with the number of PV-inverters. The sums
+	    are recomputed once a minute, to keep rounding errors from adding
+	    up. The number of PV-inverters on each position, and the lowest and
+	    highest power of one of them, are published as well. """
 	def __init__(self):
 		super(PvInverters, self).__init__()
 		self.pvinverters = set()
+		self._values = {} # service -> {path: value}
+		self._positions = {} # service -> position it is counted on
+		self._sums = {position + path[3:]: OptionalSum() \
+			for position in POSITIONS for path in SUMMED}
+		self._counts = dict.fromkeys(POSITIONS, 0)
+		self._lowest = {position: ExtremeIndex() for position in POSITIONS}
+		self._highest = {position: ExtremeIndex(True) for position in POSITIONS}
+		self._acinputs = (None, None)
 
 	def set_sources(self, dbusmonitor, settings, dbusservice):
 		super(PvInverters, self).set_sources(dbusmonitor, settings, dbusservice)
 		dbusservice.add_path('/PvInvertersProductIds', value=[])
+		self._timer = Scheduler.instance.add_job('PvInverters', RECOMPUTE_INTERVAL,
+			exit_on_error, self._recompute)
 
 	def get_input(self):
 		return [('com.victronenergy.pvinverter', [
@@ -22,7 +56,8 @@ class PvInverters(SystemCalcDelegate):
 				'/Ac/L2/Current',
 				'/Ac/L3/Current',
 				'/Position',
-				'/ProductId'])]
+				'/ProductId']),
+			('com.victronenergy.settings', list(ACINPUTS))]
 
 	def get_output(self):
 		return [('/Ac/PvOnOutput/L1/Power', {'gettext': '%.0F W'}),
@@ -45,17 +80,35 @@ class PvInverters(SystemCalcDelegate):
 			('/Ac/PvOnGenset/L1/Current', {'gettext': '%.1F A'}),
 			('/Ac/PvOnGenset/L2/Current', {'gettext': '%.1F A'}),
 			('/Ac/PvOnGenset/L3/Current', {'gettext': '%.1F A'}),
-			('/Ac/PvOnGenset/NumberOfPhases', {'gettext': '%d'})]
+			('/Ac/PvOnGenset/NumberOfPhases', {'gettext': '%d'})] + [
+			x for position in POSITIONS for x in (
+				(position + '/InverterCount', {'gettext': '%d'}),
+				(position + '/MinInverterPower', {'gettext': '%.0F W'}),
+				(position + '/MaxInverterPower', {'gettext': '%.0F W'}))]
 
 	def device_added(self, service, instance, *args):
 		if service.startswith('com.victronenergy.pvinverter.'):
 			self.pvinverters.add(service)
 			self._updatepvinverterspidlist()
+			for path in ('/Position', ) + SUMMED:
+				self._dbusmonitor.track_value(service, path, self._value_changed, service, path)
+			self._values[service] = {path: self._dbusmonitor.get_value(service, path) for path in SUMMED}
+			self._positions[service] = None
+			self._move(service)
+		elif service == 'com.victronenergy.settings':
+			for path in ACINPUTS:
+				self._dbusmonitor.track_value(service, path, self._acinputs_changed)
+			self._acinputs_changed()
 
 	def device_removed(self, service, instance):
 		if service in self.pvinverters:
 			self.pvinverters.discard(service)
 			self._updatepvinverterspidlist()
+			self._count(service, False)
+			del self._values[service]
+			del self._positions[service]
+		elif service == 'com.victronenergy.settings':
+			self._set_acinputs((None, None))
 
 	def _updatepvinverterspidlist(self):
 		# Create list of connected pv inverters id's
@@ -69,32 +122,91 @@ class PvInverters(SystemCalcDelegate):
 		if p == 1:
 			return '/Ac/PvOnOutput'
 		s = {
-			0: self._dbusmonitor.get_value(
-				'com.victronenergy.settings', '/Settings/SystemSetup/AcInput1'),
-			2: self._dbusmonitor.get_value(
-				'com.victronenergy.settings', '/Settings/SystemSetup/AcInput2')
+			0: self._acinputs[0],
+			2: self._acinputs[1]
 			}.get(p)
 		return {
 			1: '/Ac/PvOnGrid',
 			2: '/Ac/PvOnGenset',
 			3: '/Ac/PvOnGrid'}.get(s)
 
+	def _acinputs_changed(self, *args, **kwargs):
+		self._set_acinputs(tuple(self._dbusmonitor.get_value(
+			'com.victronenergy.settings', path) for path in ACINPUTS))
+
+	def _set_acinputs(self, acinputs):
+		if acinputs != self._acinputs:
+			self._acinputs = acinputs
+			for service in self._positions:
+				self._move(service)
+
+	def _value_changed(self, service, path, changes, *args, **kwargs):
+		if service not in self._values:
+			return
+		if path == '/Position':
+			self._move(service)
+			return
+
+		# An invalid value arrives as an empty array
+		values = self._values[service]
+		old, values[path] = values[path], unwrap_dbus_value(changes.get('Value'))
+		position = self._positions[service]
+		if position is not None:
+			self._sums[position + path[3:]].replace(old, values[path])
+			if path in POWER:
+				self._set_power(service, position)
+
+	def _move(self, service):
+		""" Counts the PV-inverter on the position it is on now. """
+		# Position will be None if PV inverter service has just been removed
+		pos = self._dbusmonitor.get_value(service, '/Position')
+		position = None if pos is None else self.map_position(pos)
+		if position != self._positions[service]:
+			self._count(service, False)
+			self._positions[service] = position
+			self._count(service, True)
+
+	def _count(self, service, add):
+		""" Adds the values of a PV-inverter to its position, or takes them
+		    away from it. """
+		position = self._positions[service]
+		if position is None:
+			return
+		for path, value in self._values[service].items():
+			if add:
+				self._sums[position + path[3:]].replace(None, value)
+			else:
+				self._sums[position + path[3:]].replace(value, None)
+		self._counts[position] += 1 if add else -1
+		if add:
+			self._set_power(service, position)
+		else:
+			self._lowest[position].update(service, None)
+			self._highest[position].update(service, None)
+
+	def _set_power(self, service, position):
+		values = self._values[service]
+		power = safeadd(*(values[path] for path in POWER))
+		self._lowest[position].update(service, power)
+		self._highest[position].update(service, power)
+
+	def _recompute(self):
+		""" Sums everything from scratch, dropping the rounding errors that
+		    the running sums pick up. """
+		for position in POSITIONS:
+			values = [self._values[service] for service, p in \
+				self._positions.items() if p == position]
+			for path in SUMMED:
+				self._sums[position + path[3:]].reset(v[path] for v in values)
+		return True
+
 	def get_totals(self):
-		newvalues = {}
-		for pvinverter in self.pvinverters:
-			# Position will be None if PV inverter service has just been removed (after retrieving the
-			# service list).
-			pos = self._dbusmonitor.get_value(pvinverter, '/Position')
-			if pos is not None and (position := self.map_position(pos)) is not None:
-				for phase in range(1, 4):
-					power = self._dbusmonitor.get_value(pvinverter, '/Ac/L%s/Power' % phase)
-					if power is not None:
-						path = '%s/L%s/Power' % (position, phase)
-						newvalues[path] = safeadd(newvalues.get(path), power)
-
-					current = self._dbusmonitor.get_value(pvinverter, '/Ac/L%s/Current' % phase)
-					if current is not None:
-						path = '%s/L%s/Current' % (position, phase)
-						newvalues[path] = safeadd(newvalues.get(path), current)
-
-		return newvalues
+		return {path: s.value for path, s in self._sums.items() if s.count}
+
+	def update_values(self, newvalues):
+		for position in POSITIONS:
+			lowest = self._lowest[position].top()
+			highest = self._highest[position].top()
+			newvalues[position + '/InverterCount'] = self._counts[position]
+			newvalues[position + '/MinInverterPower'] = None if lowest is None else lowest[1]
+			newvalues[position + '/MaxInverterPower'] = None if highest is None else highest[1]
@@ -1,5 +1,6 @@
 from enum import IntEnum
-from gi.repository import GLib
+from scheduler import Scheduler
+from writequeue import WriteQueue
 from datetime import datetime, timedelta, time
 
 # Victron packages
@@ -148,18 +149,18 @@ class VebusDevice(EssDevice):
 		return 0
 
 	def _forcecharge(self):
-		return self.monitor.get_value(HUB4_SERVICE, '/Overrides/ForceCharge')
+		return WriteQueue.instance.get_value(HUB4_SERVICE, '/Overrides/ForceCharge')
 
 	def _set_forcecharge(self, v):
-		return self.monitor.set_value_async(HUB4_SERVICE,
+		WriteQueue.instance.write(HUB4_SERVICE,
 			'/Overrides/ForceCharge', 1 if v else 0)
 
 	def _maxdischargepower(self):
-		return self.monitor.get_value(HUB4_SERVICE,
+		return WriteQueue.instance.get_value(HUB4_SERVICE,
 			'/Overrides/MaxDischargePower')
 
 	def _set_maxdischargepower(self, v):
-		return self.monitor.set_value_async(HUB4_SERVICE,
+		WriteQueue.instance.write(HUB4_SERVICE,
 			'/Overrides/MaxDischargePower', -1 if v is None else v)
 
 class MultiRsDevice(EssDevice):
@@ -189,15 +190,15 @@ class MultiRsDevice(EssDevice):
 		# Setting the maxdischargepower always happens last, so we can
 		# include charging decisions here
 		if self.charge:
-			self.monitor.set_value_async(self.service,
+			WriteQueue.instance.write(self.service,
 				'/Ess/UseInverterPowerSetpoint', 1)
-			self.monitor.set_value_async(self.service,
+			WriteQueue.instance.write(self.service,
 				'/Ess/InverterPowerSetpoint', 15000)
 		elif v is not None:
-			self.monitor.set_value_async(self.service, '/Ess/UseInverterPowerSetpoint', 1)
-			self.monitor.set_value_async(self.service, '/Ess/InverterPowerSetpoint', -v)
+			WriteQueue.instance.write(self.service, '/Ess/UseInverterPowerSetpoint', 1)
+			WriteQueue.instance.write(self.service, '/Ess/InverterPowerSetpoint', -v)
 		else:
-			self.monitor.set_value_async(self.service, '/Ess/UseInverterPowerSetpoint', 0)
+			WriteQueue.instance.write(self.service, '/Ess/UseInverterPowerSetpoint', 0)
 
 class Reasons(IntEnum):
 	OK = 0
@@ -237,7 +238,7 @@ class ScheduledCharging(SystemCalcDelegate, ChargeControl):
 		# return non-zero.
 		self.devices.append(VebusDevice(self, dbusmonitor, None))
 
-		self._timer = GLib.timeout_add_seconds(5, exit_on_error, self._on_timer)
+		self._timer = Scheduler.instance.add_job('ScheduledCharging', 5000, exit_on_error, self._on_timer)
 
 	def get_input(self):
 		return [
@@ -1,7 +1,7 @@
-from dbus.exceptions import DBusException
 from delegates.base import SystemCalcDelegate
 from delegates.multi import Multi
 from sc_utils import safeadd
+from writequeue import WriteQueue
 
 def service_is_battery(service):
 	return service.split('.')[2] == 'battery'
@@ -51,12 +51,7 @@ class SocSync(SystemCalcDelegate):
 					not self._service_is_vecan(batteryservice)
 					or service_is_battery(batteryservice)):
 				for service in self.vecan:
-					# In case service goes down while we write, ignore
-					# exception
-					try:
-						self._dbusmonitor.set_value_async(service, '/Link/Soc', soc)
-					except DBusException:
-						pass
+					WriteQueue.instance.write(service, '/Link/Soc', soc)
 
 		# Sync ExtraBatteryCurrent, but only consider currents from
 		# VE.Direct chargers and the Multi
@@ -72,13 +67,9 @@ class SocSync(SystemCalcDelegate):
 			getattr(multi, 'dc_current', None))
 
 		for service in self.vecan:
-			try:
-				self._dbusmonitor.set_value_async(service,
-					'/Link/ExtraBatteryCurrent', pv_current)
-			except DBusException:
-				pass
-			else:
-				# This control flag is created by the VebusSocWriter delegate.
-				# We set the same one in case the extra battery current was
-				# successfully written to an Inverter RS.
-				newvalues['/Control/ExtraBatteryCurrent'] |= 1
+			WriteQueue.instance.write(service,
+				'/Link/ExtraBatteryCurrent', pv_current)
+			# This control flag is created by the VebusSocWriter delegate.
+			# We set the same one in case the extra battery current was
+			# written to an Inverter RS.
+			newvalues['/Control/ExtraBatteryCurrent'] |= 1
@@ -1,5 +1,5 @@
 from time import time
-from gi.repository import GLib
+from scheduler import Scheduler
 
 # Victron packages
 from ve_utils import exit_on_error
@@ -29,7 +29,8 @@ class SourceTimers(SystemCalcDelegate):
 			self._dbusservice.add_path(p, value=0)
 		self._dbusservice.add_path('/Timers/TimeOff', value=0)
 		self._on_timer()
-		self._timer = GLib.timeout_add_seconds(10, exit_on_error, self._on_timer)
+		self._timer = Scheduler.instance.add_job('SourceTimers', 10000, exit_on_error, self._on_timer,
+			spread=False)
 
 	@property
 	def elapsed(self):
@@ -135,8 +135,8 @@ class SystemState(SystemCalcDelegate):
 
 			# Look for Multi RS, Inverter RS, or a VE.Direct inverter
 			inverter = next(chain(
-				self._dbusmonitor.get_service_list('com.victronenergy.acsystem').keys(),
-				self._dbusmonitor.get_service_list('com.victronenergy.inverter').keys()), None)
+				sc_utils.ServiceIndex.instance.get('com.victronenergy.acsystem'),
+				sc_utils.ServiceIndex.instance.get('com.victronenergy.inverter')), None)
 			if inverter is not None:
 				if self._dbusmonitor.get_value(inverter, '/Ess/Sustain') == 1:
 					ss = SystemState.SUSTAIN
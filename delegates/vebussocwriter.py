@@ -1,5 +1,6 @@
-from dbus.exceptions import DBusException
 from gi.repository import GLib
+from scheduler import Scheduler
+from writequeue import WriteQueue
 import logging
 from itertools import islice
 
@@ -35,7 +36,7 @@ class VebusSocWriter(SystemCalcDelegate):
 		self._dbusservice.add_path('/Control/VebusSoc', value=0)
 
 		GLib.idle_add(exit_on_error, lambda: not self._write_vebus_soc())
-		GLib.timeout_add_seconds(10, exit_on_error, self._write_vebus_soc)
+		Scheduler.instance.add_job('VebusSocWriter', 10000, exit_on_error, self._write_vebus_soc)
 
 	def update_values(self, newvalues):
 		vebus_service = newvalues.get('/VebusService')
@@ -54,13 +55,10 @@ class VebusSocWriter(SystemCalcDelegate):
 
 			# Take only the charge current. Total current includes output on the load output terminals
 			total_charge_current = newvalues.get('/Dc/Pv/ChargeCurrent', 0)
-			try:
-				charge_current = self._dbusmonitor.get_value(vebus_service, '/ExtraBatteryCurrent')
-				if charge_current is not None:
-					self._dbusmonitor.set_value_async(vebus_service, '/ExtraBatteryCurrent', total_charge_current)
-					current_written = 1
-			except DBusException:
-				pass
+			charge_current = self._dbusmonitor.get_value(vebus_service, '/ExtraBatteryCurrent')
+			if charge_current is not None:
+				WriteQueue.instance.write(vebus_service, '/ExtraBatteryCurrent', total_charge_current)
+				current_written = 1
 		newvalues['/Control/ExtraBatteryCurrent'] = current_written
 
 	def _write_vebus_soc(self):
@@ -71,12 +69,8 @@ class VebusSocWriter(SystemCalcDelegate):
 				soc = self._dbusservice['/Dc/Battery/Soc']
 				if soc is not None:
 					logging.debug("writing this soc to vebus: %d", soc)
-					try:
-						# Vebus service may go offline while we write this SoC
-						self._dbusmonitor.set_value_async(vebus_service, '/Soc', soc)
-						soc_written = 1
-					except DBusException:
-						pass
+					WriteQueue.instance.write(vebus_service, '/Soc', soc)
+					soc_written = 1
 		self._dbusservice['/Control/VebusSoc'] = soc_written
 		return True
 
@@ -0,0 +1,93 @@
+import gzip
+import json
+import time
+from sc_utils import service_base_name
+
+# Paths always monitored, in addition to those in the tree
+_MANDATORY_PATHS = ('/Connected', '/ProductName', '/Mgmt/Connection', '/DeviceInstance')
+
+VERSION = 1
+
+def _open(path, mode):
+	if path.endswith('.gz'):
+		return gzip.open(path, mode + 't')
+	return open(path, mode)
+
+class Recorder(object):
+	""" Writes the services seen by the dbus monitor, and every change to
+	    their values, to a file that can be fed back into MockSystemCalc
+	    with tests/replay.py. The file is gzipped if the name ends in .gz.
+
+	    The first line is a JSON header with the systemcalc settings, each
+	    following line is a JSON list, with the time in milliseconds since
+	    the start of the recording second:
+	        ["A", t, id, service, {path: value}]  service added
+	        ["R", t, id]                          service removed
+	        ["C", t, id, path, value]             value changed
+	        ["S", t, setting, value]              systemcalc setting changed
+	    Services are numbered, to keep the value changes short. """
+	def __init__(self, path, monitor, tree, settings):
+		self._monitor = monitor
+		self._tree = tree
+		self._ids = {}
+		self._next_id = 0
+		self._start = self._get_time()
+		self._flushed = 0
+		self._file = _open(path, 'w')
+		self._file.write(json.dumps({'version': VERSION, 'settings': settings}) + '\n')
+
+		for service in monitor.get_service_list():
+			self.service_added(service)
+
+	_get_time = lambda s: time.monotonic()
+
+	def _write(self, *event):
+		t = int((self._get_time() - self._start) * 1000)
+		self._file.write(json.dumps([event[0], t] + list(event[1:]),
+			separators=(',', ':'), default=str) + '\n')
+		if t - self._flushed >= 1000:
+			self._flushed = t
+			self._file.flush()
+
+	def service_added(self, service):
+		if service in self._ids:
+			return
+		self._ids[service] = sid = self._next_id
+		self._next_id += 1
+
+		paths = self._tree.get(service_base_name(service), {})
+		paths = list(_MANDATORY_PATHS) + [p for p in paths if p not in _MANDATORY_PATHS]
+		values = {p: self._monitor.get_value(service, p) for p in paths
+			if self._monitor.seen(service, p)}
+		self._write('A', sid, service, values)
+
+	def service_removed(self, service):
+		sid = self._ids.pop(service, None)
+		if sid is not None:
+			self._write('R', sid)
+
+	def value_changed(self, service, path, value):
+		sid = self._ids.get(service)
+		if sid is not None:
+			self._write('C', sid, path, value)
+
+	def setting_changed(self, setting, value):
+		self._write('S', setting, value)
+
+	def close(self):
+		self._file.close()
+
+def read_recording(path):
+	""" Returns the header of a recording, and an iterator over its
+	    events, as written by Recorder. """
+	f = _open(path, 'r')
+	header = json.loads(f.readline())
+	if header.get('version') != VERSION:
+		raise ValueError('Unsupported recording version {}'.format(header.get('version')))
+
+	def events():
+		with f:
+			for line in f:
+				if line.strip():
+					yield json.loads(line)
+	return header, events()
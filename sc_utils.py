@@ -1,5 +1,12 @@
+import csv
+import heapq
+import itertools
+from time import perf_counter
 from functools import update_wrapper
+from array import array
+from collections import ChainMap, deque
 from collections.abc import Mapping
+from types import MappingProxyType
 
 VictronServicePrefix = 'com.victronenergy'
 
@@ -104,6 +111,11 @@ class ExpiringValue(object):
 			return self._value
 		return None
 
+	def peek(self):
+		""" Returns the value like get does, without using up one of the
+		    reads. """
+		return self._value if self._ttl > 0 else None
+
 	def set(self, v):
 		self._value = v
 		self._ttl = self._maxage
@@ -111,3 +123,409 @@ class ExpiringValue(object):
 	@property
 	def expired(self):
 		return self._ttl <= 0
+
+class RollingStats(object):
+	""" Keeps the last size samples, and works out percentiles over them
+	    only when asked, so adding a sample stays cheap. The number and sum
+	    of all samples ever added are kept too. """
+	def __init__(self, size=128):
+		self._samples = deque(maxlen=size)
+		self.count = 0
+		self.total = 0
+
+	def __len__(self):
+		return len(self._samples)
+
+	def add(self, v):
+		self._samples.append(v)
+		self.count += 1
+		self.total += v
+
+	def percentiles(self):
+		""" Returns p50, p99 and the maximum of the samples kept. """
+		if not self._samples:
+			return None, None, None
+		s = sorted(self._samples)
+		return s[len(s) // 2], s[min(len(s) - 1, int(len(s) * 0.99))], s[-1]
+
+class Profiler(object):
+	""" Rolling run time statistics, in milliseconds, of delegate hooks,
+	    keyed on the name of the delegate and the hook. Nothing is timed
+	    while disabled. """
+	def __init__(self, size=128):
+		self.enabled = True
+		self._size = size
+		self._stats = {}
+		self._changed = set()
+
+	def call(self, name, hook, f, *args):
+		if not self.enabled:
+			return f(*args)
+		start = perf_counter()
+		try:
+			return f(*args)
+		finally:
+			self.record(name, hook, (perf_counter() - start) * 1000)
+
+	def record(self, name, hook, ms):
+		if not self.enabled:
+			return
+		try:
+			stats = self._stats[(name, hook)]
+		except KeyError:
+			stats = self._stats[(name, hook)] = RollingStats(self._size)
+		stats.add(ms)
+		self._changed.add((name, hook))
+
+	def clear(self):
+		self._stats.clear()
+		self._changed.clear()
+
+	def items(self):
+		""" Yields name, hook and the RollingStats for everything timed. """
+		for (name, hook), stats in self._stats.items():
+			yield name, hook, stats
+
+	def changed(self):
+		""" Yields name, hook and (p50, p99, max) for everything timed
+		    since the previous call. """
+		changed, self._changed = self._changed, set()
+		for name, hook in changed:
+			yield name, hook, self._stats[(name, hook)].percentiles()
+
+class Trace(object):
+	""" Fixed size ring buffer of numeric records. Every field is kept in
+	    its own preallocated array, of the typecode given with the field,
+	    so that appending a record allocates nothing. None is stored as
+	    NaN, in integer fields as the smallest value of the type. """
+	MAGIC = b'TRACE1\n'
+
+	def __init__(self, fields, size):
+		self.fields = tuple(name for name, _ in fields)
+		self.size = size
+		self._columns = tuple(array(t, bytes(array(t).itemsize * size)) for _, t in fields)
+		self._none = tuple(float('nan') if t in 'fd' else
+			-(1 << (8 * array(t).itemsize - 1)) for _, t in fields)
+		self._next = 0
+		self._count = 0
+
+	def __len__(self):
+		return self._count
+
+	def append(self, *values):
+		i = self._next
+		for column, none, v in zip(self._columns, self._none, values):
+			column[i] = none if v is None else v
+		self._next = (i + 1) % self.size
+		self._count = min(self._count + 1, self.size)
+
+	def __iter__(self):
+		""" Yields the records kept as tuples, oldest first. """
+		start = self._next - self._count
+		for i in range(start, start + self._count):
+			i %= self.size
+			yield tuple(None if (v != v or v == none) else v
+				for v, none in zip((c[i] for c in self._columns), self._none))
+
+	def clear(self):
+		self._next = self._count = 0
+
+	def dump_csv(self, path):
+		with open(path, 'w', newline='') as f:
+			writer = csv.writer(f)
+			writer.writerow(self.fields)
+			writer.writerows(('' if v is None else v for v in r) for r in self)
+
+	def dump(self, path):
+		""" Writes the records, oldest first, as a line with the magic, a
+		    line with the fields and their typecodes, the number of records
+		    on a line, followed by the raw arrays one after the other. """
+		start = (self._next - self._count) % self.size
+		with open(path, 'wb') as f:
+			f.write(self.MAGIC)
+			f.write(','.join('{}:{}'.format(n, c.typecode)
+				for n, c in zip(self.fields, self._columns)).encode('ascii') + b'\n')
+			f.write(b'%d\n' % self._count)
+			for column in self._columns:
+				if start + self._count <= self.size:
+					column[start:start + self._count].tofile(f)
+				else:
+					column[start:].tofile(f)
+					column[:(start + self._count) % self.size].tofile(f)
+
+	@classmethod
+	def load(cls, path):
+		""" Reads a trace written by dump. """
+		with open(path, 'rb') as f:
+			if f.readline() != cls.MAGIC:
+				raise ValueError('{} is not a trace'.format(path))
+			fields = [tuple(x.split(':')) for x in f.readline().decode('ascii').strip().split(',')]
+			count = int(f.readline())
+			trace = cls(fields, max(1, count))
+			for column in trace._columns:
+				column[:count] = array(column.typecode, f.read(column.itemsize * count))
+			trace._count = count
+			trace._next = count % trace.size
+		return trace
+
+class ServiceIndex(object):
+	""" Keeps the services of each service class, along with their device
+	    instances. It is maintained from the device added and removed
+	    events, so that enumerating the services of a class does not need
+	    a fresh dict from the dbusmonitor. The views handed out are read
+	    only, but do reflect later changes. The last created index is
+	    available as ServiceIndex.instance.
+
+	    Separately, the services that are connected are tracked, along with
+	    a heap ordered by device instance, so the connected service with
+	    the lowest device instance is found without sorting. """
+	_empty = MappingProxyType({})
+	instance = None
+
+	def __init__(self):
+		self._services = {}
+		self._views = {}
+		self._instances = {}
+		self._connected = {}
+		self._connected_views = {}
+		self._heaps = {}
+		ServiceIndex.instance = self
+
+	@staticmethod
+	def _class_dict(d, views, serviceclass):
+		services = d.get(serviceclass)
+		if services is None:
+			services = d[serviceclass] = {}
+			views[serviceclass] = MappingProxyType(services)
+		return services
+
+	def add(self, service, instance):
+		services = self._class_dict(self._services, self._views,
+			service_base_name(service))
+		services[service] = self._instances[service] = instance
+
+	def remove(self, service):
+		self._instances.pop(service, None)
+		serviceclass = service_base_name(service)
+		for d in (self._services, self._connected):
+			services = d.get(serviceclass)
+			if services is not None:
+				services.pop(service, None)
+
+	def set_connected(self, service, connected):
+		""" Mark a service that was added as connected or not. """
+		if service not in self._instances:
+			return
+		serviceclass = service_base_name(service)
+		services = self._class_dict(self._connected, self._connected_views,
+			serviceclass)
+		if not connected:
+			services.pop(service, None)
+		elif service not in services:
+			instance = services[service] = self._instances[service]
+			heap = self._heaps.setdefault(serviceclass, [])
+			heapq.heappush(heap, (instance, service))
+
+			# Stale entries are normally dropped when they reach the top,
+			# but if a service flaps they could pile up.
+			if len(heap) > 2 * len(services) + 8:
+				heap[:] = [(i, s) for s, i in services.items()]
+				heapq.heapify(heap)
+
+	def get(self, classfilter):
+		""" Returns a read-only mapping of service name to device instance
+		    for all services of classfilter. """
+		return self._views.get(classfilter, self._empty)
+
+	def device_instance(self, service):
+		return self._instances.get(service)
+
+	def connected(self, classfilter):
+		""" Like get, but only the services that are connected. """
+		return self._connected_views.get(classfilter, self._empty)
+
+	def lowest_connected(self, classfilter):
+		""" Returns (service, instance) for the connected service of
+		    classfilter that has the lowest device instance, or None. """
+		heap = self._heaps.get(classfilter)
+		if not heap:
+			return None
+		services = self._connected[classfilter]
+		while heap:
+			instance, service = heap[0]
+			if service in services and services[service] == instance:
+				return (service, instance)
+			heapq.heappop(heap) # Disconnected or removed since
+		return None
+
+class OptionalSum(object):
+	""" A sum that is kept up to date as the values in it change. Values
+	    that are None are left out. If all of them are, the sum is None. """
+	def __init__(self):
+		self.total = 0
+		self.count = 0
+
+	def replace(self, old, new):
+		if old is not None:
+			self.total -= old
+			self.count -= 1
+		if new is not None:
+			self.total += new
+			self.count += 1
+		if self.count == 0:
+			self.total = 0 # Don't let rounding errors accumulate
+
+	def reset(self, values):
+		""" Sums values from scratch. Call this now and then, as the
+		    rounding errors of replace add up for as long as the count
+		    does not return to zero. """
+		values = [v for v in values if v is not None]
+		self.total = sum(values)
+		self.count = len(values)
+
+	@property
+	def value(self):
+		return self.total if self.count else None
+
+class ExtremeIndex(object):
+	""" Keeps the lowest, or highest, of the values of a number of keys in a
+	    heap, so that a change costs O(log n). A key that changes gets a new
+	    entry; the old one is left behind and dropped once it comes to the
+	    top. The heap is rebuilt when it holds too many of those. """
+	def __init__(self, highest=False):
+		self._sign = -1 if highest else 1
+		self._heap = [] # (sign * value, seq, key)
+		self._live = {} # key -> (value, data, seq)
+		self._seq = itertools.count()
+
+	def __len__(self):
+		return len(self._live)
+
+	def update(self, key, value, data=None):
+		""" Sets the value of key, and some data that goes with it. A value
+		    of None removes key. """
+		live = self._live.get(key)
+		if value is None:
+			self._live.pop(key, None)
+		elif live is not None and live[0] == value:
+			self._live[key] = (value, data, live[2])
+		else:
+			seq = next(self._seq)
+			self._live[key] = (value, data, seq)
+			heapq.heappush(self._heap, (self._sign * value, seq, key))
+
+		if len(self._heap) > 2 * len(self._live) + 16:
+			self._heap = [(self._sign * v, seq, k) for k, (v, _, seq) in self._live.items()]
+			heapq.heapify(self._heap)
+
+	def top(self):
+		""" Returns the key holding the extreme, its value and data, or
+		    None if there are no values. """
+		while self._heap:
+			_, seq, key = self._heap[0]
+			live = self._live.get(key)
+			if live is not None and live[2] == seq:
+				return key, live[0], live[1]
+			heapq.heappop(self._heap)
+		return None
+
+class DependencyGraph(object):
+	""" A set of computations (nodes) that each declare the keys they read
+	    and the keys they produce. A key read by a node is either produced
+	    by another node, or is an external input that the caller reports as
+	    changed. Nodes are evaluated in dependency order, and only if one
+	    of their inputs changed. A node that produces the same outputs as
+	    before does not cause anything downstream of it to be evaluated.
+	    The results of all nodes are kept in the values dict. """
+	_missing = object()
+
+	def __init__(self):
+		self._nodes = {}
+		self._producers = {}
+		self._order = None
+		self.values = {}
+		self.evaluated = []
+
+	def add_node(self, name, compute, inputs, outputs):
+		""" Adds a node. compute is called with a mapping from which the
+		    node reads its inputs, and into which it writes its outputs.
+		    Outputs that the node does not write are considered invalid,
+		    and are left out of values. """
+		if name in self._nodes:
+			raise ValueError('Duplicate node {}'.format(name))
+		for o in outputs:
+			if o in self._producers:
+				raise ValueError('{} is produced by both {} and {}'.format(
+					o, self._producers[o], name))
+		for o in outputs:
+			self._producers[o] = name
+		self._nodes[name] = (compute, tuple(inputs), frozenset(outputs))
+		self._order = None
+
+	@property
+	def outputs(self):
+		return self._producers.keys()
+
+	def _sort(self):
+		# Order nodes so that each node comes after the nodes whose output
+		# it reads. Ties are broken in the order the nodes were added.
+		upstream = {}
+		self._consumers = {}
+		for name, (compute, inputs, outputs) in self._nodes.items():
+			upstream[name] = set()
+			for i in inputs:
+				producer = self._producers.get(i)
+				if producer is None:
+					self._consumers.setdefault(i, []).append(name)
+				elif producer != name:
+					upstream[name].add(producer)
+
+		order = []
+		done = set()
+		while len(order) < len(self._nodes):
+			ready = [n for n in self._nodes if n not in done and upstream[n] <= done]
+			if not ready:
+				raise ValueError('Dependency cycle between {}'.format(
+					', '.join(n for n in self._nodes if n not in done)))
+			order.extend(ready)
+			done.update(ready)
+		self._order = order
+
+	def evaluate(self, changed=None, *args):
+		""" Evaluate the nodes affected by the external inputs in changed,
+		    or all nodes if changed is None. Extra arguments are passed to
+		    each compute function. Returns the set of keys whose value
+		    changed. """
+		if self._order is None:
+			self._sort()
+
+		if changed is None:
+			dirty = set(self._nodes)
+		else:
+			dirty = set()
+			for i in changed:
+				dirty.update(self._consumers.get(i, ()))
+
+		modified = set()
+		self.evaluated = []
+		for name in self._order:
+			compute, inputs, outputs = self._nodes[name]
+			if name not in dirty and modified.isdisjoint(inputs):
+				continue
+			self.evaluated.append(name)
+
+			# Take the old outputs away so the node cannot see them
+			previous = {o: self.values.pop(o) for o in outputs if o in self.values}
+			values = ChainMap({}, self.values)
+			compute(values, *args)
+			result = values.maps[0]
+
+			for k, v in result.items():
+				if k not in outputs:
+					raise ValueError('Node {} wrote undeclared output {}'.format(name, k))
+				if previous.pop(k, self._missing) != v:
+					modified.add(k)
+			modified.update(previous) # Outputs that went away
+			self.values.update(result)
+
+		return modified
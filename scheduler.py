@@ -0,0 +1,150 @@
+import heapq
+import logging
+import time
+from itertools import count
+from gi.repository import GLib
+
+logger = logging.getLogger(__name__)
+
+# Granularity of the scheduler, in milliseconds. Job intervals are rounded
+# up to a whole number of ticks.
+TICK = 1000
+
+class Job(object):
+	def __init__(self, name, interval, due, callback, args):
+		self.name = name
+		self.interval = interval
+		self.due = due
+		self.callback = callback
+		self.args = args
+		self.active = True
+		self.runs = 0
+		self.failures = 0
+		self.runtime = None
+		self.lateness = None
+		self.maxlateness = 0
+
+class Scheduler(object):
+	""" Runs the periodic jobs of the delegates off a single GLib timer.
+	    Jobs sharing an interval are spread over different ticks, and all
+	    jobs due on a tick are run in one batch. A job that raises is
+	    logged and kept. Run time, lateness and the number of failed runs
+	    of every job are kept, and published under /Debug/Scheduler if a
+	    dbus service is passed, in one go for each batch. Run times are also handed to the profiler, if
+	    there is one, under the job name. If after is passed, it is called
+	    once a batch has run. """
+	instance = None
+
+	_get_time = lambda s: time.monotonic()
+
+	def __init__(self, dbusservice=None, profiler=None, after=None):
+		Scheduler.instance = self
+		self._dbusservice = dbusservice
+		self._profiler = profiler
+		self._after = after
+		self._queue = [] # heap of (due tick, seq, job)
+		self._seq = count()
+		self._phases = {}
+		self._published = set()
+		self._ticks = 0
+		self._expected = None
+		self._timer = None
+		self._start()
+
+	def add_job(self, name, interval, callback, *args, spread=True):
+		""" Run callback(*args) every interval milliseconds. As with GLib
+		    timers, the job is removed when the callback returns False.
+		    Unless spread is False, the first run may be brought forward by
+		    a number of ticks, so that jobs with the same interval do not
+		    run together. Returns a handle that can be passed to
+		    remove_job. """
+		ticks = max(1, -(-interval // TICK))
+		offset = 0
+		if spread:
+			slot = self._phases.get(ticks, 0)
+			self._phases[ticks] = slot + 1
+			offset = slot % ticks
+
+		job = Job(name, ticks, self._ticks + ticks - offset, callback, args)
+		heapq.heappush(self._queue, (job.due, next(self._seq), job))
+		self._add_paths(name)
+		self._start()
+		return job
+
+	def remove_job(self, job):
+		# The queue entry is dropped when it comes due.
+		job.active = False
+
+	@property
+	def jobs(self):
+		return [job for _, _, job in self._queue if job.active]
+
+	def _start(self):
+		if self._timer is None:
+			self._expected = self._get_time() + TICK / 1000.0
+			self._timer = GLib.timeout_add(TICK, self._on_timer)
+
+	def _add_paths(self, name):
+		if self._dbusservice is None or name in self._published:
+			return
+		self._published.add(name)
+		for p in ('Runtime', 'Lateness', 'MaxLateness', 'Failures'):
+			self._dbusservice.add_path('/Debug/Scheduler/{}/{}'.format(name, p), None)
+
+	def _on_timer(self):
+		self._ticks += 1
+		expected = self._expected
+		self._expected = self._get_time() + TICK / 1000.0
+
+		batch = []
+		while self._queue and self._queue[0][0] <= self._ticks:
+			job = heapq.heappop(self._queue)[2]
+			if job.active:
+				batch.append(job)
+
+		for job in batch:
+			if not job.active:
+				continue # Removed by an earlier job in this batch
+			self._run(job, expected)
+			if job.active:
+				job.due = self._ticks + job.interval
+				heapq.heappush(self._queue, (job.due, next(self._seq), job))
+
+		if batch and self._dbusservice is not None:
+			self._publish(batch)
+
+		if batch and self._after is not None:
+			self._after()
+
+		if not self._queue:
+			self._timer = None
+			return False
+		return True
+
+	def _run(self, job, expected):
+		job.lateness = max(0, int((self._get_time() - expected) * 1000))
+		job.maxlateness = max(job.maxlateness, job.lateness)
+		start = time.perf_counter()
+		try:
+			keep = job.callback(*job.args)
+		except Exception:
+			# Like the other jobs, it runs again at its next interval
+			logger.exception('Scheduled job %s failed', job.name)
+			job.failures += 1
+			keep = True
+		job.runtime = round((time.perf_counter() - start) * 1000, 3)
+		job.runs += 1
+		if self._profiler is not None:
+			self._profiler.record(job.name, 'Timer', job.runtime)
+		if not keep:
+			job.active = False
+
+	def _publish(self, jobs):
+		# Send the statistics of the batch as one ItemsChanged
+		with self._dbusservice as s:
+			for job in jobs:
+				prefix = '/Debug/Scheduler/' + job.name
+				s[prefix + '/Runtime'] = job.runtime
+				s[prefix + '/Lateness'] = job.lateness
+				s[prefix + '/MaxLateness'] = job.maxlateness
+				s[prefix + '/Failures'] = job.failures
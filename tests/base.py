@@ -47,6 +47,10 @@ class TestSystemCalcBase(unittest.TestCase):
 	def _remove_device(self, service):
 		self._monitor.remove_service(service)
 
+	def _flush_writes(self):
+		# Send the values delegates wrote outside of a tick
+		self._system_calc._writequeue.flush()
+
 	def _set_setting(self, path, value):
 		self._system_calc._settings[self._system_calc._settings.get_short_name(path)] = value
 
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import unittest
+import dbus
+
+# This adapts sys.path to include all relevant packages
+import context
+
+# our own packages
+from base import TestSystemCalcBase
+
+# Monkey patching for unit tests
+import patches
+
+# tested classes
+from delegates.batterybank import BatteryBank
+
+def battery(instance, current, soc, capacity, mincell, maxcell):
+	return {
+		'/Dc/0/Voltage': 52.0,
+		'/Dc/0/Current': current,
+		'/Dc/0/Power': round(52.0 * current),
+		'/Soc': soc,
+		'/InstalledCapacity': capacity,
+		'/System/MinCellVoltage': mincell,
+		'/System/MaxCellVoltage': maxcell,
+		'/System/MinCellTemperature': 20,
+		'/System/MaxCellTemperature': 24,
+		'/System/MinVoltageCellId': 'C1',
+		'/System/MaxVoltageCellId': 'C{}'.format(instance + 2),
+		'/System/MinTemperatureCellId': None,
+		'/System/MaxTemperatureCellId': None,
+		'/DeviceInstance': instance}
+
+class TestBatteryBank(TestSystemCalcBase):
+	def __init__(self, methodName='runTest'):
+		TestSystemCalcBase.__init__(self, methodName)
+
+	def setUp(self):
+		TestSystemCalcBase.setUp(self)
+		self._add_device('com.victronenergy.battery.ttyO1',
+			product_name='battery', values=battery(0, 10, 50, 100, 3.30, 3.35))
+		self._add_device('com.victronenergy.battery.ttyO2',
+			product_name='battery', values=battery(1, 20, 80, 300, 3.32, 3.40))
+		self._add_device('com.victronenergy.battery.ttyO3',
+			product_name='battery', values=battery(2, -5, 20, 100, 3.25, 3.31))
+
+	def test_bank(self):
+		self._update_values()
+		self._check_values({
+			'/Dc/Battery/Bank/Count': 3,
+			'/Dc/Battery/Bank/Current': 25,
+			'/Dc/Battery/Bank/Power': 1300,
+			'/Dc/Battery/Bank/Soc': 62,
+			'/Dc/Battery/Bank/Capacity': 500,
+			'/Dc/Battery/Bank/MinCellVoltage': 3.25,
+			'/Dc/Battery/Bank/MinCellVoltageService': 'com.victronenergy.battery.ttyO3',
+			'/Dc/Battery/Bank/MinCellVoltageCellId': 'C1',
+			'/Dc/Battery/Bank/MaxCellVoltage': 3.40,
+			'/Dc/Battery/Bank/MaxCellVoltageService': 'com.victronenergy.battery.ttyO2',
+			'/Dc/Battery/Bank/MaxCellVoltageCellId': 'C3',
+			'/Dc/Battery/Bank/MinCellTemperature': 20,
+			'/Dc/Battery/Bank/MinCellTemperatureCellId': None,
+			'/Dc/Battery/Bank/MaxCellTemperature': 24,
+		})
+		self.assertEqual(BatteryBank.instance.cell('/System/MaxCellVoltage'),
+			(3.40, 'com.victronenergy.battery.ttyO2', 'C3'))
+
+		# Not used for the battery unless enabled
+		self._check_values({
+			'/Dc/Battery/Current': 10,
+			'/Dc/Battery/Soc': 50,
+			'/Dc/Battery/Capacity': 100})
+
+	def test_changes(self):
+		self._update_values()
+
+		# The weakest cell recovers, the next weakest takes over
+		self._monitor.set_value('com.victronenergy.battery.ttyO3', '/System/MinCellVoltage', 3.31)
+		self._monitor.set_value('com.victronenergy.battery.ttyO1', '/Dc/0/Current', 12)
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Soc', 90)
+		self._update_values()
+		self._check_values({
+			'/Dc/Battery/Bank/Current': 27,
+			'/Dc/Battery/Bank/Soc': 68,
+			'/Dc/Battery/Bank/MinCellVoltage': 3.30,
+			'/Dc/Battery/Bank/MinCellVoltageService': 'com.victronenergy.battery.ttyO1',
+		})
+
+		# A battery without a soc still counts for capacity
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Soc', None)
+		self._update_values()
+		self._check_values({
+			'/Dc/Battery/Bank/Soc': 35,
+			'/Dc/Battery/Bank/Capacity': 500})
+
+		# Another cell becomes the highest
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/System/MaxVoltageCellId', 'C7')
+		self._update_values()
+		self._check_values({
+			'/Dc/Battery/Bank/MaxCellVoltage': 3.40,
+			'/Dc/Battery/Bank/MaxCellVoltageCellId': 'C7'})
+
+		# Disconnected batteries are left out
+		self._monitor.set_value('com.victronenergy.battery.ttyO1', '/Connected', 0)
+		self._update_values()
+		self._check_values({
+			'/Dc/Battery/Bank/Count': 2,
+			'/Dc/Battery/Bank/Current': 15,
+			'/Dc/Battery/Bank/Capacity': 400,
+			'/Dc/Battery/Bank/MinCellVoltage': 3.31,
+			'/Dc/Battery/Bank/MinCellVoltageService': 'com.victronenergy.battery.ttyO3',
+			'/Dc/Battery/Bank/MaxCellVoltageService': 'com.victronenergy.battery.ttyO2',
+		})
+
+		self._monitor.set_value('com.victronenergy.battery.ttyO1', '/Connected', 1)
+		self._remove_device('com.victronenergy.battery.ttyO2')
+		self._update_values()
+		self._check_values({
+			'/Dc/Battery/Bank/Count': 2,
+			'/Dc/Battery/Bank/Current': 7,
+			'/Dc/Battery/Bank/Soc': 35,
+			'/Dc/Battery/Bank/MaxCellVoltage': 3.35,
+			'/Dc/Battery/Bank/MaxCellVoltageService': 'com.victronenergy.battery.ttyO1',
+		})
+
+	def test_invalid_value(self):
+		self._update_values()
+		bank = BatteryBank.instance
+
+		# On the bus, an invalid value is an empty array
+		invalid = {'Value': dbus.Array([], signature='i')}
+		bank._value_changed('com.victronenergy.battery.ttyO1', '/Dc/0/Current', invalid)
+		bank._value_changed('com.victronenergy.battery.ttyO3', '/System/MinCellVoltage', invalid)
+		self.assertEqual(bank.get_totals()['/Dc/Battery/Current'], 15)
+		self.assertEqual(bank.cell('/System/MinCellVoltage'),
+			(3.30, 'com.victronenergy.battery.ttyO1', 'C1'))
+
+		# And a valid value later on is summed again
+		bank._value_changed('com.victronenergy.battery.ttyO1', '/Dc/0/Current', {'Value': 11})
+		self.assertEqual(bank.get_totals()['/Dc/Battery/Current'], 26)
+
+	def test_recompute(self):
+		self._update_values()
+		bank = BatteryBank.instance
+		bank._sums['/Dc/0/Current'].total += 1e-9
+		bank._charge.total += 1e-6
+
+		# The rounding errors are gone once the sums are recomputed
+		self._update_values(60000)
+		self.assertEqual(bank._sums['/Dc/0/Current'].value, 25)
+		self.assertEqual(bank._charge.value, 50 * 100 + 80 * 300 + 20 * 100)
+		self._check_values({'/Dc/Battery/Bank/Current': 25})
+
+	def test_aggregation(self):
+		self._set_setting('/Settings/SystemSetup/BatteryBank', 1)
+		self._update_values()
+		self._check_values({
+			'/Dc/Battery/BatteryService': 'com.victronenergy.battery.ttyO1',
+			'/Dc/Battery/Current': 25,
+			'/Dc/Battery/Power': 1300,
+			'/Dc/Battery/Soc': 62,
+			'/Dc/Battery/Capacity': 500,
+			'/Dc/Battery/State': 1})
+
+		# A change on another battery than the battery monitor
+		self._monitor.set_value('com.victronenergy.battery.ttyO3', '/Dc/0/Power', -2000)
+		self._update_values()
+		self._check_values({
+			'/Dc/Battery/Power': -440,
+			'/Dc/Battery/State': 2})
+
+		self._set_setting('/Settings/SystemSetup/BatteryBank', 0)
+		self._update_values()
+		self._check_values({
+			'/Dc/Battery/Current': 10,
+			'/Dc/Battery/Power': 520,
+			'/Dc/Battery/Soc': 50,
+			'/Dc/Battery/Capacity': 100})
+
+if __name__ == '__main__':
+	unittest.main()
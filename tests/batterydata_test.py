@@ -1,3 +1,5 @@
+import dbus
+
 # This adapts sys.path to include all relevant packages
 import context
 
@@ -91,3 +93,78 @@ class TestHubSystem(TestSystemCalcBase):
 		data = self._service._dbusobjects['/Batteries']
 		self.assertTrue(len(data) == 1)
 		self.assertEqual(data[0]['name'], "battery")
+
+	def test_batteries_patched(self):
+		mock_load_configured_batteries(BatteryData.instance, [
+			{"name": None, "service": "com.victronenergy.battery/0", "enabled": True},
+			{"name": None, "service": "com.victronenergy.battery/1", "enabled": True},
+		])
+
+		self._update_values(5000)
+		data = self._service._dbusobjects['/Batteries']
+
+		# Only the entry of the battery that changed is replaced
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Soc', 16.1)
+		self._update_values(5000)
+		patched = self._service._dbusobjects['/Batteries']
+		self.assertIsNot(patched, data)
+		self.assertIs(patched[0], data[0])
+		self.assertEqual(patched[1]['soc'], 16.1)
+
+		# Nothing changed, nothing published
+		self._update_values(5000)
+		self.assertIs(self._service._dbusobjects['/Batteries'], patched)
+
+		# A battery that loses its voltage drops out of the list
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Dc/0/Voltage', None)
+		self._update_values(5000)
+		data = self._service._dbusobjects['/Batteries']
+		self.assertEqual([b['instance'] for b in data], [0])
+
+	def test_invalid_value(self):
+		mock_load_configured_batteries(BatteryData.instance, [
+			{"name": None, "service": "com.victronenergy.battery/0", "enabled": True},
+			{"name": None, "service": "com.victronenergy.battery/1", "enabled": True},
+		])
+		self._update_values(5000)
+
+		# On the bus, an invalid value is an empty array
+		tracker = BatteryData.instance.batteries['com.victronenergy.battery.ttyO2'][0]
+		tracker._value_changed('/Dc/0/Power', {'Value': dbus.Array([], signature='i')})
+		self.assertIsNone(tracker._tracked['/Dc/0/Power'])
+		self._update_values(5000)
+
+		# Power is then calculated, and there is no state
+		data = self._service._dbusobjects['/Batteries']
+		self.assertEqual(data[1]['power'], 12.15 * 5.3)
+		self.assertNotIn('state', data[1])
+		self.assertEqual(data[0]['state'], 1)
+
+	def test_flat_paths(self):
+		mock_load_configured_batteries(BatteryData.instance, [
+			{"name": None, "service": "com.victronenergy.battery/0", "enabled": True},
+			{"name": "Thruster Bank", "service": "com.victronenergy.battery/1", "enabled": True},
+		])
+		self._set_setting('/Settings/SystemSetup/Batteries/FlatPaths', 1)
+		self._update_values(5000)
+		self._check_values({
+			'/Batteries/com_victronenergy_battery_0/Soc': 15.3,
+			'/Batteries/com_victronenergy_battery_1/Soc': 15.3,
+			'/Batteries/com_victronenergy_battery_1/Name': 'Thruster Bank',
+			'/Batteries/com_victronenergy_battery_1/TimeToGo': None})
+
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Soc', 16.1)
+		self._update_values(5000)
+		self._check_values({
+			'/Batteries/com_victronenergy_battery_1/Soc': 16.1})
+
+		# Paths go away with the battery
+		self._remove_device('com.victronenergy.battery.ttyO2')
+		self._update_values(5000)
+		self.assertNotIn('/Batteries/com_victronenergy_battery_1/Soc', self._service)
+		self.assertIn('/Batteries/com_victronenergy_battery_0/Soc', self._service)
+
+		# And when disabled
+		self._set_setting('/Settings/SystemSetup/Batteries/FlatPaths', 0)
+		self._update_values(5000)
+		self.assertNotIn('/Batteries/com_victronenergy_battery_0/Soc', self._service)
@@ -11,6 +11,11 @@ from delegates import BatterySense, Dvcc
 # Monkey patching for unit tests
 import patches
 
+# Time travel patch
+from mock_gobject import timer_manager
+from writequeue import WriteQueue
+WriteQueue._get_time = lambda *a: timer_manager.time / 1000.0
+
 
 class VoltageSenseTest(TestSystemCalcBase):
 	def __init__(self, methodName='runTest'):
@@ -1039,3 +1044,62 @@ class VoltageSenseTest(TestSystemCalcBase):
 		self._check_external_values({
 			'com.victronenergy.alternator.ttyO1': {
 				'/Link/BatteryCurrent': 5.3}})
+
+	def test_sense_deadband(self):
+		self._set_setting('/Settings/Services/Bol', 1)
+		self._add_device('com.victronenergy.battery.ttyO2',
+			product_name='battery',
+			values={
+				'/Dc/0/Voltage': 12.15,
+				'/Dc/0/Current': 5.3,
+				'/Dc/0/Power': 65,
+				'/Soc': 15.3,
+				'/DeviceInstance': 2})
+		self._add_device('com.victronenergy.solarcharger.ttyO1', {
+			'/State': 0,
+			'/Link/NetworkMode': 0,
+			'/Link/VoltageSense': None,
+			'/Link/BatteryCurrent': None,
+			'/Dc/0/Voltage': 12.2,
+			'/Dc/0/Current': 9.7},
+			connection='VE.Direct')
+		self._update_values(3000)
+		self._check_external_values({
+			'com.victronenergy.vebus.ttyO1': {
+				'/BatterySense/Voltage': 12.15},
+			'com.victronenergy.solarcharger.ttyO1': {
+				'/Link/VoltageSense': 12.15,
+				'/Link/BatteryCurrent': 5.3}})
+
+		# Small changes are not sent
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Dc/0/Voltage', 12.155)
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Dc/0/Current', 5.35)
+		self._update_values(3000)
+		self._check_external_values({
+			'com.victronenergy.solarcharger.ttyO1': {
+				'/Link/VoltageSense': 12.15,
+				'/Link/BatteryCurrent': 5.3}})
+
+		# Larger ones are
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Dc/0/Current', 5.5)
+		self._update_values(3000)
+		self._check_external_values({
+			'com.victronenergy.solarcharger.ttyO1': {
+				'/Link/VoltageSense': 12.15,
+				'/Link/BatteryCurrent': 5.5}})
+
+		# The counters are updated on the next tick
+		self._check_values({
+			'/Debug/BatterySense/Sent': 3,
+			'/Debug/BatterySense/Suppressed': 3})
+
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Dc/0/Voltage', 12.17)
+		self._update_values(3000)
+		self._check_external_values({
+			'com.victronenergy.solarcharger.ttyO1': {
+				'/Link/VoltageSense': 12.17}})
+
+		# And everything is refreshed every now and then
+		self._update_values(12000)
+		self._check_values({
+			'/Debug/BatterySense/Sent': 7})
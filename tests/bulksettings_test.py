@@ -0,0 +1,139 @@
+import unittest
+from unittest.mock import patch
+
+# This adapts sys.path to include all relevant packages
+import context
+
+# Monkey patching for unit tests
+import patches
+
+from dbus.exceptions import DBusException
+from settingsdevice import SettingsDevice
+from bulksettings import BulkSettingsDevice
+
+SERVICE = 'com.victronenergy.settings'
+
+SETTINGS = {
+	'a': ['/Settings/Test/A', 1, 0, 10],
+	'b': ['/Settings/Test/B', 2.5, 0, 5],
+	'c': ['/Settings/Test/C', 'x', 0, 0],
+}
+
+class FakeItem(object):
+	def __init__(self, settings, path):
+		self._settings = settings
+		self._path = path
+
+	def SetValue(self, value, dbus_interface=None):
+		self._settings.values[self._path] = value
+		return 0
+
+class FakeSettings(object):
+	""" The root object of localsettings. Paths in reject are refused by
+	    AddSettings. Without bulk support, AddSettings raises like an
+	    unknown method would. """
+	def __init__(self, values=None, reject=(), bulk=True):
+		self.values = dict(values or {})
+		self.reject = reject
+		self.bulk = bulk
+		self.added = []
+
+	def AddSettings(self, items, dbus_interface=None):
+		if not self.bulk:
+			raise DBusException('No such method', name='org.freedesktop.DBus.Error.UnknownMethod')
+		result = []
+		for item in items:
+			path = item['path']
+			if path in self.reject:
+				result.append({'path': path, 'error': -2})
+				continue
+			self.added.append(item)
+			self.values.setdefault(path, item['default'])
+			result.append({'path': path, 'error': 0})
+		return result
+
+	def GetItems(self, dbus_interface=None):
+		return {path: {'Value': v, 'Text': str(v)} for path, v in self.values.items()}
+
+class FakeBus(object):
+	def __init__(self, settings):
+		self.settings = settings
+		self.receivers = []
+
+	def list_names(self):
+		return [SERVICE]
+
+	def get_object(self, name, path, introspect=True):
+		if path == '/':
+			return self.settings
+		return FakeItem(self.settings, path)
+
+	def add_signal_receiver(self, handler, **kwargs):
+		self.receivers.append((handler, kwargs))
+
+class TestBulkSettings(unittest.TestCase):
+	def setUp(self):
+		self.changes = []
+		self.fallback = []
+
+	def _device(self, settings):
+		self.bus = FakeBus(settings)
+		def add_settings(device, s):
+			self.fallback.extend(sorted(s))
+		with patch.object(SettingsDevice, 'addSettings', add_settings):
+			return BulkSettingsDevice(self.bus, SETTINGS, self._changed)
+
+	def _changed(self, setting, old, new):
+		self.changes.append((setting, old, new))
+
+	def test_bulk(self):
+		settings = FakeSettings({'/Settings/Test/A': 7})
+		device = self._device(settings)
+		self.assertEqual(self.fallback, [])
+		self.assertEqual(len(settings.added), 3)
+		self.assertEqual(settings.added[0], {'path': '/Settings/Test/A',
+			'default': 1, 'min': 0, 'max': 10})
+
+		# Strings have no limits
+		self.assertNotIn('min', settings.added[2])
+
+		# Values are what localsettings has, not the defaults
+		self.assertEqual(device['a'], 7)
+		self.assertEqual(device['b'], 2.5)
+		self.assertEqual(device['c'], 'x')
+
+		self.assertEqual(device._settings['a'].set_value(8), 0)
+		self.assertEqual(settings.values['/Settings/Test/A'], 8)
+		self.assertEqual(device._settings['a'].get_value(), 8)
+
+	def test_rejected(self):
+		settings = FakeSettings(reject=('/Settings/Test/B', ))
+		device = self._device(settings)
+
+		# Only the rejected setting is added the usual way
+		self.assertEqual(self.fallback, ['b'])
+		self.assertEqual(device['a'], 1)
+		self.assertNotIn('b', device._settings)
+
+	def test_not_supported(self):
+		self._device(FakeSettings(bulk=False))
+		self.assertEqual(self.fallback, ['a', 'b', 'c'])
+		self.assertEqual(self.bus.receivers, [])
+
+	def test_items_changed(self):
+		device = self._device(FakeSettings())
+		self.assertEqual(len(self.bus.receivers), 1)
+		handler, kwargs = self.bus.receivers[0]
+		self.assertEqual(kwargs['signal_name'], 'ItemsChanged')
+		self.assertEqual(kwargs['bus_name'], SERVICE)
+
+		handler({
+			'/Settings/Test/A': {'Value': 4, 'Text': '4'},
+			'/Settings/Test/C': {'Text': 'y'}, # No value, ignored
+			'/Settings/Other': {'Value': 1, 'Text': '1'}})
+		self.assertEqual(self.changes, [('a', 1, 4)])
+		self.assertEqual(device['a'], 4)
+		self.assertEqual(device._settings['a'].get_value(), 4)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+""" Simulates fleets of solar chargers, some of them shaded, under a battery
+    charge current limit, and runs the DVCC charge current distribution
+    against them in a closed loop. Reports how many ticks it takes for the
+    chargers to settle, how close the total gets to what is possible, how
+    many limits are still rewritten once settled, and how long a call
+    takes. """
+import argparse
+import json
+import random
+import sys
+import time
+
+# This adapts sys.path to include all relevant packages
+import context
+
+# Monkey patching for unit tests
+import patches
+
+from delegates.dvcc import ChargerSubsystem
+
+SIZES = (15, 35, 50, 70, 100)
+
+class Charger(object):
+	""" A solar charger that makes what its array gives it, up to its limit
+	    and size, and follows changes with a first order lag. """
+	def __init__(self, currentlimit, available, lag=0.5):
+		self.currentlimit = currentlimit
+		self.available = available
+		self.lag = lag
+		self.smoothed_current = 0.0
+		self.writes = 0
+		self._maxchargecurrent = currentlimit
+
+	@property
+	def maxchargecurrent(self):
+		return self._maxchargecurrent
+
+	@maxchargecurrent.setter
+	def maxchargecurrent(self, v):
+		v = max(0, min(v, self.currentlimit))
+		if v != self._maxchargecurrent:
+			self.writes += 1
+		self._maxchargecurrent = v
+
+	def step(self):
+		target = min(self.available, self._maxchargecurrent)
+		self.smoothed_current += (target - self.smoothed_current) * (1 - self.lag)
+
+def fleet(count, shaded=0.3, seed=0):
+	""" Returns count chargers of random size. A fraction of them is
+	    shaded, and makes a small part of its size. The rest has plenty of
+	    sun. """
+	rnd = random.Random(seed)
+	chargers = []
+	for _ in range(count):
+		size = rnd.choice(SIZES)
+		sun = rnd.uniform(0.05, 0.4) if rnd.random() < shaded else rnd.uniform(0.9, 1.0)
+		chargers.append(Charger(size, round(size * sun, 1)))
+	return chargers
+
+def possible(chargers, limit):
+	return min(limit, sum(min(c.available, c.currentlimit) for c in chargers))
+
+def simulate(chargers, limit, ticks=30, tolerance=0.03):
+	""" Runs the distribution for a number of ticks. Returns the tick at
+	    which the total current settled within tolerance of what is
+	    possible, the final total, and the number of writes in the last
+	    third of the run. """
+	target = possible(chargers, limit)
+	settled = None
+	history = []
+	for tick in range(ticks):
+		ChargerSubsystem._distribute_current(chargers, limit)
+		for c in chargers:
+			c.step()
+		total = sum(c.smoothed_current for c in chargers)
+		history.append((total, sum(c.writes for c in chargers)))
+		if abs(total - target) <= tolerance * target:
+			if settled is None:
+				settled = tick + 1
+		else:
+			settled = None
+	tail = ticks - ticks // 3
+	return {
+		'target': round(target, 1),
+		'total': round(history[-1][0], 1),
+		'settled': settled,
+		'writes': history[-1][1] - history[tail - 1][1],
+		'overshoot': round(max(t for t, _ in history) - limit, 1),
+		'assigned': round(sum(c.maxchargecurrent for c in chargers), 1)}
+
+def benchmark(count, repeat=200):
+	""" Median time in microseconds of a distribution over count
+	    chargers. """
+	chargers = fleet(count)
+	for c in chargers:
+		c.smoothed_current = c.available
+	limit = sum(c.currentlimit for c in chargers) * 0.5
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		ChargerSubsystem._distribute_current(chargers, limit)
+		times.append((time.perf_counter() - start) * 1e6)
+	times.sort()
+	return round(times[len(times) // 2], 1)
+
+def run(counts=(2, 5, 10, 20, 40), ratios=(0.3, 0.6, 0.9), seeds=5):
+	results = []
+	for count in counts:
+		for ratio in ratios:
+			for seed in range(seeds):
+				chargers = fleet(count, seed=seed)
+				limit = round(sum(c.currentlimit for c in chargers) * ratio)
+				r = simulate(chargers, limit)
+				r.update(count=count, ratio=ratio, seed=seed)
+				results.append(r)
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--counts', type=int, nargs='+', default=[2, 5, 10, 20, 40])
+	parser.add_argument('--seeds', type=int, default=5)
+	parser.add_argument('--json', action='store_true', help='Output JSON')
+	args = parser.parse_args()
+
+	results = run(counts=args.counts, seeds=args.seeds)
+	timings = {count: benchmark(count) for count in args.counts}
+	if args.json:
+		json.dump({'results': results, 'timings_us': timings}, sys.stdout, indent=1)
+		return
+
+	print('{:>6} {:>6} {:>8} {:>8} {:>9} {:>8}'.format(
+		'count', 'ratio', 'settled', 'error %', 'overshoot', 'writes'))
+	for count in args.counts:
+		for ratio in (0.3, 0.6, 0.9):
+			rs = [r for r in results if r['count'] == count and r['ratio'] == ratio]
+			settled = [r['settled'] for r in rs]
+			print('{:>6} {:>6} {:>8} {:>8.1f} {:>9.1f} {:>8}'.format(count, ratio,
+				'-' if None in settled else max(settled),
+				max(abs(r['total'] - r['target']) / r['target'] * 100 for r in rs),
+				max(r['overshoot'] for r in rs),
+				max(r['writes'] for r in rs)))
+	print()
+	for count, t in timings.items():
+		print('{} chargers: {} us per distribution'.format(count, t))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,57 @@
+import unittest
+
+# This adapts sys.path to include all relevant packages
+import context
+
+import chargerfleet
+from chargerfleet import Charger, fleet, simulate
+from delegates.dvcc import ChargerSubsystem, CURRENT_DEADBAND
+
+class TestChargerFleet(unittest.TestCase):
+	def test_waterfill(self):
+		alloc = ChargerSubsystem._waterfill([1, 1, 2], [1, 10, 10], 9)
+		self.assertEqual(alloc[0], 1)
+		self.assertAlmostEqual(alloc[1], 8 / 3)
+		self.assertAlmostEqual(alloc[2], 16 / 3)
+
+		# Not enough room
+		self.assertEqual(ChargerSubsystem._waterfill([1, 1], [2, 3], 9), [2, 3])
+
+		# No weight, nothing assigned
+		self.assertEqual(ChargerSubsystem._waterfill([0, 1], [5, 5], 4), [0, 4])
+
+	def test_shaded(self):
+		# The charger in the sun gets what the shaded one can't use
+		chargers = [shaded := Charger(50, 10), sunny := Charger(50, 50)]
+		simulate(chargers, 60, ticks=15)
+		self.assertAlmostEqual(shaded.maxchargecurrent, 11, delta=0.3)
+		self.assertAlmostEqual(sunny.maxchargecurrent, 49, delta=0.3)
+		self.assertAlmostEqual(sunny.smoothed_current, 49, delta=0.3)
+
+		# Sun comes out
+		shaded.available = 50
+		simulate(chargers, 60, ticks=15)
+		self.assertAlmostEqual(shaded.maxchargecurrent, 30, delta=0.3)
+		self.assertAlmostEqual(sunny.maxchargecurrent, 30, delta=0.3)
+
+	def test_convergence(self):
+		for count in (5, 20, 40):
+			for ratio in (0.3, 0.6):
+				for seed in range(3):
+					chargers = fleet(count, seed=seed)
+					limit = round(sum(c.currentlimit for c in chargers) * ratio)
+					r = simulate(chargers, limit, tolerance=0.05)
+					msg = 'count={} ratio={} seed={}: {}'.format(count, ratio, seed, r)
+					self.assertIsNotNone(r['settled'], msg)
+					self.assertLessEqual(r['settled'], 15, msg)
+					self.assertLessEqual(r['overshoot'], 0.5, msg)
+					self.assertLessEqual(r['assigned'], limit + CURRENT_DEADBAND, msg)
+
+					# Once settled, limits are not rewritten all the time
+					self.assertLessEqual(r['writes'], count // 4, msg)
+
+	def test_benchmark(self):
+		self.assertGreater(chargerfleet.benchmark(10, repeat=5), 0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+""" Compares the AC consumption calculation of ConsumptionEngine with the
+    implementation it replaced, kept here as reference. Random systems, with
+    or without a VE.Bus system, other inverters, grid and genset meters, and
+    with values missing at random, are run through both, and any
+    difference in the outputs is reported. Then both are timed on a
+    system with a growing number of inverters. """
+import argparse
+import json
+import random
+import sys
+import time
+
+# This adapts sys.path to include all relevant packages
+import context
+
+# Monkey patching for unit tests
+import patches
+
+from consumption import ConsumptionEngine, PHASES
+from sc_utils import safeadd as _safeadd, safemax as _safemax
+
+AC_IN_SOURCES = (None, 0, 1, 2, 3, 0xF0)
+
+class Monitor(object):
+	""" Just enough of a dbusmonitor: values by service and path. """
+	def __init__(self, values=None):
+		self.values = values or {}
+
+	def get_value(self, service, path, default_value=None):
+		v = self.values.get(service, {}).get(path)
+		return default_value if v is None else v
+
+class Meter(object):
+	def __init__(self, service, product_id=None, device_type=None):
+		self.service = service
+		self.product_id = product_id
+		self.device_type = device_type
+
+def _compute_number_of_phases(path, newvalues):
+	number_of_phases = None
+	for phase in range(1, 4):
+		p = newvalues.get('%s/L%s/Power' % (path, phase))
+		if p is not None:
+			number_of_phases = phase
+	newvalues[path + '/NumberOfPhases'] = number_of_phases
+
+def reference(monitor, newvalues, ctx, hasacinloads, useacout):
+	""" The calculation as it was done in SystemCalc._updatevalues. """
+	multi_path = ctx['multi_path']
+	non_vebus_inverters = ctx['non_vebus_inverters']
+	non_vebus_inverter = ctx['non_vebus_inverter']
+	grid_meter = ctx['grid_meter']
+	genset_meter = ctx['genset_meter']
+	ac_in_source = newvalues['/Ac/ActiveIn/Source']
+	active_input = newvalues['active_input']
+
+	ac_in_guess = ac_in_source
+	if ac_in_guess in (None, 0xF0):
+		if genset_meter is None and grid_meter is not None:
+			ac_in_guess = 1
+		elif grid_meter is None and genset_meter is not None:
+			ac_in_guess = 2
+
+	consumption = { "L1" : None, "L2" : None, "L3" : None }
+	currentconsumption = { "L1" : None, "L2" : None, "L3" : None }
+	for device_type, em, _types in (('Grid', grid_meter, (1, 3)), ('Genset', genset_meter, (2,))):
+		uses_active_input = ac_in_source in _types
+		for phase in consumption:
+			p = None
+			mc = None
+			pvpower = newvalues.get('/Ac/PvOn%s/%s/Power' % (device_type, phase))
+			pvcurrent = newvalues.get('/Ac/PvOn%s/%s/Current' % (device_type, phase))
+			if em is not None:
+				p = monitor.get_value(em.service, '/Ac/%s/Power' % phase)
+				mc = monitor.get_value(em.service, '/Ac/%s/Current' % phase)
+				c = None
+				cc = None
+				if uses_active_input:
+					if multi_path is not None:
+						try:
+							c = _safeadd(c, -monitor.get_value(multi_path, '/Ac/ActiveIn/%s/P' % phase))
+							cc = _safeadd(cc, -monitor.get_value(multi_path, '/Ac/ActiveIn/%s/I' % phase))
+						except TypeError:
+							pass
+					if non_vebus_inverter is not None and active_input in (0, 1):
+						for i in non_vebus_inverters:
+							try:
+								c = _safeadd(c, -monitor.get_value(i, '/Ac/In/%d/%s/P' % (active_input+1, phase)))
+								cc = _safeadd(cc, -monitor.get_value(i, '/Ac/In/%d/%s/I' % (active_input+1, phase)))
+							except TypeError:
+								pass
+				c = _safeadd(c, p, pvpower)
+				cc = _safeadd(cc, mc, pvcurrent)
+				consumption[phase] = _safeadd(consumption[phase], _safemax(0, c))
+				currentconsumption[phase] = _safeadd(currentconsumption[phase], _safemax(0, cc))
+			else:
+				if uses_active_input:
+					if multi_path is not None:
+						vebus_ain_p = monitor.get_value(multi_path, '/Ac/ActiveIn/%s/P' % phase)
+						if vebus_ain_p is not None:
+							p = _safeadd(p, vebus_ain_p)
+							mc = _safeadd(mc, monitor.get_value(multi_path, '/Ac/ActiveIn/%s/I' % phase))
+					if non_vebus_inverter is not None and active_input in (0, 1):
+						for i in non_vebus_inverters:
+							p = _safeadd(p,
+								monitor.get_value(i, '/Ac/In/%d/%s/P' % (active_input + 1, phase)))
+							mc = _safeadd(mc,
+								monitor.get_value(i, '/Ac/In/%d/%s/I' % (active_input + 1, phase)))
+					if p is not None:
+						consumption[phase] = _safeadd(0, consumption[phase])
+						currentconsumption[phase] = _safeadd(0, currentconsumption[phase])
+				try:
+					p = _safeadd(p, -pvpower)
+					mc = _safeadd(mc, -pvcurrent)
+				except TypeError:
+					pass
+
+			newvalues['/Ac/%s/%s/Power' % (device_type, phase)] = p
+			newvalues['/Ac/%s/%s/Current' % (device_type, phase)] = mc
+			if ac_in_guess in _types:
+				newvalues['/Ac/ActiveIn/%s/Power' % phase] = p
+				newvalues['/Ac/ActiveIn/%s/Current' % phase] = mc
+
+		_compute_number_of_phases('/Ac/' + device_type, newvalues)
+		_compute_number_of_phases('/Ac/ActiveIn', newvalues)
+
+		product_id = None
+		device_type_id = None
+		if em is not None:
+			product_id = em.product_id
+			device_type_id = em.device_type
+		if product_id is None and uses_active_input:
+			if multi_path is not None:
+				product_id = monitor.get_value(multi_path, '/ProductId')
+			elif non_vebus_inverter is not None:
+				product_id = monitor.get_value(non_vebus_inverter, '/ProductId')
+		newvalues['/Ac/' + device_type + '/ProductId'] = product_id
+		newvalues['/Ac/' + device_type + '/DeviceType'] = device_type_id
+
+	has_ac_in_system = hasacinloads == 1
+	use_ac_out = \
+		not has_ac_in_system or \
+		useacout == 1 or \
+		(multi_path is not None and monitor.get_value(multi_path, '/Hub4/AssistantId') not in (4, 5)) or \
+		monitor.get_value('com.victronenergy.settings', '/Settings/CGwacs/RunWithoutGridMeter') == 1
+	for phase in consumption:
+		c = None
+		a = None
+		if use_ac_out:
+			c = newvalues.get('/Ac/PvOnOutput/%s/Power' % phase)
+			a = newvalues.get('/Ac/PvOnOutput/%s/Current' % phase)
+			if multi_path is not None:
+				c = _safeadd(c, monitor.get_value(multi_path, '/Ac/Out/%s/P' % phase))
+				a = _safeadd(a, monitor.get_value(multi_path, '/Ac/Out/%s/I' % phase))
+			for inv in non_vebus_inverters:
+				ac_out = monitor.get_value(inv, '/Ac/Out/%s/P' % phase)
+				i = monitor.get_value(inv, '/Ac/Out/%s/I' % phase)
+				if ac_out is None:
+					ac_out = monitor.get_value(inv, '/Ac/Out/%s/S' % phase)
+					if ac_out is None:
+						u = monitor.get_value(inv, '/Ac/Out/%s/V' % phase)
+						if None not in (i, u):
+							ac_out = i * u
+				c = _safeadd(c, ac_out)
+				a = _safeadd(a, i)
+			c = _safemax(0, c)
+			a = _safemax(0, a)
+		newvalues['/Ac/ConsumptionOnOutput/%s/Power' % phase] = c
+		newvalues['/Ac/ConsumptionOnOutput/%s/Current' % phase] = a
+		newvalues['/Ac/Consumption/%s/Power' % phase] = _safeadd(consumption[phase], c)
+		newvalues['/Ac/Consumption/%s/Current' % phase] = _safeadd(currentconsumption[phase], a)
+		if has_ac_in_system:
+			newvalues['/Ac/ConsumptionOnInput/%s/Power' % phase] = consumption[phase]
+			newvalues['/Ac/ConsumptionOnInput/%s/Current' % phase] = currentconsumption[phase]
+
+	_compute_number_of_phases('/Ac/Consumption', newvalues)
+	_compute_number_of_phases('/Ac/ConsumptionOnOutput', newvalues)
+	_compute_number_of_phases('/Ac/ConsumptionOnInput', newvalues)
+
+def system(rnd, inverters=None, missing=0.2):
+	""" Returns the monitor, the graph values and the ctx of a random
+	    system. Values are left out with a chance of missing. """
+	def value(scale):
+		return None if rnd.random() < missing else round(rnd.uniform(-scale, scale), 1)
+
+	values = {}
+	multi = 'com.victronenergy.vebus.ttyO1' if rnd.random() < 0.6 else None
+	if inverters is None:
+		inverters = rnd.choice((0, 0, 1, 2, 3))
+	others = ['com.victronenergy.multi.ttyS{}'.format(n) for n in range(inverters)]
+	meters = [Meter(s, rnd.choice((None, 0xB012)), rnd.choice((None, 71))) \
+		if rnd.random() < 0.5 else None for s in (
+			'com.victronenergy.grid.cgwacs_ttyUSB0', 'com.victronenergy.genset.cgwacs_ttyUSB1')]
+
+	for m in meters:
+		if m is not None:
+			values[m.service] = {'/Ac/%s/%s' % (ph, q): value(2000 if q == 'Power' else 10) \
+				for ph in PHASES for q in ('Power', 'Current')}
+	if multi is not None:
+		values[multi] = {'/Ac/%s/%s/%s' % (d, ph, q): value(3000 if q == 'P' else 12) \
+			for d in ('ActiveIn', 'Out') for ph in PHASES for q in ('P', 'I')}
+		values[multi].update({'/ProductId': 0x2623, '/Hub4/AssistantId': rnd.choice((None, 3, 4, 5))})
+	for s in others:
+		values[s] = {'/Ac/%s/%s/%s' % (d, ph, q): value(3000 if q in 'PS' else 240 if q == 'V' else 12) \
+			for d in ('In/1', 'In/2', 'Out') for ph in PHASES for q in ('P', 'I', 'S', 'V')}
+		values[s]['/ProductId'] = 0xA442
+	values['com.victronenergy.settings'] = {
+		'/Settings/CGwacs/RunWithoutGridMeter': rnd.choice((None, 0, 1))}
+
+	newvalues = {'/Ac/ActiveIn/Source': rnd.choice(AC_IN_SOURCES),
+		'active_input': rnd.choice((None, 0, 1, 2))}
+	for pos in ('Grid', 'Genset', 'Output'):
+		for ph in PHASES:
+			if rnd.random() < 0.3:
+				newvalues['/Ac/PvOn%s/%s/Power' % (pos, ph)] = value(1000)
+				newvalues['/Ac/PvOn%s/%s/Current' % (pos, ph)] = value(5)
+
+	ctx = {
+		'multi_path': multi,
+		'non_vebus_inverters': others,
+		'non_vebus_inverter': others[0] if others else None,
+		'grid_meter': meters[0],
+		'genset_meter': meters[1]}
+	return Monitor(values), newvalues, ctx
+
+def _engine(monitor, ctx):
+	engine = ConsumptionEngine(monitor)
+	engine.bind(ctx['multi_path'], ctx['non_vebus_inverters'],
+		getattr(ctx['grid_meter'], 'service', None),
+		getattr(ctx['genset_meter'], 'service', None))
+	return engine
+
+def _run_engine(engine, newvalues, ctx, hasacinloads, useacout):
+	engine.update(newvalues, ctx['grid_meter'], ctx['genset_meter'],
+		newvalues['/Ac/ActiveIn/Source'], newvalues['active_input'],
+		hasacinloads == 1, useacout == 1)
+
+def compare(count=1000, seed=0):
+	""" Runs count random systems through both implementations. Returns a
+	    list of (system, path, reference value, engine value) for every
+	    output that differs. """
+	rnd = random.Random(seed)
+	differences = []
+	for n in range(count):
+		monitor, values, ctx = system(rnd)
+		hasacinloads, useacout = rnd.choice((0, 1)), rnd.choice((0, 1))
+		expected, actual = dict(values), dict(values)
+		reference(monitor, expected, ctx, hasacinloads, useacout)
+		_run_engine(_engine(monitor, ctx), actual, ctx, hasacinloads, useacout)
+
+		# A value left out is published as None
+		for path in set(expected) | set(actual):
+			if expected.get(path) != actual.get(path):
+				differences.append((n, path, expected.get(path), actual.get(path)))
+	return differences
+
+def benchmark(inverters, repeat=200):
+	""" Median time in microseconds of a calculation by the reference and
+	    by the engine, on a system with a VE.Bus system, a grid meter and a
+	    number of other inverters. """
+	rnd = random.Random(inverters)
+	while True:
+		monitor, values, ctx = system(rnd, inverters=inverters, missing=0)
+		if ctx['multi_path'] is not None and ctx['grid_meter'] is not None:
+			break
+	values.update({'/Ac/ActiveIn/Source': 1, 'active_input': 0})
+	engine = _engine(monitor, ctx)
+
+	times = ([], [])
+	for _ in range(repeat):
+		start = time.perf_counter()
+		reference(monitor, dict(values), ctx, 1, 0)
+		times[0].append((time.perf_counter() - start) * 1e6)
+		start = time.perf_counter()
+		_run_engine(engine, dict(values), ctx, 1, 0)
+		times[1].append((time.perf_counter() - start) * 1e6)
+	for t in times:
+		t.sort()
+	return tuple(round(t[len(t) // 2], 1) for t in times)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--inverters', type=int, nargs='+', default=[0, 1, 3, 10, 30])
+	parser.add_argument('--systems', type=int, default=5000,
+		help='Number of random systems to compare')
+	parser.add_argument('--json', action='store_true', help='Output JSON')
+	args = parser.parse_args()
+
+	differences = compare(args.systems)
+	timings = {n: benchmark(n) for n in args.inverters}
+	if args.json:
+		json.dump({'differences': differences, 'timings_us': timings}, sys.stdout, indent=1)
+		return
+
+	for d in differences[:20]:
+		print('system {}: {} reference {} engine {}'.format(*d))
+	print('{} systems compared, {} differences'.format(args.systems, len(differences)))
+	print()
+	print('{:>9} {:>14} {:>11} {:>8}'.format('inverters', 'reference us', 'engine us', 'speedup'))
+	for n, (ref, eng) in timings.items():
+		print('{:>9} {:>14} {:>11} {:>8.1f}'.format(n, ref, eng, ref / eng))
+
+if __name__ == '__main__':
+	main()
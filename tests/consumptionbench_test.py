@@ -0,0 +1,20 @@
+import unittest
+
+# This adapts sys.path to include all relevant packages
+import context
+
+import consumptionbench
+
+class TestConsumptionEngine(unittest.TestCase):
+	def test_same_as_reference(self):
+		for seed in range(3):
+			differences = consumptionbench.compare(1000, seed=seed)
+			self.assertEqual(differences[:5], [], 'seed={}'.format(seed))
+
+	def test_benchmark(self):
+		reference, engine = consumptionbench.benchmark(3, repeat=5)
+		self.assertGreater(reference, 0)
+		self.assertGreater(engine, 0)
+
+if __name__ == '__main__':
+	unittest.main()
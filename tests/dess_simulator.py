@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+""" Runs DynamicEss in MockSystemCalc against a schedule with load, PV and
+    prices, on a virtual clock, and reports per interval the reactive
+    strategy chosen, the SoC, the energy taken from and fed into the grid
+    and what that cost. A week of schedules runs in seconds.
+
+    The schedule is a CSV file with a row per interval:
+        time         start of the interval, epoch seconds or ISO 8601
+        load, pv     average power in W
+        buy, sell    price per kWh
+        soc          target soc at the end of the interval
+        strategy, restrictions, allowfeedin, flags
+                     as in /Settings/DynamicEss/Schedule/n
+    Only time is mandatory, the other columns default to 0. """
+import argparse
+import csv
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+# This adapts sys.path to include all relevant packages
+import context
+
+# Testing tools
+from mock_gobject import timer_manager
+from base import MockSystemCalc
+
+# our own packages
+from delegates import BatteryLife, Dvcc, DynamicEss
+from delegates.dynamicess import NUM_SCHEDULES, HUB4_SERVICE, ReactiveStrategy
+from writequeue import WriteQueue
+
+# Monkey patching for unit tests
+import patches
+
+SETTINGS_SERVICE = 'com.victronenergy.settings'
+GRID_SERVICE = 'com.victronenergy.grid.sim'
+PVINVERTER_SERVICE = 'com.victronenergy.pvinverter.sim'
+BATTERY_SERVICE = 'com.victronenergy.battery.sim'
+VEBUS_SERVICE = 'com.victronenergy.vebus.sim'
+MULTI_SERVICE = 'com.victronenergy.multi.sim'
+ACSYSTEM_SERVICE = 'com.victronenergy.acsystem.sim'
+VOLTAGE = 52.0
+
+COLUMNS = ('load', 'pv', 'buy', 'sell', 'soc', 'strategy', 'restrictions',
+	'allowfeedin', 'flags')
+
+def _parse_time(v):
+	try:
+		return int(float(v))
+	except ValueError:
+		return int(datetime.fromisoformat(v).timestamp())
+
+def read_schedule(path):
+	""" Reads a schedule as described above. Returns a list of dicts, one
+	    for each interval, with start and duration in seconds. """
+	with open(path, newline='') as f:
+		rows = []
+		for r in csv.DictReader(f):
+			row = {k: float(r.get(k) or 0) for k in COLUMNS}
+			row['start'] = _parse_time(r['time'])
+			rows.append(row)
+	rows.sort(key=lambda r: r['start'])
+	for r, n in zip(rows, rows[1:]):
+		r['duration'] = n['start'] - r['start']
+	if rows:
+		rows[-1]['duration'] = rows[-2]['duration'] if len(rows) > 1 else 900
+	return rows
+
+def _device(service, instance, values):
+	values.update({
+		'/Connected': 1,
+		'/ProductName': 'Simulated',
+		'/Mgmt/Connection': 'Simulated',
+		'/DeviceInstance': instance})
+	return service, values
+
+class Battery(object):
+	""" The battery, and the inverter/charger in front of it, reduced to
+	    how much power flows in or out. Power is positive when charging,
+	    and on the DC side, the AC side sees the losses on top. """
+	def __init__(self, capacity, soc, maxcharge, maxdischarge, efficiency):
+		self.capacity = capacity * 1000.0 # Wh
+		self.soc = soc
+		self.maxcharge = maxcharge
+		self.maxdischarge = maxdischarge
+		self.efficiency = efficiency # One way
+		self.power = 0.0
+
+	def to_dc(self, ac):
+		return ac * self.efficiency if ac > 0 else ac / self.efficiency
+
+	def to_ac(self, dc):
+		return dc / self.efficiency if dc > 0 else dc * self.efficiency
+
+	def run(self, power, minsoc, seconds):
+		""" Charges (power > 0) or discharges the battery for seconds, as
+		    far as its limits and its soc allow. Returns the DC power. """
+		hours = seconds / 3600.0
+		power = min(power, self.maxcharge,
+			(100.0 - self.soc) / 100.0 * self.capacity / hours)
+		power = max(power, -self.maxdischarge,
+			min(0.0, (minsoc - self.soc) / 100.0 * self.capacity / hours))
+		self.soc += power * hours / self.capacity * 100.0
+		self.power = power
+		return power
+
+class Simulator(object):
+	""" Drives DynamicEss through the schedule in steps of step seconds.
+	    The real VebusDevice or MultiRsDevice controls the system, this
+	    models what a Multi would do with the overrides they write, and
+	    feeds the result back in as the values of the simulated devices. """
+	def __init__(self, rows, device='vebus', capacity=10.0, soc=50.0,
+			maxcharge=5000.0, maxdischarge=5000.0, efficiency=90.0, minsoc=10.0,
+			step=60):
+		self.rows = rows
+		self.device = device
+		self.step = step
+		self.minsoc = minsoc
+		self.now = rows[0]['start'] if rows else 0
+		self.battery = Battery(capacity, soc, maxcharge, maxdischarge,
+			min(1.0, 1.0 - (100.0 - efficiency) / 200.0))
+
+		timer_manager.reset()
+		self.systemcalc = MockSystemCalc()
+		self.monitor = self.systemcalc._dbusmonitor
+		self.settings = self.systemcalc._settings
+		self._add_devices()
+		self.settings['dess_capacity'] = capacity
+		self.settings['dess_efficiency'] = efficiency
+		self.settings['dess_batterychargelimit'] = maxcharge / 1000.0
+		self.settings['dess_batterydischargelimit'] = maxdischarge / 1000.0
+		self.settings['dess_gridimportlimit'] = 9999.9
+		self.settings['dess_gridexportlimit'] = 9999.9
+		self._loaded = 0
+		self._load_windows(0)
+
+		# The clock is our own, let the delegates settle before taking over
+		get_time = lambda: datetime.fromtimestamp(self.now)
+		DynamicEss.instance._get_time = BatteryLife.instance._get_time = get_time
+		DynamicEss.instance._get_monotonic = lambda: self.now
+		timer_manager.run(5000)
+		self.dess = DynamicEss.instance
+		self.settings['dess_mode'] = 1
+
+	def _add_devices(self):
+		m = self.monitor
+		m.add_service(SETTINGS_SERVICE, {
+			'/Settings/CGwacs/Hub4Mode': 1,
+			'/Settings/CGwacs/MaxFeedInPower': -1,
+			'/Settings/CGwacs/PreventFeedback': 0,
+			'/Settings/CGwacs/BatteryLife/MinimumSocLimit': self.minsoc,
+			'/Settings/SystemSetup/AcInput1': 1})
+		m.add_service(*_device(GRID_SERVICE, 30, {'/Ac/L1/Power': 0, '/Ac/L1/Current': 0}))
+		m.add_service(*_device(PVINVERTER_SERVICE, 20, {
+			'/Position': 0, '/Ac/L1/Power': 0, '/Ac/L1/Current': 0}))
+		m.add_service(*_device(BATTERY_SERVICE, 512, {
+			'/Soc': self.battery.soc,
+			'/Dc/0/Voltage': VOLTAGE,
+			'/Dc/0/Current': 0,
+			'/Dc/0/Power': 0,
+			'/Info/MaxChargeCurrent': self.battery.maxcharge / VOLTAGE,
+			'/Info/MaxDischargeCurrent': self.battery.maxdischarge / VOLTAGE,
+			'/Info/MaxChargeVoltage': 55.2}))
+
+		if self.device == 'vebus':
+			m.add_service(*_device(HUB4_SERVICE, 0, {
+				'/Overrides/ForceCharge': 0,
+				'/Overrides/MaxDischargePower': -1,
+				'/Overrides/Setpoint': None,
+				'/Overrides/FeedInExcess': 0}))
+			m.add_service(*_device(VEBUS_SERVICE, 0, {
+				'/Devices/0/Assistants': [0x55, 0x1] + (26 * [0]),
+				'/Hub4/AssistantId': 5,
+				'/VebusMainState': 9,
+				'/State': 3,
+				'/Ac/ActiveIn/ActiveInput': 0,
+				'/Ac/ActiveIn/Connected': 1,
+				'/Ac/ActiveIn/L1/P': 0,
+				'/Ac/ActiveIn/L1/I': 0,
+				'/Ac/Out/L1/P': 0,
+				'/Ac/NumberOfAcInputs': 1,
+				'/Dc/0/Voltage': VOLTAGE,
+				'/Dc/0/Current': 0,
+				'/ExtraBatteryCurrent': 0}))
+		else:
+			# The units publish their measurements as .multi, the
+			# acsystem takes the ESS control.
+			m.add_service(*_device(MULTI_SERVICE, 0, {
+				'/State': 3,
+				'/Ac/ActiveIn/ActiveInput': 0,
+				'/Ac/In/1/Type': 1,
+				'/Ac/In/1/L1/P': 0,
+				'/Ac/In/1/L1/I': 0,
+				'/Ac/Out/L1/P': 0}))
+			m.add_service(*_device(ACSYSTEM_SERVICE, 0, {
+				'/Capabilities/HasDynamicEssSupport': 1,
+				'/Settings/Ess/Mode': 1,
+				'/Settings/Ess/MinimumSocLimit': self.minsoc,
+				'/Ess/AcPowerSetpoint': 0,
+				'/Ess/InverterPowerSetpoint': 0,
+				'/Ess/UseInverterPowerSetpoint': 0,
+				'/Ess/DisableCharge': 0,
+				'/Ess/DisableDischarge': 0,
+				'/Ess/DisableFeedIn': 0}))
+
+	def _load_windows(self, index):
+		""" Makes sure the windows of the intervals from index on are in
+		    the settings, as far as they fit. Like VRM, this keeps the
+		    schedule filled NUM_SCHEDULES intervals ahead. Interval i goes
+		    in slot i % NUM_SCHEDULES. """
+		end = min(len(self.rows), index + NUM_SCHEDULES)
+		for i in range(max(self._loaded, index), end):
+			r = self.rows[i]
+			slot = i % NUM_SCHEDULES
+			for setting, value in (
+					('start', r['start']),
+					('duration', r['duration']),
+					('targetsoc', r['soc']),
+					('discharge', int(r['allowfeedin'])),
+					('restrictions', int(r['restrictions'])),
+					('strategy', int(r['strategy'])),
+					('flags', int(r['flags']))):
+				self.settings['dess_{}_{}'.format(setting, slot)] = value
+		self._loaded = max(self._loaded, end)
+
+	def _publish(self, load, pv, battery, grid):
+		""" Publishes the state of the system on the simulated devices.
+		    Everything sits on AC in, the load as well. """
+		m = self.monitor
+		m.set_value(GRID_SERVICE, '/Ac/L1/Power', grid)
+		m.set_value(PVINVERTER_SERVICE, '/Ac/L1/Power', pv)
+		m.set_value(BATTERY_SERVICE, '/Soc', self.battery.soc)
+		m.set_value(BATTERY_SERVICE, '/Dc/0/Power', self.battery.power)
+		m.set_value(BATTERY_SERVICE, '/Dc/0/Current', self.battery.power / VOLTAGE)
+		if self.device == 'vebus':
+			m.set_value(VEBUS_SERVICE, '/Ac/ActiveIn/L1/P', battery)
+			m.set_value(VEBUS_SERVICE, '/Dc/0/Current', self.battery.power / VOLTAGE)
+		else:
+			m.set_value(MULTI_SERVICE, '/Ac/In/1/L1/P', battery)
+
+	def _vebus(self, load, pv):
+		""" What a Multi does with the hub4 overrides. Returns the DC power
+		    it wants to charge the battery with, and its minimum soc. """
+		m = self.monitor
+		chargelimit = Dvcc.instance.internal_maxchargepower
+		chargelimit = self.battery.maxcharge if chargelimit is None else chargelimit
+		if m.get_value(HUB4_SERVICE, '/Overrides/ForceCharge'):
+			power = chargelimit
+		else:
+			setpoint = m.get_value(HUB4_SERVICE, '/Overrides/Setpoint') or 0
+			power = min(self.battery.to_dc(setpoint - load + pv), chargelimit)
+			maxdischarge = m.get_value(HUB4_SERVICE, '/Overrides/MaxDischargePower')
+			if maxdischarge is not None and maxdischarge >= 0:
+				power = max(power, -maxdischarge)
+		minsoc = self.systemcalc._dbusservice['/Control/ActiveSocLimit']
+		return power, self.minsoc if minsoc is None else minsoc
+
+	def _multirs(self, load, pv):
+		""" As _vebus, with what a Multi-RS does with the /Ess paths. """
+		m = self.monitor
+		setpoint = m.get_value(ACSYSTEM_SERVICE, '/Ess/AcPowerSetpoint') or 0
+		power = self.battery.to_dc(setpoint - load + pv)
+		if m.get_value(ACSYSTEM_SERVICE, '/Ess/DisableCharge'):
+			power = min(power, 0)
+		if m.get_value(ACSYSTEM_SERVICE, '/Ess/DisableDischarge'):
+			power = max(power, 0)
+		if m.get_value(ACSYSTEM_SERVICE, '/Ess/DisableFeedIn') and power < 0:
+			# The battery does not feed in, it only backs the load
+			power = max(power, self.battery.to_dc(min(0, pv - load)))
+		return power, m.get_value(ACSYSTEM_SERVICE, '/Settings/Ess/MinimumSocLimit')
+
+	def run(self):
+		""" Runs the whole schedule. Returns a list with a dict for every
+		    interval. """
+		results = []
+		battery = grid = 0.0
+		control = self._vebus if self.device == 'vebus' else self._multirs
+		for index, row in enumerate(self.rows):
+			self._load_windows(index)
+			strategies = Counter()
+			result = {
+				'time': row['start'],
+				'startsoc': self.battery.soc,
+				'targetsoc': row['soc'],
+				'import': 0.0,
+				'export': 0.0}
+			end = row['start'] + row['duration']
+			self.now = row['start']
+			while self.now < end:
+				seconds = min(self.step, end - self.now)
+				self._publish(row['load'], row['pv'], battery, grid)
+				self.systemcalc._updatevalues()
+				self.dess._on_timer()
+				WriteQueue.instance.flush()
+				strategies[self.systemcalc._dbusservice['/DynamicEss/ReactiveStrategy']] += seconds
+
+				power, minsoc = control(row['load'], row['pv'])
+				battery = self.battery.to_ac(self.battery.run(power, minsoc, seconds))
+				grid = row['load'] - row['pv'] + battery
+				energy = grid * seconds / 3600000.0 # kWh
+				if energy > 0:
+					result['import'] += energy
+				else:
+					result['export'] -= energy
+				self.now += seconds
+
+			strategy = strategies.most_common(1)[0][0] if strategies else None
+			result.update(
+				strategy=None if strategy is None else ReactiveStrategy(strategy).name,
+				endsoc=self.battery.soc,
+				cost=result['import'] * row['buy'] - result['export'] * row['sell'])
+			results.append(result)
+		return results
+
+def totals(results):
+	return {
+		'import': sum(r['import'] for r in results),
+		'export': sum(r['export'] for r in results),
+		'cost': sum(r['cost'] for r in results)}
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__,
+		formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('schedule', help='CSV file with the schedule, load, PV and prices')
+	parser.add_argument('-d', '--device', choices=('vebus', 'multirs'), default='vebus',
+		help='the ESS device DynamicEss controls (default %(default)s)')
+	parser.add_argument('--capacity', type=float, default=10.0,
+		help='battery capacity in kWh (default %(default)s)')
+	parser.add_argument('--soc', type=float, default=50.0,
+		help='soc at the start (default %(default)s)')
+	parser.add_argument('--minsoc', type=float, default=10.0,
+		help='ESS minimum soc (default %(default)s)')
+	parser.add_argument('--maxcharge', type=float, default=5000.0,
+		help='battery charge limit in W (default %(default)s)')
+	parser.add_argument('--maxdischarge', type=float, default=5000.0,
+		help='battery discharge limit in W (default %(default)s)')
+	parser.add_argument('--efficiency', type=float, default=90.0,
+		help='round trip efficiency in percent (default %(default)s)')
+	parser.add_argument('--step', type=int, default=60,
+		help='seconds between two runs of DynamicEss (default %(default)s)')
+	parser.add_argument('-o', '--output', metavar='FILE',
+		help='write the results per interval to FILE, as CSV')
+	args = parser.parse_args()
+
+	rows = read_schedule(args.schedule)
+	if not rows:
+		sys.exit('{}: no intervals'.format(args.schedule))
+
+	start = time.perf_counter()
+	simulator = Simulator(rows, args.device, args.capacity, args.soc,
+		args.maxcharge, args.maxdischarge, args.efficiency, args.minsoc, args.step)
+	results = simulator.run()
+	walltime = time.perf_counter() - start
+
+	fields = ('time', 'strategy', 'startsoc', 'endsoc', 'targetsoc', 'import', 'export', 'cost')
+	if args.output:
+		with open(args.output, 'w', newline='') as f:
+			writer = csv.DictWriter(f, fields, extrasaction='ignore')
+			writer.writeheader()
+			writer.writerows(results)
+
+	print('{:<20} {:<40} {:>6} {:>6} {:>8} {:>8} {:>8}'.format(
+		'Time', 'Strategy', 'Soc', 'Target', 'Import', 'Export', 'Cost'))
+	for r in results:
+		print('{:<20} {:<40} {:>6.1f} {:>6.1f} {:>8.3f} {:>8.3f} {:>8.3f}'.format(
+			datetime.fromtimestamp(r['time']).strftime('%Y-%m-%d %H:%M'),
+			r['strategy'] or '-', r['endsoc'], r['targetsoc'],
+			r['import'], r['export'], r['cost']))
+	t = totals(results)
+	print('\n{} intervals simulated in {:.2f} s'.format(len(results), walltime))
+	print('Imported {import:.3f} kWh, exported {export:.3f} kWh, cost {cost:.3f}'.format(**t))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+# This adapts sys.path to include all relevant packages
+import context
+
+# our own packages
+from dess_simulator import Simulator, read_schedule, totals
+
+# Monkey patching for unit tests
+import patches
+
+START = 1760000400
+SCHEDULE = """time,load,pv,buy,sell,soc,strategy,restrictions,allowfeedin,flags
+{0},500,0,0.10,0.05,60,0,0,1,0
+{1},500,0,0.10,0.05,60,0,0,1,0
+{2},500,0,0.30,0.20,50,0,0,1,0
+{3},500,0,0.30,0.20,50,0,0,1,0
+""".format(*(START + i * 900 for i in range(4)))
+
+class TestDessSimulator(unittest.TestCase):
+	def setUp(self):
+		fd, self.path = tempfile.mkstemp(suffix='.csv')
+		with os.fdopen(fd, 'w') as f:
+			f.write(SCHEDULE)
+
+	def tearDown(self):
+		os.unlink(self.path)
+
+	def test_read_schedule(self):
+		rows = read_schedule(self.path)
+		self.assertEqual(len(rows), 4)
+		self.assertEqual(rows[0]['start'], START)
+		self.assertEqual([r['duration'] for r in rows], [900] * 4)
+		self.assertEqual(rows[2]['soc'], 50)
+		self.assertEqual(rows[2]['sell'], 0.2)
+
+	def _simulate(self, device):
+		results = Simulator(read_schedule(self.path), device, capacity=10.0,
+			soc=50.0, maxcharge=3000.0, maxdischarge=3000.0).run()
+		self.assertEqual(len(results), 4)
+
+		# Charge from the grid towards 60%, then sell down to 50%
+		self.assertEqual(results[0]['strategy'], 'SCHEDULED_CHARGE_ALLOW_GRID')
+		self.assertGreater(results[0]['endsoc'], results[0]['startsoc'])
+		self.assertAlmostEqual(results[1]['endsoc'], 60, delta=1)
+		self.assertGreater(results[0]['import'], 0.5)
+		self.assertEqual(results[2]['strategy'], 'SCHEDULED_DISCHARGE')
+		self.assertLess(results[2]['endsoc'], results[2]['startsoc'])
+		self.assertGreater(results[2]['export'], 0)
+		self.assertAlmostEqual(results[3]['endsoc'], 50, delta=1)
+
+		t = totals(results)
+		self.assertAlmostEqual(t['cost'],
+			sum(r['import'] * b - r['export'] * s for r, b, s in zip(results,
+				(0.1, 0.1, 0.3, 0.3), (0.05, 0.05, 0.2, 0.2))))
+
+	def test_vebus(self):
+		self._simulate('vebus')
+
+	def test_multirs(self):
+		self._simulate('multirs')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -21,6 +21,7 @@ import logging
 
 # Time travel patch
 DynamicEss._get_time = lambda *a: timer_manager.datetime
+DynamicEss._get_monotonic = lambda *a: timer_manager.time / 1000.0
 
 class TestDynamicEss(TestSystemCalcBase):
 	vebus = 'com.victronenergy.vebus.ttyO1'
@@ -235,10 +236,12 @@ class TestDynamicEss(TestSystemCalcBase):
 		#Simple test-cases: No AC, DC or consumption, no restrictions.
 		#Calculated Grid Setpoint should equal desired Battery charge plus efficiency offset.
 		mock.charge(Flags.NONE,Restrictions.NONE,2500,True)
+		self._flush_writes()
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 2500 / 0.95)
 
 		#grid2bat restriction -> Setpoint should be 0.
 		mock.charge(Flags.NONE,Restrictions.GRID2BAT,2500,True)
+		self._flush_writes()
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 0)
 
 		#tests with 500 consumption
@@ -246,6 +249,7 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._monitor.set_value("com.victronenergy.grid.ttyUSB0", '/Ac/L1/Power', 500.0)
 		self._update_values()
 		mock.charge(Flags.NONE,Restrictions.NONE,2500,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 500)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 2500 / 0.95 + 500)
 
@@ -254,6 +258,7 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._monitor.set_value("com.victronenergy.grid.ttyUSB0", '/Ac/L1/Power', 0)
 		self._update_values()
 		mock.charge(Flags.NONE,Restrictions.NONE,2500,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 500)
 		self.assertEqual(mock.acpv, 500)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 2500 / 0.95)
@@ -265,6 +270,7 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._monitor.set_value("com.victronenergy.grid.ttyUSB0", '/Ac/L1/Power', -500)
 		self._update_values()
 		mock.charge(Flags.NONE,Restrictions.NONE,2500,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 500)
 		self.assertEqual(mock.acpv, 1000)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , (2500 - 500 * 0.95) / 0.95)
@@ -279,6 +285,7 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._set_setting('/Settings/DynamicEss/BatteryDischargeLimit', 30)
 		self._update_values()
 		mock.charge(Flags.NONE,Restrictions.NONE,9999,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 0)
 		self.assertEqual(mock.acpv, 0)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 6000 / 0.95)
@@ -293,6 +300,7 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._set_setting('/Settings/DynamicEss/BatteryDischargeLimit', 30)
 		self._update_values()
 		mock.charge(Flags.NONE,Restrictions.NONE,9999,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 0)
 		self.assertEqual(mock.acpv, 0)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 6000)
@@ -303,12 +311,14 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._monitor.set_value("com.victronenergy.grid.ttyUSB0", '/Ac/L1/Power', -8000)
 		self._update_values()
 		mock.charge(Flags.NONE,Restrictions.NONE,4000,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 0)
 		self.assertEqual(mock.acpv, 8000)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , (8000 - 4000/0.95) * -1)
 
 		#... and 0, if we don't allow Feedin ;)
 		mock.charge(Flags.NONE,Restrictions.NONE,4000,False)
+		self._flush_writes()
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 0)
 
 	def test_0_RS_Idle_no_external_mppts(self):
@@ -483,10 +493,12 @@ class TestDynamicEss(TestSystemCalcBase):
 		#Simple test-cases: No AC, DC or consumption, no restrictions.
 		#Discharging 2500 means, we need to set a slightly lower GSP: 2500 * 0,95
 		mock.discharge(Flags.NONE,Restrictions.NONE,2500,True)
+		self._flush_writes()
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 2500 * -0.95)
 
 		#bat2grid restriction -> Setpoint should be 0.
 		mock.discharge(Flags.NONE,Restrictions.BAT2GRID,2500,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 0)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 0)
 
@@ -495,6 +507,7 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._monitor.set_value("com.victronenergy.grid.ttyUSB0", '/Ac/L1/Power', 500.0)
 		self._update_values()
 		mock.discharge(Flags.NONE,Restrictions.NONE,2500,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 500)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , (2500 * 0.95 - 500) * -1)
 
@@ -503,6 +516,7 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._monitor.set_value("com.victronenergy.grid.ttyUSB0", '/Ac/L1/Power', 0)
 		self._update_values()
 		mock.discharge(Flags.NONE,Restrictions.NONE,2500,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 500)
 		self.assertEqual(mock.acpv, 500)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , (2500 * 0.95) * -1)
@@ -512,6 +526,7 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._monitor.set_value("com.victronenergy.grid.ttyUSB0", '/Ac/L1/Power', -500)
 		self._update_values()
 		mock.discharge(Flags.NONE,Restrictions.NONE,2500,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 500)
 		self.assertEqual(mock.acpv, 1000)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 2500 * -0.95 - 500)
@@ -526,6 +541,7 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._set_setting('/Settings/DynamicEss/BatteryDischargeLimit', 6)
 		self._update_values()
 		mock.discharge(Flags.NONE,Restrictions.NONE,9999,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 0)
 		self.assertEqual(mock.acpv, 0)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 6000 * -0.95)
@@ -540,6 +556,7 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._set_setting('/Settings/DynamicEss/BatteryDischargeLimit', 30)
 		self._update_values()
 		mock.discharge(Flags.NONE,Restrictions.NONE,9000,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 0)
 		self.assertEqual(mock.acpv, 0)
 		self.assertEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , 6000 * -1)
@@ -551,6 +568,7 @@ class TestDynamicEss(TestSystemCalcBase):
 		self._monitor.set_value("com.victronenergy.grid.ttyUSB0", '/Ac/L1/Power', 0)
 		self._update_values()
 		mock.discharge(Flags.NONE,Restrictions.BAT2GRID,2000,True)
+		self._flush_writes()
 		self.assertEqual(mock.consumption, 500)
 		self.assertEqual(mock.acpv, 500)
 		self.assertAlmostEqual(self._monitor.get_value(self.rs_service,'/Ess/AcPowerSetpoint') , -500, 4)
@@ -1577,6 +1595,171 @@ class TestDynamicEss(TestSystemCalcBase):
 		self.assertEqual(self._monitor.get_value('com.victronenergy.hub4','/Overrides/Setpoint') , -6100)
 		self.validate_idle_state()
 
+	def test_schedule_index(self):
+		now = timer_manager.datetime
+		stamp = int(now.timestamp())
+
+		# Slots do not have to be in order
+		for slot, offset in ((0, 3600), (1, 0), (2, 7200)):
+			self._set_setting('/Settings/DynamicEss/Schedule/{}/Start'.format(slot), stamp + offset)
+			self._set_setting('/Settings/DynamicEss/Schedule/{}/Duration'.format(slot), 3600)
+
+		schedule = DynamicEss.instance.schedule
+		self.assertEqual([w.slot for w in schedule], [1, 0, 2])
+		self.assertEqual(schedule.last.slot, 2)
+		self.assertEqual(schedule.current(now).slot, 1)
+		self.assertEqual(schedule.current(now + timedelta(seconds=3600)).slot, 0)
+		self.assertIsNone(schedule.current(now - timedelta(seconds=1)))
+		self.assertIsNone(schedule.current(now + timedelta(seconds=10800)))
+		self.assertEqual(schedule.next(schedule.current(now)).slot, 0)
+		self.assertIsNone(schedule.next(schedule.last))
+
+		# Not rebuilt unless a setting changes
+		self.assertIs(DynamicEss.instance.schedule, schedule)
+		self._set_setting('/Settings/DynamicEss/Schedule/3/Start', stamp + 1800)
+		self._set_setting('/Settings/DynamicEss/Schedule/3/Duration', 600)
+		schedule = DynamicEss.instance.schedule
+		self.assertEqual(len(schedule), 4)
+
+		# Overlapping windows, the lowest slot wins
+		self.assertEqual(schedule.current(now + timedelta(seconds=1900)).slot, 1)
+
+		self._set_setting('/Settings/DynamicEss/Mode', 1)
+		timer_manager.run(10000)
+		self._check_values({
+			'/DynamicEss/LastScheduledStart': stamp + 7200,
+			'/DynamicEss/LastScheduledEnd': stamp + 10800,
+		})
+
+	def test_trace(self):
+		import os, tempfile
+		from sc_utils import Trace
+		now = timer_manager.datetime
+		stamp = int(now.timestamp())
+
+		self._set_setting('/Settings/DynamicEss/Mode', 1)
+		self._set_setting('/Settings/DynamicEss/Schedule/0/Start', stamp)
+		self._set_setting('/Settings/DynamicEss/Schedule/0/Duration', 3600)
+		self._set_setting('/Settings/DynamicEss/Schedule/0/Strategy', 0)
+		self._set_setting('/Settings/DynamicEss/Schedule/0/Restrictions', 2)
+		self._set_setting('/Settings/DynamicEss/Schedule/0/AllowGridFeedIn', 1)
+		self._set_setting('/Settings/DynamicEss/Schedule/0/TargetSoc', 70)
+		timer_manager.run(10000)
+
+		trace = DynamicEss.instance.trace
+		self.assertEqual(len(trace), 2)
+		record = dict(zip(trace.fields, list(trace)[-1]))
+		self.assertEqual(record['errorcode'], 0)
+		self.assertEqual(record['slot'], 0)
+		self.assertIsNone(record['nextslot'])
+		self.assertEqual(record['restrictions'], 2)
+		self.assertEqual(record['soc'], 55)
+		self.assertEqual(record['targetsoc'], 70)
+		self.assertEqual(record['maxdischargepower'], -1)
+		self.assertEqual(record['strategy'], self._service['/DynamicEss/ReactiveStrategy'])
+
+		# Tracing doesn't use up the reads DVCC has of the charge power
+		from delegates import Dvcc
+		Dvcc.instance.internal_maxchargepower = 1000
+		for _ in range(3):
+			DynamicEss.instance._trace_iteration()
+		self.assertEqual(dict(zip(trace.fields, list(trace)[-1]))['maxchargepower'], 1000)
+		self.assertEqual(Dvcc.instance.internal_maxchargepower, 1000)
+
+		trace_dir = DynamicEss._trace_dir
+		with tempfile.TemporaryDirectory() as d:
+			DynamicEss._trace_dir = os.path.join(d, 'traces')
+			try:
+				self._service.set_value('/Debug/DynamicEss/DumpTrace', 'trace.bin')
+				self.assertEqual(list(Trace.load(os.path.join(d, 'traces', 'trace.bin'))), list(trace))
+
+				# Always written to the trace directory
+				self._service.set_value('/Debug/DynamicEss/DumpTrace', os.path.join(d, 'other.csv'))
+				self.assertFalse(os.path.exists(os.path.join(d, 'other.csv')))
+				self.assertTrue(os.path.exists(os.path.join(d, 'traces', 'other.csv')))
+
+				# Anything else is refused
+				for value in ('..', '/', '', '.hidden', 'a b', 123, None, ['x']):
+					self._service.set_value('/Debug/DynamicEss/DumpTrace', value)
+					self.assertNotEqual(self._service['/Debug/DynamicEss/DumpTrace'], value)
+				self.assertEqual(sorted(os.listdir(os.path.join(d, 'traces'))), ['other.csv', 'trace.bin'])
+			finally:
+				DynamicEss._trace_dir = trace_dir
+
+	def test_error_timeout(self):
+		dess = DynamicEss.instance
+		self._update_values()
+		self._check_values({'/DynamicEss/ErrorCode': 0})
+
+		# However often the loop runs, the error is held back for a minute
+		for _ in range(20):
+			dess.errorcode = 2
+		timer_manager.run(55000)
+		dess.errorcode = 2
+		self._check_values({'/DynamicEss/ErrorCode': 0})
+		timer_manager.run(5000)
+		dess.errorcode = 2
+		self._check_values({'/DynamicEss/ErrorCode': 2})
+
+		# And cleared at once
+		dess.errorcode = 0
+		self._check_values({'/DynamicEss/ErrorCode': 0})
+		dess.errorcode = 2
+		self._check_values({'/DynamicEss/ErrorCode': 0})
+
+	def test_not_triggered_by_own_setpoint(self):
+		triggers = [p for service, paths in DynamicEss.instance.get_triggers() for p in paths]
+		self.assertNotIn('/Ess/AcPowerSetpoint', triggers)
+
+	def test_react_to_changes(self):
+		now = timer_manager.datetime
+		stamp = int(now.timestamp())
+
+		self._set_setting('/Settings/DynamicEss/GridExportLimit', 10)
+		self._set_setting('/Settings/DynamicEss/GridImportLimit', 10)
+		self._set_setting('/Settings/DynamicEss/BatteryChargeLimit', 10)
+		self._set_setting('/Settings/DynamicEss/BatteryDischargeLimit', 10)
+		self._set_setting('/Settings/DynamicEss/Mode', 1)
+		self._set_setting('/Settings/DynamicEss/Schedule/0/Start', stamp)
+		self._set_setting('/Settings/DynamicEss/Schedule/0/Duration', 3600)
+		self._set_setting('/Settings/DynamicEss/Schedule/0/Strategy', 0)
+		self._set_setting('/Settings/DynamicEss/Schedule/0/TargetSoc', 60)
+		self._set_setting('/Settings/DynamicEss/Schedule/0/AllowGridFeedIn', 1)
+
+		self._remove_device(self.vebus)
+		self._add_device(self.rs_service, product_name='Multi RS',
+			values={
+				'/State': 3,
+				'/DeviceInstance': 0,
+				'/Ess/AcPowerSetpoint': 0,
+				'/Soc': 50.0,
+				'/Settings/Ess/Mode': 1,
+				'/Settings/Ess/MinimumSocLimit': 15,
+				'/Capabilities/HasDynamicEssSupport': 1,
+				})
+		timer_manager.run(10000)
+		self._check_values({'/DynamicEss/ReactiveStrategy': 2})
+		setpoint = self._monitor.get_value(self.rs_service, '/Ess/AcPowerSetpoint')
+		iterations = len(DynamicEss.instance.trace)
+
+		# The setpoint follows the load without waiting for the timer
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB0', '/Ac/L1/Power', 1000)
+		timer_manager.run(1000)
+		self.assertAlmostEqual(self._monitor.get_value(self.rs_service, '/Ess/AcPowerSetpoint'), setpoint + 1000)
+		self.assertEqual(len(DynamicEss.instance.trace), iterations)
+
+		# Small changes are ignored
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB0', '/Ac/L1/Power', 1020)
+		timer_manager.run(1000)
+		self.assertAlmostEqual(self._monitor.get_value(self.rs_service, '/Ess/AcPowerSetpoint'), setpoint + 1000)
+
+		# A soc change runs the loop, and the timer holds off
+		self._monitor.set_value(self.rs_service, '/Soc', 51.0)
+		timer_manager.run(1000)
+		self.assertEqual(len(DynamicEss.instance.trace), iterations + 1)
+		timer_manager.run(3000)
+		self.assertEqual(len(DynamicEss.instance.trace), iterations + 1)
+
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)s %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
@@ -10,6 +10,11 @@ from base import TestSystemCalcBase
 # Monkey patching for unit tests
 import patches
 
+# Time travel patch
+from mock_gobject import timer_manager
+from delegates.dvcc import Dvcc
+Dvcc._get_time = lambda *a: timer_manager.time / 1000.0
+
 class Charger(object):
 	def __init__(self, currentlimit, maxchargecurrent, current):
 		self.currentlimit = currentlimit # size of charger
@@ -382,21 +387,22 @@ class TestHubSystem(TestSystemCalcBase):
 			c3 := Charger(15, 10, 3) # 15A charger, limited at 10A, doing 1A
 		]
 
-		# This approaches the right values over time
+		# None of them makes what it is allowed, so each gets some headroom,
+		# and the rest goes mostly to those doing best.
 		for _ in range(3):
 			ChargerSubsystem._distribute_current(chargers, 120)
 
-		self.assertAlmostEqual(c1.maxchargecurrent, 79.7)
-		self.assertAlmostEqual(c2.maxchargecurrent, 28.0)
-		self.assertAlmostEqual(c3.maxchargecurrent, 12.3)
+		self.assertAlmostEqual(c1.maxchargecurrent, 75.1)
+		self.assertAlmostEqual(c2.maxchargecurrent, 29.9)
+		self.assertAlmostEqual(c3.maxchargecurrent, 15.0)
 
 		# One charger starts doing better, requiring a rebalance
 		c2.smoothed_current = 14.5
 		for _ in range(3):
 			ChargerSubsystem._distribute_current(chargers, 120)
-		self.assertAlmostEqual(c1.maxchargecurrent, 78.0)
-		self.assertAlmostEqual(c2.maxchargecurrent, 29.9)
-		self.assertAlmostEqual(c3.maxchargecurrent, 12.1)
+		self.assertAlmostEqual(c1.maxchargecurrent, 70.0)
+		self.assertAlmostEqual(c2.maxchargecurrent, 35.0)
+		self.assertAlmostEqual(c3.maxchargecurrent, 15.0)
 
 		# Push Close to limit
 		c1.smoothed_current = 70.0
@@ -404,25 +410,26 @@ class TestHubSystem(TestSystemCalcBase):
 		c3.smoothed_current = 12.0
 		for _ in range(3):
 			ChargerSubsystem._distribute_current(chargers, 120)
-		self.assertAlmostEqual(c1.maxchargecurrent, 76.3)
-		self.assertAlmostEqual(c2.maxchargecurrent, 31.1)
-		self.assertAlmostEqual(c3.maxchargecurrent, 12.6)
+		self.assertAlmostEqual(c1.maxchargecurrent, 75.0)
+		self.assertAlmostEqual(c2.maxchargecurrent, 32.0)
+		self.assertAlmostEqual(c3.maxchargecurrent, 13.0)
 
 		c3.smoothed_current = 12.8
 		for _ in range(3):
 			ChargerSubsystem._distribute_current(chargers, 120)
-		self.assertAlmostEqual(c1.maxchargecurrent, 75.8)
-		self.assertAlmostEqual(c2.maxchargecurrent, 31.0)
-		self.assertAlmostEqual(c3.maxchargecurrent, 13.2)
+		self.assertAlmostEqual(c1.maxchargecurrent, 74.5)
+		self.assertAlmostEqual(c2.maxchargecurrent, 31.7)
+		self.assertAlmostEqual(c3.maxchargecurrent, 13.8)
 
-		# Two are running full power, do not restrict them
+		# Two are running full power. The first makes less than it may, so
+		# it keeps 2A of headroom, and the other two share the rest by size.
 		c2.smoothed_current = 35.0
 		c3.smoothed_current = 15.0
 		for _ in range(3):
 			ChargerSubsystem._distribute_current(chargers, 120)
-		self.assertAlmostEqual(c1.maxchargecurrent, 70.0)
-		self.assertAlmostEqual(c2.maxchargecurrent, 35.0)
-		self.assertAlmostEqual(c3.maxchargecurrent, 15.0)
+		self.assertAlmostEqual(c1.maxchargecurrent, 72.0)
+		self.assertAlmostEqual(c2.maxchargecurrent, 33.6)
+		self.assertAlmostEqual(c3.maxchargecurrent, 14.4)
 
 		self.assertEqual(sum(c.maxchargecurrent for c in (c1, c2, c3)), 120.0)
 
@@ -438,9 +445,10 @@ class TestHubSystem(TestSystemCalcBase):
 		for _ in range(3):
 			ChargerSubsystem._distribute_current(chargers, 105)
 
-		# Both have roughly 87% margin (l-a)/(c-a)
-		self.assertAlmostEqual(c1.maxchargecurrent, 91.5)
-		self.assertAlmostEqual(c2.maxchargecurrent, 13.5)
+		# Neither makes what it is allowed. After some headroom for both,
+		# the rest is split in proportion to what they make.
+		self.assertAlmostEqual(c1.maxchargecurrent, 95)
+		self.assertAlmostEqual(c2.maxchargecurrent, 10)
 
 	def test_control_vedirect_solarcharger_bms_ess_feedback(self):
 		# When feedback is allowed we do not limit MPPTs
@@ -490,6 +498,15 @@ class TestHubSystem(TestSystemCalcBase):
 			'/Control/EffectiveChargeVoltage': 58.3,
 			'/Control/BmsParameters': 1})
 
+		# Maximizing the charge current goes through the write queue, which
+		# holds back the unchanged value, unless it is due for a refresh
+		from writequeue import WriteQueue
+		sent, suppressed = WriteQueue.instance.counts(('/Link/ChargeCurrent', ))
+		self._update_values(interval=6000)
+		sent2, suppressed2 = WriteQueue.instance.counts(('/Link/ChargeCurrent', ))
+		self.assertEqual(sent2 + suppressed2, sent + suppressed + 2)
+		self.assertGreater(suppressed2, suppressed)
+
 	def test_control_vedirect_solarcharger_bms_ess_feedback_no_ac_in(self):
 		# When feedback is allowed we do not limit MPPTs, but in this case there is no AC-in so feedback is
 		# not possible.
@@ -840,6 +857,7 @@ class TestHubSystem(TestSystemCalcBase):
 
 		multi.bol.chargevoltage = 27
 		multi.bol.maxchargecurrent = 55
+		self._flush_writes()
 
 		self._check_external_values({
 			'com.victronenergy.vebus.ttyO1': {
@@ -1379,6 +1397,7 @@ class TestHubSystem(TestSystemCalcBase):
 				'/Info/MaxChargeVoltage': 53.2,
 				'/Info/MaxDischargeCurrent': 25,
 				'/ProductId': 0xB009})
+		self._update_values() # Service changes are handled from the main loop
 		self._check_values({'/ActiveBatteryService': 'com.victronenergy.battery/1'})
 		self.assertEqual(len(BatteryService.instance.bmses), 2)
 
@@ -1456,6 +1475,7 @@ class TestHubSystem(TestSystemCalcBase):
 					'/Info/MaxChargeVoltage': 53.2,
 					'/Info/MaxDischargeCurrent': 25,
 					'/ProductId': 0xB009})
+		self._update_values() # Service changes are handled from the main loop
 		self._check_values({
 			'/ActiveBatteryService': 'com.victronenergy.battery/0',
 			'/ActiveBmsService': 'com.victronenergy.battery.ttyO0'})
@@ -1770,16 +1790,17 @@ class TestHubSystem(TestSystemCalcBase):
 
 		self._update_values(interval=3000)
 
-		# Check that inverter and solarcharger share charge current limit. Both have a 17.5A margin
-		# and the total is 100A. Margin (l-a)/(c-a) == 0.46.
+		# Check that inverter and solarcharger share charge current limit. The
+		# total is 100A. Neither makes what it is allowed, so the solarcharger
+		# is left at its maximum, and the inverter gets the rest.
 		self._check_external_values({
 			'com.victronenergy.inverter.ttyO1': {
-				'/Link/ChargeCurrent': 67.7,
+				'/Link/ChargeCurrent': 65.0,
 				'/Link/ChargeVoltage': 58.2,
 			},
 			'com.victronenergy.solarcharger.ttyO2': {
 				'/Link/ChargeVoltage': 58.2,
-				'/Link/ChargeCurrent': 32.3
+				'/Link/ChargeCurrent': 35
 			}
 		})
 		self._check_values({
@@ -2378,6 +2399,51 @@ class TestHubSystem(TestSystemCalcBase):
 			'com.victronenergy.vebus.ttyO1': {
 				'/BatteryOperationalLimits/MaxChargeCurrent': 190}}) # 200 minus 10
 
+	def test_fast_control_internal_maxchargecurrent(self):
+		""" Fast adjustments don't use up the reads the internal limit is
+		    valid for. """
+		self._add_device('com.victronenergy.battery.ttyO2',
+			product_name='battery',
+			values={
+				'/Dc/0/Voltage': 12.4,
+				'/Dc/0/Current': 5.3,
+				'/Dc/0/Power': 65,
+				'/Soc': 15.3,
+				'/DeviceInstance': 0,
+				'/Info/BatteryLowVoltage': 11,
+				'/Info/MaxChargeCurrent': 200,
+				'/Info/MaxChargeVoltage': 14.5,
+				'/Info/MaxDischargeCurrent': 200})
+		self._add_device('com.victronenergy.solarcharger.ttyO1', {
+				'/State': 4,
+				'/Link/NetworkMode': 0,
+				'/Link/ChargeVoltage': None,
+				'/Link/ChargeCurrent': 100,
+				'/Link/VoltageSense': None,
+				'/Dc/0/Voltage': 12.4,
+				'/Dc/0/Current': 10.0,
+				'/FirmwareVersion': 0x129,
+				'/Settings/ChargeCurrentLimit': 100 },
+				connection='VE.Direct')
+		self._set_setting('/Settings/SystemSetup/DvccFastControl', 1)
+
+		from delegates.dvcc import Dvcc
+		Dvcc.instance.internal_maxchargepower = 124.0
+		self._update_values(3000)
+		self._check_external_values({
+			'com.victronenergy.vebus.ttyO1': {
+				'/BatteryOperationalLimits/MaxChargeCurrent': 10.0}})
+
+		# The CCL of the BMS changes a number of times in a second
+		for ccl in (199, 200, 199, 200):
+			self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Info/MaxChargeCurrent', ccl)
+			self._update_values(250)
+		self.assertGreaterEqual(self._service['/Debug/Dvcc/FastAdjustments'], 4)
+		self.assertEqual(Dvcc.instance.peek_internal_maxchargepower(), 124.0)
+		self._check_external_values({
+			'com.victronenergy.vebus.ttyO1': {
+				'/BatteryOperationalLimits/MaxChargeCurrent': 10.0}})
+
 	def test_no_systemtype(self):
 		# No ESS assistant
 		self._update_values()
@@ -2677,10 +2743,10 @@ class TestHubSystem(TestSystemCalcBase):
 		self._update_values(interval=3000)
 		self._check_external_values({ # Charge current adds up to 120A
 			'com.victronenergy.solarcharger.ttyO1': {
-				'/Link/ChargeCurrent': 63.7,
+				'/Link/ChargeCurrent': 100, # Doing most, so gets most
 			},
 			'com.victronenergy.multi.ttyO1': {
-				'/Link/ChargeCurrent': 56.3,
+				'/Link/ChargeCurrent': 20.0,
 			}
 		})
 
@@ -2791,10 +2857,10 @@ class TestHubSystem(TestSystemCalcBase):
 		self._update_values(interval=3000)
 		self._check_external_values({ # Charge current adds up to 100A
 			'com.victronenergy.solarcharger.ttyO1': {
-				'/Link/ChargeCurrent': 31.5,
+				'/Link/ChargeCurrent': 9.8,
 			},
 			'com.victronenergy.multi.ttyO1': {
-				'/Link/ChargeCurrent': 68.5,
+				'/Link/ChargeCurrent': 90.2,
 			}
 		})
 
@@ -2836,3 +2902,76 @@ class TestHubSystem(TestSystemCalcBase):
 		self._monitor.set_value('com.victronenergy.battery.ttyO2',
 			'/Info/MaxChargeVoltage', None)
 		self.assertEqual(received, [52.0, 51.5, None])
+
+	def test_fast_control(self):
+		self._monitor.add_value('com.victronenergy.vebus.ttyO1', '/Hub/ChargeVoltage', 55.2)
+		self._monitor.add_value('com.victronenergy.settings', '/Settings/CGwacs/OvervoltageFeedIn', 0)
+		self._add_device('com.victronenergy.solarcharger.ttyO2', {
+			'/State': 3,
+			'/Link/NetworkMode': 0,
+			'/Link/ChargeVoltage': None,
+			'/Link/ChargeCurrent': None,
+			'/Link/VoltageSense': None,
+			'/Settings/ChargeCurrentLimit': 100,
+			'/Dc/0/Voltage': 58.0,
+			'/Dc/0/Current': 30,
+			'/FirmwareVersion': 0x0129},
+			connection='VE.Direct')
+		self._add_device('com.victronenergy.battery.ttyO2',
+			product_name='battery',
+			values={
+				'/Dc/0/Voltage': 58.1,
+				'/Dc/0/Current': 5.3,
+				'/Dc/0/Power': 65,
+				'/Soc': 15.3,
+				'/DeviceInstance': 2,
+				'/Info/BatteryLowVoltage': 47,
+				'/Info/MaxChargeCurrent': 45,
+				'/Info/MaxChargeVoltage': 58.2,
+				'/Info/MaxDischargeCurrent': 50})
+		self._update_values(interval=60000)
+		self._check_external_values({
+			'com.victronenergy.solarcharger.ttyO2': {
+				'/Link/ChargeCurrent': 45 + 8}})
+
+		# Without fast control, a change in the CCL waits for the timer
+		self._update_values(interval=1000)
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Info/MaxChargeCurrent', 30)
+		self._check_external_values({
+			'com.victronenergy.solarcharger.ttyO2': {
+				'/Link/ChargeCurrent': 45 + 8}})
+		self._update_values(interval=3000)
+		self._check_external_values({
+			'com.victronenergy.solarcharger.ttyO2': {
+				'/Link/ChargeCurrent': 30 + 8}})
+		self.assertGreater(self._service['/Debug/Dvcc/LimitsLatency'], 0)
+		self._check_values({
+			'/Debug/Dvcc/FastAdjustments': 0})
+
+		# With fast control, it is written right away
+		self._set_setting('/Settings/SystemSetup/DvccFastControl', 1)
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Info/MaxChargeCurrent', 20)
+		self._check_external_values({
+			'com.victronenergy.solarcharger.ttyO2': {
+				'/Link/ChargeCurrent': 20 + 8},
+			'com.victronenergy.vebus.ttyO1': {
+				'/BatteryOperationalLimits/MaxChargeCurrent': 0}})
+		self._check_values({
+			'/Debug/Dvcc/FastAdjustments': 1,
+			'/Debug/Dvcc/LimitsLatency': 0})
+
+		# But not more often than every FAST_INTERVAL
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Info/MaxChargeCurrent', 10)
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Info/MaxDischargeCurrent', 40)
+		self._check_external_values({
+			'com.victronenergy.solarcharger.ttyO2': {
+				'/Link/ChargeCurrent': 20 + 8}})
+		self._update_values(interval=300)
+		self._check_external_values({
+			'com.victronenergy.solarcharger.ttyO2': {
+				'/Link/ChargeCurrent': 10 + 8},
+			'com.victronenergy.vebus.ttyO1': {
+				'/BatteryOperationalLimits/MaxDischargeCurrent': 40}})
+		self._check_values({
+			'/Debug/Dvcc/FastAdjustments': 2,
+			'/Debug/Dvcc/LimitsLatency': 250})
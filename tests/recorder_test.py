@@ -0,0 +1,83 @@
+import os
+import tempfile
+
+# This adapts sys.path to include all relevant packages
+import context
+
+# Testing tools
+from mock_gobject import timer_manager
+
+# our own packages
+from base import TestSystemCalcBase
+from recorder import Recorder, read_recording
+from replay import replay, diff_outputs
+
+# Monkey patching for unit tests
+import patches
+
+# Time travel patch
+Recorder._get_time = lambda *a: timer_manager.datetime.timestamp()
+
+class TestRecorder(TestSystemCalcBase):
+	def setUp(self):
+		TestSystemCalcBase.setUp(self)
+		fd, self.path = tempfile.mkstemp(suffix='.gz')
+		os.close(fd)
+
+	def tearDown(self):
+		os.unlink(self.path)
+
+	def _record(self):
+		self._add_device('com.victronenergy.vebus.ttyO1',
+			product_name='Multi',
+			values={
+				'/Ac/ActiveIn/L1/P': 123,
+				'/Ac/ActiveIn/ActiveInput': 0,
+				'/Ac/ActiveIn/Connected': 1,
+				'/Ac/Out/L1/P': 100,
+				'/Dc/0/Voltage': 12.25,
+				'/Dc/0/Current': -8,
+				'/DeviceInstance': 0,
+				'/Soc': 53.2,
+				'/State': 3})
+		self._update_values()
+		self._system_calc.record(self.path)
+
+		self._add_device('com.victronenergy.battery.ttyO2',
+			product_name='battery',
+			values={
+				'/Dc/0/Voltage': 12.3,
+				'/Dc/0/Current': 5.3,
+				'/Dc/0/Power': 65,
+				'/Soc': 15.3,
+				'/DeviceInstance': 2})
+		self._update_values(3000)
+		self._monitor.set_value('com.victronenergy.vebus.ttyO1', '/Ac/Out/L1/P', 150)
+		self._monitor.set_value('com.victronenergy.battery.ttyO2', '/Dc/0/Power', 80)
+		self._set_setting('/Settings/SystemSetup/HasDcSystem', 1)
+		self._update_values(3000)
+		self._remove_device('com.victronenergy.battery.ttyO2')
+		self._update_values(3000)
+		self._system_calc._recorder.close()
+		return {p: self._service[p] for p in self._system_calc._summeditems}
+
+	def test_recording(self):
+		self._record()
+		header, events = read_recording(self.path)
+		self.assertEqual(header['settings']['hasdcsystem'], 0)
+		events = list(events)
+		self.assertEqual([e[0] for e in events],
+			['A', 'A', 'C', 'C', 'S', 'R'])
+		self.assertEqual(events[1][3], 'com.victronenergy.battery.ttyO2')
+		self.assertEqual(events[2][2:], [0, '/Ac/Out/L1/P', 150])
+		self.assertEqual(events[4][1:], [3000, 'hasdcsystem', 1])
+
+	def test_replay(self):
+		outputs = self._record()
+		result, systemcalc = replay(self.path)
+		self.assertEqual(result.events, 6)
+		self.assertEqual(result.skipped, 0)
+		self.assertGreater(result.ticks, 0)
+		self.assertEqual(outputs,
+			{p: systemcalc._dbusservice[p] for p in systemcalc._summeditems})
+		self.assertEqual(list(diff_outputs(result.outputs, result.outputs)), [])
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+""" Feeds a recording made with dbus_systemcalc.py --record into
+    MockSystemCalc, and reports how fast the ticks ran, where the time in
+    the delegates went, and, when compared against an earlier run, which
+    outputs changed. """
+import argparse
+import json
+import sys
+import time
+
+# This adapts sys.path to include all relevant packages
+import context
+
+# Testing tools
+from mock_gobject import timer_manager
+from base import MockSystemCalc
+from recorder import read_recording
+
+# Monkey patching for unit tests
+import patches
+
+class ReplayResult(object):
+	def __init__(self):
+		self.ticks = 0
+		self.ticktime = 0.0
+		self.walltime = 0.0
+		self.events = 0
+		self.skipped = 0
+		self.outputs = [] # (time in ms, {path: value}) for each tick
+
+def replay(path, speed=0):
+	""" Replays the recording at path. A speed of 1 runs it in real time,
+	    a speed of 0 as fast as possible. Returns a ReplayResult, and the
+	    MockSystemCalc the recording was played into. """
+	result = ReplayResult()
+	header, events = read_recording(path)
+
+	timer_manager.reset()
+	origin = timer_manager.datetime.timestamp()
+	systemcalc = MockSystemCalc()
+	monitor = systemcalc._dbusmonitor
+	service = systemcalc._dbusservice
+	for k, v in header['settings'].items():
+		if k in systemcalc._setting_names:
+			systemcalc._settings[k] = v
+
+	# Time each tick, and keep the outputs that changed
+	updatevalues = systemcalc._updatevalues
+	outputs = {}
+	def timed_updatevalues():
+		start = time.perf_counter()
+		updatevalues()
+		result.ticktime += time.perf_counter() - start
+		result.ticks += 1
+		changed = {}
+		for p in systemcalc._summeditems:
+			v = service[p]
+			if outputs.get(p) != v:
+				outputs[p] = changed[p] = v
+		result.outputs.append((
+			int(round((timer_manager.datetime.timestamp() - origin) * 1000)), changed))
+	systemcalc._updatevalues = timed_updatevalues
+
+	services = {}
+	now = 0
+	start = time.perf_counter()
+	for event in events:
+		kind, t = event[:2]
+		if t > now:
+			if speed > 0:
+				time.sleep(max(0, (t / 1000.0 - (time.perf_counter() - start)) / speed))
+			timer_manager.run(t - now)
+			now = t
+		result.events += 1
+
+		if kind == 'A':
+			sid, name, values = event[2:]
+			if name in monitor.get_service_list():
+				monitor.remove_service(name)
+			services[sid] = name
+			monitor.add_service(name, values)
+		elif kind == 'R':
+			name = services.pop(event[2], None)
+			if name is not None:
+				monitor.remove_service(name)
+		elif kind == 'C':
+			sid, p, v = event[2:]
+			name = services.get(sid)
+			if name is None:
+				result.skipped += 1
+				continue
+			if not monitor.seen(name, p):
+				monitor.add_value(name, p, None)
+			monitor.set_value(name, p, v)
+		elif kind == 'S':
+			systemcalc._settings[event[2]] = event[3]
+		else:
+			result.skipped += 1
+
+	# Run until the slowest tick has seen the last event
+	timer_manager.run(systemcalc._settings['tickslow'])
+	result.walltime = time.perf_counter() - start
+	return result, systemcalc
+
+def diff_outputs(outputs, baseline):
+	""" Compares two lists of outputs per tick, as kept in
+	    ReplayResult.outputs. Yields time, path, baseline value and value
+	    for every difference. """
+	current = {}
+	expected = {}
+	for (t, changed), (_, bchanged) in zip(outputs, baseline):
+		current.update(changed)
+		expected.update(bchanged)
+		for p in set(changed) | set(bchanged):
+			if current.get(p) != expected.get(p):
+				yield t, p, expected.get(p), current.get(p)
+	if len(outputs) != len(baseline):
+		yield None, 'ticks', len(baseline), len(outputs)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('recording', help='file written by dbus_systemcalc.py --record')
+	parser.add_argument('-s', '--speed', type=float, default=0,
+		help='1 for real time, 10 for ten times as fast, 0 (default) for as fast as possible')
+	parser.add_argument('--save', metavar='FILE', help='write the outputs of each tick to FILE')
+	parser.add_argument('--compare', metavar='FILE', help='compare the outputs against those saved to FILE')
+	args = parser.parse_args()
+
+	result, systemcalc = replay(args.recording, args.speed)
+
+	print('{} events, {} skipped, replayed in {:.2f} s'.format(
+		result.events, result.skipped, result.walltime))
+	if result.ticks:
+		print('{} ticks, {:.3f} ms per tick, {:.0f} ticks/s'.format(result.ticks,
+			1000 * result.ticktime / result.ticks, result.ticks / result.ticktime))
+
+	print('\n{:<40} {:>8} {:>10} {:>8} {:>8} {:>8} {:>8}'.format(
+		'Delegate', 'Calls', 'Total ms', 'Mean', 'P50', 'P99', 'Max'))
+	stats = sorted(systemcalc._profiler.items(), key=lambda i: -i[2].total)
+	for name, hook, s in stats:
+		p50, p99, mx = s.percentiles()
+		print('{:<40} {:>8} {:>10.1f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}'.format(
+			name + '/' + hook, s.count, s.total, s.total / s.count, p50, p99, mx))
+
+	if args.save:
+		with open(args.save, 'w') as f:
+			for t, changed in result.outputs:
+				f.write(json.dumps([t, changed], default=str) + '\n')
+
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = [tuple(json.loads(line)) for line in f if line.strip()]
+		diffs = list(diff_outputs(result.outputs, baseline))
+		print('\n{} differences in outputs'.format(len(diffs)))
+		for t, p, expected, value in diffs[:50]:
+			print('{:>10} {:<50} {!r} -> {!r}'.format('' if t is None else t, p, expected, value))
+		if diffs:
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
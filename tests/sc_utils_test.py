@@ -104,3 +104,262 @@ class TestExpiringValue(unittest.TestCase):
 		self.assertTrue(ev.expired)
 		ev.set(2)
 		self.assertFalse(ev.expired)
+
+	def test_peek(self):
+		from sc_utils import ExpiringValue
+		ev = ExpiringValue(1, 3)
+		self.assertEqual(3, ev.peek())
+		self.assertEqual(3, ev.peek())
+		self.assertEqual(3, ev.get())
+		self.assertIsNone(ev.peek())
+
+class TestProfiler(unittest.TestCase):
+	def test_percentiles(self):
+		from sc_utils import RollingStats
+		s = RollingStats(100)
+		self.assertEqual(s.percentiles(), (None, None, None))
+		for i in range(200):
+			s.add(i)
+		self.assertEqual(len(s), 100)
+		self.assertEqual(s.percentiles(), (150, 199, 199))
+
+	def test_changed(self):
+		from sc_utils import Profiler
+		p = Profiler()
+		self.assertEqual(p.call('A', 'UpdateValues', lambda x: x + 1, 1), 2)
+		p.record('B', 'Timer', 5)
+		self.assertEqual(sorted((n, h) for n, h, _ in p.changed()),
+			[('A', 'UpdateValues'), ('B', 'Timer')])
+		self.assertEqual(list(p.changed()), [])
+
+		p.record('B', 'Timer', 7)
+		self.assertEqual(list(p.changed()), [('B', 'Timer', (7, 7, 7))])
+
+		p.enabled = False
+		p.record('B', 'Timer', 9)
+		self.assertEqual(list(p.changed()), [])
+
+class TestTrace(unittest.TestCase):
+	fields = (('time', 'd'), ('slot', 'h'), ('rate', 'f'))
+
+	def test_wrap(self):
+		from sc_utils import Trace
+		t = Trace(self.fields, 3)
+		self.assertEqual(list(t), [])
+		for i in range(5):
+			t.append(i, None if i == 3 else i, i / 2)
+		self.assertEqual(len(t), 3)
+		self.assertEqual(list(t), [(2, 2, 1), (3, None, 1.5), (4, 4, 2)])
+
+		t.append(5, 5, None)
+		self.assertEqual(list(t)[-1], (5, 5, None))
+
+	def test_dump(self):
+		import os, tempfile
+		from sc_utils import Trace
+		t = Trace(self.fields, 4)
+		for i in range(6):
+			t.append(i, i, None if i == 4 else i)
+		with tempfile.TemporaryDirectory() as d:
+			t.dump(os.path.join(d, 'trace'))
+			loaded = Trace.load(os.path.join(d, 'trace'))
+			self.assertEqual(loaded.fields, ('time', 'slot', 'rate'))
+			self.assertEqual(list(loaded), list(t))
+
+			t.dump_csv(os.path.join(d, 'trace.csv'))
+			with open(os.path.join(d, 'trace.csv')) as f:
+				self.assertEqual(f.read().splitlines(),
+					['time,slot,rate', '2.0,2,2.0', '3.0,3,3.0', '4.0,4,', '5.0,5,5.0'])
+
+class TestServiceIndex(unittest.TestCase):
+	def test_add_remove(self):
+		from sc_utils import ServiceIndex
+		index = ServiceIndex()
+		self.assertIs(ServiceIndex.instance, index)
+		self.assertEqual(dict(index.get('com.victronenergy.battery')), {})
+
+		index.add('com.victronenergy.battery.ttyO1', 256)
+		index.add('com.victronenergy.battery.ttyO2', 257)
+		index.add('com.victronenergy.vebus.ttyO3', 0)
+		batteries = index.get('com.victronenergy.battery')
+		self.assertEqual(dict(batteries), {
+			'com.victronenergy.battery.ttyO1': 256,
+			'com.victronenergy.battery.ttyO2': 257})
+		self.assertEqual(index.device_instance('com.victronenergy.vebus.ttyO3'), 0)
+
+		# Views are read only, but follow later changes
+		with self.assertRaises(TypeError):
+			batteries['com.victronenergy.battery.ttyO4'] = 1
+		index.remove('com.victronenergy.battery.ttyO1')
+		index.remove('com.victronenergy.battery.ttyO9')
+		self.assertEqual(list(batteries), ['com.victronenergy.battery.ttyO2'])
+		self.assertIsNone(index.device_instance('com.victronenergy.battery.ttyO1'))
+
+	def test_connected(self):
+		from sc_utils import ServiceIndex
+		index = ServiceIndex()
+		self.assertIsNone(index.lowest_connected('com.victronenergy.vebus'))
+		index.add('com.victronenergy.vebus.ttyO1', 5)
+		index.add('com.victronenergy.vebus.ttyO2', 3)
+		index.add('com.victronenergy.vebus.ttyO3', 4)
+		index.set_connected('com.victronenergy.vebus.ttyO1', True)
+		index.set_connected('com.victronenergy.vebus.ttyO2', True)
+		index.set_connected('com.victronenergy.vebus.ttyO3', False)
+		index.set_connected('com.victronenergy.vebus.ttyO9', True)
+		self.assertEqual(dict(index.connected('com.victronenergy.vebus')), {
+			'com.victronenergy.vebus.ttyO1': 5,
+			'com.victronenergy.vebus.ttyO2': 3})
+		self.assertEqual(index.lowest_connected('com.victronenergy.vebus'),
+			('com.victronenergy.vebus.ttyO2', 3))
+
+		index.set_connected('com.victronenergy.vebus.ttyO3', True)
+		index.set_connected('com.victronenergy.vebus.ttyO2', False)
+		self.assertEqual(index.lowest_connected('com.victronenergy.vebus'),
+			('com.victronenergy.vebus.ttyO3', 4))
+		index.remove('com.victronenergy.vebus.ttyO3')
+		self.assertEqual(index.lowest_connected('com.victronenergy.vebus'),
+			('com.victronenergy.vebus.ttyO1', 5))
+
+		# Flapping does not grow the heap without bound
+		for _ in range(50):
+			index.set_connected('com.victronenergy.vebus.ttyO2', True)
+			index.set_connected('com.victronenergy.vebus.ttyO2', False)
+		self.assertLess(len(index._heaps['com.victronenergy.vebus']), 20)
+		self.assertEqual(index.lowest_connected('com.victronenergy.vebus'),
+			('com.victronenergy.vebus.ttyO1', 5))
+
+class TestOptionalSum(unittest.TestCase):
+	def test_replace(self):
+		from sc_utils import OptionalSum
+		s = OptionalSum()
+		self.assertIsNone(s.value)
+		s.replace(None, 1.1)
+		s.replace(None, 2.2)
+		s.replace(1.1, None)
+		self.assertAlmostEqual(s.value, 2.2)
+		s.replace(2.2, None)
+		self.assertIsNone(s.value)
+
+	def test_reset(self):
+		from sc_utils import OptionalSum
+		s = OptionalSum()
+		for i in range(1000):
+			s.replace(None if i == 0 else 0.1, 0.1)
+		s.replace(None, 0.2)
+		s.reset([0.1, None, 0.2])
+		self.assertEqual(s.value, 0.1 + 0.2)
+		self.assertEqual(s.count, 2)
+		s.reset([None])
+		self.assertIsNone(s.value)
+
+class TestExtremeIndex(unittest.TestCase):
+	def test_update(self):
+		from sc_utils import ExtremeIndex
+
+		index = ExtremeIndex(highest=True)
+		self.assertIsNone(index.top())
+		index.update('a', 3.30, 'C1')
+		index.update('b', 3.40, 'C2')
+		index.update('c', 3.35, 'C3')
+		self.assertEqual(index.top(), ('b', 3.40, 'C2'))
+
+		# The old entry of b is skipped
+		index.update('b', 3.20, 'C2')
+		self.assertEqual(index.top(), ('c', 3.35, 'C3'))
+
+		# Only the cell changes
+		index.update('c', 3.35, 'C4')
+		self.assertEqual(index.top(), ('c', 3.35, 'C4'))
+
+		index.update('c', None)
+		self.assertEqual(index.top(), ('a', 3.30, 'C1'))
+		self.assertEqual(len(index), 2)
+
+		# Left behind entries don't pile up
+		for i in range(1000):
+			index.update('a', i % 7 / 10.0)
+		self.assertLessEqual(len(index._heap), 20)
+		self.assertEqual(index.top(), ('b', 3.20, 'C2'))
+
+		index = ExtremeIndex()
+		index.update('a', 20)
+		index.update('b', 10)
+		self.assertEqual(index.top(), ('b', 10, None))
+
+class TestDependencyGraph(unittest.TestCase):
+	def _graph(self, calls):
+		from sc_utils import DependencyGraph
+		inputs = {'a': 1, 'b': 2}
+		def total(values):
+			calls.append('total')
+			values['/Total'] = inputs['a'] + inputs['b']
+		def sign(values):
+			calls.append('sign')
+			values['/Sign'] = 1 if values['/Total'] >= 0 else -1
+		def double(values):
+			calls.append('double')
+			values['/Double'] = 2 * inputs['b']
+		g = DependencyGraph()
+		# Added out of order on purpose
+		g.add_node('sign', sign, ['/Total'], ['/Sign'])
+		g.add_node('total', total, ['a', 'b'], ['/Total'])
+		g.add_node('double', double, ['b'], ['/Double'])
+		return g, inputs
+
+	def test_evaluate_all(self):
+		calls = []
+		g, inputs = self._graph(calls)
+		self.assertEqual(g.evaluate(), {'/Total', '/Sign', '/Double'})
+		self.assertEqual(calls, ['total', 'double', 'sign'])
+		self.assertEqual(g.values, {'/Total': 3, '/Sign': 1, '/Double': 4})
+
+	def test_evaluate_downstream_only(self):
+		calls = []
+		g, inputs = self._graph(calls)
+		g.evaluate()
+		del calls[:]
+
+		inputs['a'] = -5
+		self.assertEqual(g.evaluate(['a']), {'/Total', '/Sign'})
+		self.assertEqual(calls, ['total', 'sign'])
+		self.assertEqual(g.values['/Sign'], -1)
+
+	def test_unchanged_output_stops_propagation(self):
+		calls = []
+		g, inputs = self._graph(calls)
+		g.evaluate()
+		del calls[:]
+
+		inputs['a'], inputs['b'] = 2, 1
+		self.assertEqual(g.evaluate(['a', 'b']), {'/Double'})
+		self.assertEqual(calls, ['total', 'double'])
+
+	def test_missing_output(self):
+		from sc_utils import DependencyGraph
+		present = [True]
+		def f(values):
+			if present[0]:
+				values['/X'] = 1
+		g = DependencyGraph()
+		g.add_node('f', f, ['x'], ['/X'])
+		g.evaluate()
+		present[0] = False
+		self.assertEqual(g.evaluate(['x']), {'/X'})
+		self.assertNotIn('/X', g.values)
+
+	def test_errors(self):
+		from sc_utils import DependencyGraph
+		g = DependencyGraph()
+		g.add_node('a', lambda v: None, ['/B'], ['/A'])
+		with self.assertRaises(ValueError):
+			g.add_node('a', lambda v: None, [], ['/C'])
+		with self.assertRaises(ValueError):
+			g.add_node('c', lambda v: None, [], ['/A'])
+		g.add_node('b', lambda v: None, ['/A'], ['/B'])
+		with self.assertRaises(ValueError):
+			g.evaluate()
+
+		g = DependencyGraph()
+		g.add_node('a', lambda v: v.update({'/B': 1}), [], ['/A'])
+		with self.assertRaises(ValueError):
+			g.evaluate()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+""" Builds synthetic systems of growing size in MockSystemCalc, and measures
+    how the time taken by _updatevalues and _handleservicechange, and the
+    memory used, grow with the number of devices of each kind. """
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+# This adapts sys.path to include all relevant packages
+import context
+
+# Testing tools
+from mock_gobject import timer_manager
+from base import MockSystemCalc
+
+# Monkey patching for unit tests
+import patches
+
+DIMENSIONS = ('solarchargers', 'batteries', 'pvinverters', 'gridmeters', 'vebus')
+COUNTS = (1, 2, 5, 10, 20, 50, 100)
+
+def _device(service, instance, values):
+	values.update({
+		'/Connected': 1,
+		'/ProductName': 'dummy',
+		'/Mgmt/Connection': 'dummy',
+		'/DeviceInstance': instance})
+	return service, values
+
+def _solarcharger(i):
+	return _device('com.victronenergy.solarcharger.ttyS{}'.format(i), i, {
+		'/State': 3,
+		'/Dc/0/Voltage': 52.1,
+		'/Dc/0/Current': 10.0 + i % 7,
+		'/Yield/Power': 500 + i,
+		'/Load/I': None})
+
+def _battery(i):
+	return _device('com.victronenergy.battery.ttyB{}'.format(i), 512 + i, {
+		'/Dc/0/Voltage': 52.3,
+		'/Dc/0/Current': 5.0 + i % 3,
+		'/Dc/0/Power': 260 + i,
+		'/Soc': 60 + i % 40,
+		'/Capacity': 200,
+		'/InstalledCapacity': 200,
+		'/Info/MaxChargeCurrent': 100,
+		'/Info/MaxDischargeCurrent': 200,
+		'/Info/MaxChargeVoltage': 55.2})
+
+def _pvinverter(i):
+	return _device('com.victronenergy.pvinverter.pv_{}'.format(i), 20 + i, {
+		'/Position': i % 3,
+		'/Ac/Power': 900 + i,
+		'/Ac/L1/Power': 300 + i, '/Ac/L2/Power': 300, '/Ac/L3/Power': 300,
+		'/Ac/L1/Current': 1.3, '/Ac/L2/Current': 1.3, '/Ac/L3/Current': 1.3})
+
+def _gridmeter(i):
+	return _device('com.victronenergy.grid.cgwacs_{}'.format(i), 30 + i, {
+		'/ProductId': 0xB002,
+		'/DeviceType': 72,
+		'/Ac/Power': 1200 + i,
+		'/Ac/L1/Power': 400 + i, '/Ac/L2/Power': 400, '/Ac/L3/Power': 400,
+		'/Ac/L1/Current': 1.8, '/Ac/L2/Current': 1.8, '/Ac/L3/Current': 1.8})
+
+def _vebus(i):
+	return _device('com.victronenergy.vebus.ttyV{}'.format(i), 200 + i, {
+		'/State': 3,
+		'/ProductId': 0x2623,
+		'/Soc': 55.0,
+		'/Dc/0/Voltage': 52.2,
+		'/Dc/0/Current': -12.0,
+		'/Ac/ActiveIn/ActiveInput': 0,
+		'/Ac/ActiveIn/Connected': 1,
+		'/Ac/ActiveIn/L1/P': 500 + i, '/Ac/ActiveIn/L1/I': 2.2,
+		'/Ac/Out/L1/P': 450 + i, '/Ac/Out/L1/I': 2.0,
+		'/Hub4/AssistantId': 5})
+
+FACTORIES = dict(zip(DIMENSIONS, (_solarcharger, _battery, _pvinverter, _gridmeter, _vebus)))
+
+def build(counts):
+	""" Creates a MockSystemCalc with counts[dimension] devices of each
+	    kind, and lets it settle. """
+	timer_manager.reset()
+	systemcalc = MockSystemCalc()
+	monitor = systemcalc._dbusmonitor
+	monitor.add_service('com.victronenergy.settings', {
+		'/Settings/SystemSetup/AcInput1': 1,
+		'/Settings/SystemSetup/AcInput2': 2})
+	devices = []
+	for dimension, n in counts.items():
+		for i in range(n):
+			service, values = FACTORIES[dimension](i)
+			monitor.add_service(service, values)
+			devices.append(service)
+	timer_manager.run(5000)
+	return systemcalc, devices
+
+def _median_ms(f, repeat, setup=None):
+	times = []
+	for _ in range(repeat):
+		if setup is not None:
+			setup()
+		start = time.perf_counter()
+		f()
+		times.append((time.perf_counter() - start) * 1000)
+	return statistics.median(times)
+
+def measure(counts, repeat=20):
+	""" Returns the median time in ms of a tick where every device changed,
+	    of a service change, and the memory in kB held by the systemcalc
+	    and its devices. """
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	systemcalc, devices = build(counts)
+	memory = (tracemalloc.get_traced_memory()[0] - before) / 1024.0
+	tracemalloc.stop()
+	systemcalc, devices = build(counts)
+
+	monitor = systemcalc._dbusmonitor
+	step = [0]
+	def change():
+		# A value on every device moves, as it would between two ticks
+		step[0] += 1
+		for service in devices:
+			if monitor.seen(service, '/Dc/0/Voltage'):
+				monitor.set_value(service, '/Dc/0/Voltage', 52 + step[0] % 2)
+			else:
+				monitor.set_value(service, '/Ac/Power', 1000 + step[0] % 2)
+
+	return {
+		'updatevalues_ms': _median_ms(systemcalc._updatevalues, repeat, change),
+		'servicechange_ms': _median_ms(systemcalc._handleservicechange, repeat),
+		'memory_kb': round(memory, 1)}
+
+def _fit(xs, ys):
+	""" Least squares fit, returns intercept and slope. """
+	n = len(xs)
+	mx = sum(xs) / n
+	my = sum(ys) / n
+	sxx = sum((x - mx) ** 2 for x in xs)
+	if sxx == 0:
+		return my, 0.0
+	slope = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+	return my - slope * mx, slope
+
+def run(dimensions=DIMENSIONS, counts=COUNTS, repeat=20, budget=1000, slowdown=1.0):
+	""" Grows each dimension in turn, with one device of every other kind
+	    present. Returns the results, and for each dimension the estimated
+	    device count at which a tick and a service change no longer fit in
+	    budget milliseconds, on a machine slowdown times slower. """
+	results = []
+	limits = {}
+	for dimension in dimensions:
+		points = []
+		for n in counts:
+			topology = dict.fromkeys(DIMENSIONS, 1)
+			topology[dimension] = n
+			r = measure(topology, repeat)
+			r.update(dimension=dimension, count=n)
+			results.append(r)
+			points.append((n, r['updatevalues_ms'] + r['servicechange_ms']))
+
+		intercept, slope = _fit(*zip(*points))
+		if slope > 0:
+			limits[dimension] = max(0, int((budget / slowdown - intercept) / slope))
+		else:
+			limits[dimension] = None
+	return results, limits
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('-o', '--output', metavar='FILE', default='scaling.json',
+		help='file to write the results to, as JSON (default %(default)s)')
+	parser.add_argument('-d', '--dimension', action='append', choices=DIMENSIONS,
+		help='only grow this kind of device, may be given more than once')
+	parser.add_argument('-c', '--counts', type=lambda s: [int(x) for x in s.split(',')],
+		default=COUNTS, help='comma separated device counts (default %(default)s)')
+	parser.add_argument('-r', '--repeat', type=int, default=20,
+		help='measurements per point, the median is reported')
+	parser.add_argument('--budget', type=float, default=1000,
+		help='tick budget in ms (default %(default)s)')
+	parser.add_argument('--slowdown', type=float, default=1.0,
+		help='how many times slower the target, eg a GX device, is than this machine')
+	args = parser.parse_args()
+
+	results, limits = run(args.dimension or DIMENSIONS, args.counts, args.repeat,
+		args.budget, args.slowdown)
+
+	print('{:<15} {:>6} {:>12} {:>14} {:>10}'.format(
+		'Dimension', 'Count', 'Update ms', 'Service ms', 'Memory kB'))
+	for r in results:
+		print('{dimension:<15} {count:>6} {updatevalues_ms:>12.3f} {servicechange_ms:>14.3f} {memory_kb:>10.1f}'.format(**r))
+	print()
+	for dimension, limit in limits.items():
+		print('{:<15} fits a {:.0f} ms tick up to about {} devices'.format(
+			dimension, args.budget, 'any number of' if limit is None else limit))
+
+	with open(args.output, 'w') as f:
+		json.dump({
+			'python': sys.version.split()[0],
+			'machine': platform.machine(),
+			'platform': platform.platform(),
+			'budget_ms': args.budget,
+			'slowdown': args.slowdown,
+			'results': results,
+			'limits': limits}, f, indent=1)
+
+if __name__ == '__main__':
+	main()
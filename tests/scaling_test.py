@@ -0,0 +1,25 @@
+import unittest
+
+# This adapts sys.path to include all relevant packages
+import context
+
+import scaling
+
+class TestScaling(unittest.TestCase):
+	def test_run(self):
+		results, limits = scaling.run(dimensions=('solarchargers', 'vebus'),
+			counts=(1, 3), repeat=1)
+		self.assertEqual([(r['dimension'], r['count']) for r in results],
+			[('solarchargers', 1), ('solarchargers', 3), ('vebus', 1), ('vebus', 3)])
+		for r in results:
+			self.assertGreater(r['updatevalues_ms'], 0)
+			self.assertGreater(r['servicechange_ms'], 0)
+			self.assertGreater(r['memory_kb'], 0)
+		self.assertEqual(set(limits), {'solarchargers', 'vebus'})
+
+	def test_topology(self):
+		systemcalc, devices = scaling.build({'pvinverters': 4, 'batteries': 2})
+		self.assertEqual(len(devices), 6)
+		self.assertEqual(systemcalc._dbusservice['/Ac/PvOnGrid/L1/Power'], 603)
+		self.assertEqual(systemcalc._dbusservice['/Ac/PvOnOutput/L1/Power'], 301)
+		self.assertEqual(systemcalc._dbusservice['/Ac/PvOnGenset/L1/Power'], 302)
@@ -0,0 +1,108 @@
+import unittest
+
+# This adapts sys.path to include all relevant packages
+import context
+
+# Testing tools
+from mock_gobject import timer_manager
+from mock_dbus_service import MockDbusService
+
+# Monkey patching for unit tests
+import patches
+
+from scheduler import Scheduler
+
+# Time travel patch
+Scheduler._get_time = lambda *a: timer_manager.datetime.timestamp()
+
+class BatchingService(MockDbusService):
+	""" Keeps the paths set in each batch, and those set outside of one. """
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.batches = []
+		self.unbatched = []
+		self._batch = None
+
+	def __enter__(self):
+		self._batch = []
+		return self
+
+	def __exit__(self, *exc):
+		self.batches.append(self._batch)
+		self._batch = None
+		return False
+
+	def __setitem__(self, path, value):
+		super().__setitem__(path, value)
+		(self.unbatched if self._batch is None else self._batch).append(path)
+
+class TestScheduler(unittest.TestCase):
+	def setUp(self):
+		timer_manager.reset()
+		self.service = MockDbusService('com.victronenergy.system')
+		self.scheduler = Scheduler(self.service)
+		self.runs = []
+
+	def _job(self, name, result=True):
+		def f():
+			self.runs.append((name, self.scheduler._ticks))
+			return result
+		return f
+
+	def _ticks(self, name):
+		return [t for n, t in self.runs if n == name]
+
+	def test_phase_offsets(self):
+		self.scheduler.add_job('A', 5000, self._job('A'))
+		self.scheduler.add_job('B', 5000, self._job('B'))
+		self.scheduler.add_job('C', 5000, self._job('C'), spread=False)
+		self.scheduler.add_job('D', 3000, self._job('D'))
+		timer_manager.run(10000)
+		self.assertEqual(self._ticks('A'), [5, 10])
+		self.assertEqual(self._ticks('B'), [4, 9])
+		self.assertEqual(self._ticks('C'), [5, 10])
+		self.assertEqual(self._ticks('D'), [3, 6, 9])
+
+	def test_remove(self):
+		a = self.scheduler.add_job('A', 1000, self._job('A'))
+		self.scheduler.add_job('B', 2000, self._job('B', False))
+		timer_manager.run(3000)
+		self.assertEqual(self._ticks('A'), [1, 2, 3])
+		self.assertEqual(self._ticks('B'), [2])
+
+		self.scheduler.remove_job(a)
+		timer_manager.run(3000)
+		self.assertEqual(self._ticks('A'), [1, 2, 3])
+		self.assertEqual(self.scheduler.jobs, [])
+
+	def test_failing_job(self):
+		def fail():
+			raise ValueError()
+		job = self.scheduler.add_job('A', 1000, fail)
+		timer_manager.run(3000)
+
+		# The job is kept, and runs again at the next interval
+		self.assertEqual(self.scheduler.jobs, [job])
+		self.assertEqual(job.runs, 3)
+		self.assertEqual(self.service['/Debug/Scheduler/A/Failures'], 3)
+		self.assertEqual(self.service['/Debug/Scheduler/A/Lateness'], 0)
+
+	def test_statistics(self):
+		job = self.scheduler.add_job('A', 1000, self._job('A'))
+		timer_manager.run(2000)
+		self.assertEqual(job.runs, 2)
+		self.assertEqual(self.service['/Debug/Scheduler/A/Lateness'], 0)
+		self.assertEqual(self.service['/Debug/Scheduler/A/MaxLateness'], 0)
+		self.assertIsNotNone(self.service['/Debug/Scheduler/A/Runtime'])
+
+	def test_published_per_batch(self):
+		self.service = BatchingService('com.victronenergy.system')
+		self.scheduler = Scheduler(self.service)
+		self.scheduler.add_job('A', 1000, self._job('A'))
+		self.scheduler.add_job('B', 2000, self._job('B'), spread=False)
+		timer_manager.run(2000)
+
+		# One batch per tick, with the statistics of every job that ran
+		self.assertEqual(self.service.unbatched, [])
+		self.assertEqual([len(b) for b in self.service.batches], [4, 8])
+		self.assertIn('/Debug/Scheduler/B/Runtime', self.service.batches[1])
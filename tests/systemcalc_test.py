@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import json
 import unittest
+import dbus
 
 # This adapts sys.path to include all relevant packages
 import context
@@ -1586,6 +1587,107 @@ class TestSystemCalc(TestSystemCalcBase):
 			'/Ac/PvOnGrid/L1/Power': 210
 		})
 
+	def test_pv_totals_follow_changes(self):
+		self._add_device('com.victronenergy.pvinverter.fronius_122_2314', {
+			'/Ac/L1/Power': 105,
+			'/Ac/L1/Current': 0.5,
+			'/Ac/L2/Power': 100,
+			'/Position': 0 # AC-in 1
+		})
+		self._add_device('com.victronenergy.pvinverter.fronius_122_2315', {
+			'/Ac/L1/Power': 210,
+			'/Position': 0 # AC-in 1
+		})
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/SystemSetup/AcInput1', 1) # Grid
+		self._update_values()
+		self._check_values({
+			'/Ac/PvOnGrid/L1/Power': 315,
+			'/Ac/PvOnGrid/L1/Current': 0.5,
+			'/Ac/PvOnGrid/L2/Power': 100,
+			'/Ac/PvOnGrid/InverterCount': 2,
+			'/Ac/PvOnGrid/MinInverterPower': 205,
+			'/Ac/PvOnGrid/MaxInverterPower': 210,
+			'/Ac/PvOnOutput/InverterCount': 0,
+			'/Ac/PvOnOutput/MinInverterPower': None,
+		})
+
+		self._monitor.set_value('com.victronenergy.pvinverter.fronius_122_2315', '/Ac/L1/Power', 150)
+		self._update_values()
+		self._check_values({
+			'/Ac/PvOnGrid/L1/Power': 255,
+			'/Ac/PvOnGrid/MinInverterPower': 150,
+			'/Ac/PvOnGrid/MaxInverterPower': 205,
+		})
+
+		# Moved to the output
+		self._monitor.set_value('com.victronenergy.pvinverter.fronius_122_2314', '/Position', 1)
+		self._update_values()
+		self._check_values({
+			'/Ac/PvOnGrid/L1/Power': 150,
+			'/Ac/PvOnGrid/L1/Current': None,
+			'/Ac/PvOnGrid/L2/Power': None,
+			'/Ac/PvOnGrid/InverterCount': 1,
+			'/Ac/PvOnOutput/L1/Power': 105,
+			'/Ac/PvOnOutput/L2/Power': 100,
+			'/Ac/PvOnOutput/InverterCount': 1,
+			'/Ac/PvOnOutput/MaxInverterPower': 205,
+		})
+
+		# Input no longer in use
+		self._monitor.set_value('com.victronenergy.settings', '/Settings/SystemSetup/AcInput1', 0)
+		self._update_values()
+		self._check_values({
+			'/Ac/PvOnGrid/L1/Power': None,
+			'/Ac/PvOnGrid/InverterCount': 0,
+			'/Ac/PvOnGrid/MaxInverterPower': None,
+		})
+
+		self._remove_device('com.victronenergy.pvinverter.fronius_122_2314')
+		self._update_values()
+		self._check_values({
+			'/Ac/PvOnOutput/L1/Power': None,
+			'/Ac/PvOnOutput/InverterCount': 0,
+		})
+
+	def test_pv_invalid_value(self):
+		from delegates import PvInverters
+		self._add_device('com.victronenergy.pvinverter.fronius_122_2314', {
+			'/Ac/L1/Power': 105,
+			'/Ac/L1/Current': 0.5,
+			'/Position': 1 # AC-out
+		})
+		self._add_device('com.victronenergy.pvinverter.fronius_122_2315', {
+			'/Ac/L1/Power': 210,
+			'/Position': 1 # AC-out
+		})
+		self._update_values()
+		pv = PvInverters.instance
+
+		# On the bus, an invalid value is an empty array
+		pv._value_changed('com.victronenergy.pvinverter.fronius_122_2315', '/Ac/L1/Power',
+			{'Value': dbus.Array([], signature='i')})
+		self.assertEqual(pv.get_totals()['/Ac/PvOnOutput/L1/Power'], 105)
+		newvalues = {}
+		pv.update_values(newvalues)
+		self.assertEqual(newvalues['/Ac/PvOnOutput/MaxInverterPower'], 105)
+
+		# The sum keeps working after that
+		pv._value_changed('com.victronenergy.pvinverter.fronius_122_2315', '/Ac/L1/Power', {'Value': 200})
+		self.assertEqual(pv.get_totals()['/Ac/PvOnOutput/L1/Power'], 305)
+
+	def test_pv_totals_recomputed(self):
+		from delegates import PvInverters
+		self._add_device('com.victronenergy.pvinverter.fronius_122_2314', {
+			'/Ac/L1/Power': 105,
+			'/Position': 1 # AC-out
+		})
+		self._update_values()
+		PvInverters.instance._sums['/Ac/PvOnOutput/L1/Power'].total += 1e-9
+
+		# The rounding errors are gone once the sums are recomputed
+		self._update_values(60000)
+		self.assertEqual(PvInverters.instance.get_totals()['/Ac/PvOnOutput/L1/Power'], 105)
+
 	def test_multi_rs_3phase_summing(self):
 		self._remove_device('com.victronenergy.vebus.ttyO1')
 		self._add_device('com.victronenergy.multi.ttyO1',
@@ -1788,5 +1890,215 @@ class TestSystemCalc(TestSystemCalcBase):
 			'/Ac/Consumption/L1/Power': (1000 - 123 - 80) + (100 + 70),
 		})
 
+	def test_only_changed_nodes_evaluated(self):
+		self._add_device('com.victronenergy.solarcharger.ttyO1',
+			product_name='solarcharger',
+			values={
+				'/Dc/0/Voltage': 12.4,
+				'/Dc/0/Current': 9.7})
+		self._add_device('com.victronenergy.grid.ttyUSB1', {
+			'/Ac/L1/Power': 1230,
+			'/Ac/L1/Current': 5.3})
+		self._update_values()
+		graph = self._system_calc._graph
+
+		# A grid meter change leaves the DC side alone
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB1', '/Ac/L1/Current', 5.6)
+		self._update_values()
+		self.assertEqual(graph.evaluated, ['acconsumption'])
+		self._check_values({
+			'/Ac/Grid/L1/Power': 1230,
+			'/Ac/Grid/L1/Current': 5.6,
+			'/Dc/Pv/Power': 12.4 * 9.7})
+
+		# A solarcharger change also recomputes the battery and dc system
+		self._monitor.set_value('com.victronenergy.solarcharger.ttyO1', '/Dc/0/Current', 5)
+		self._update_values()
+		self.assertEqual(graph.evaluated, ['solarchargers', 'battery', 'dcsystem'])
+		self._check_values({
+			'/Ac/Grid/L1/Power': 1230,
+			'/Dc/Pv/Power': 12.4 * 5})
+
+		# A change that does not alter the outputs of a node stops there
+		self._monitor.set_value('com.victronenergy.solarcharger.ttyO1', '/Dc/0/Current', 5.0)
+		self._system_calc._dirty_paths.add(
+			('com.victronenergy.solarcharger', '/Dc/0/Current'))
+		self._system_calc._changed = True
+		self._update_values()
+		self.assertEqual(graph.evaluated, ['solarchargers'])
+
+		# Nothing changed, nothing evaluated
+		self._system_calc._changed = True
+		self._update_values()
+		self.assertEqual(graph.evaluated, [])
+		self._check_values({'/Dc/Pv/Power': 12.4 * 5})
+
+		# Adding a device invalidates everything
+		self._add_device('com.victronenergy.dcsystem.ttyUSB2', {
+			'/Dc/0/Power': 20})
+		self._update_values()
+		self.assertEqual(graph.evaluated,
+			['pvinverters', 'vebuspower', 'solarchargers', 'fuelcells',
+			'alternators', 'chargers', 'acinsource', 'battery', 'acconsumption',
+			'dcsystem'])
+
+	def test_publish_deadband(self):
+		now = [0]
+		self._system_calc._get_time = lambda: now[0]
+		self._add_device('com.victronenergy.grid.ttyUSB1', {
+			'/Ac/L1/Power': 1230,
+			'/Ac/L1/Current': 5.3})
+		self._update_values()
+		self._check_values({'/Ac/Grid/L1/Power': 1230})
+
+		# Changes inside the deadband are held back
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB1', '/Ac/L1/Power', 1230.4)
+		self._update_values()
+		self._check_values({'/Ac/Grid/L1/Power': 1230})
+
+		# Until they add up to more than the deadband
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB1', '/Ac/L1/Power', 1231.2)
+		self._update_values()
+		self._check_values({'/Ac/Grid/L1/Power': 1231.2})
+
+		# Or until the refresh interval passed
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB1', '/Ac/L1/Current', 5.35)
+		self._update_values()
+		self._check_values({'/Ac/Grid/L1/Current': 5.3})
+		now[0] = 29
+		self._update_values()
+		self._check_values({'/Ac/Grid/L1/Current': 5.3})
+		now[0] = 30
+		self._update_values()
+		self._check_values({'/Ac/Grid/L1/Current': 5.35})
+
+		# The deadband comes from settings, and going invalid is always sent
+		self._set_setting('/Settings/SystemSetup/PublishDeadband/Power', 0)
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB1', '/Ac/L1/Power', 1231.3)
+		self._update_values()
+		self._check_values({'/Ac/Grid/L1/Power': 1231.3})
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB1', '/Ac/L1/Power', None)
+		self._update_values()
+		self._check_values({'/Ac/Grid/L1/Power': None})
+
+	def test_publish_deadband_per_path(self):
+		self._system_calc._get_time = lambda: 0
+		self._update_values()
+
+		# Watts, not percent
+		self.assertEqual(self._system_calc._deadbands['/Dc/Charger/Power'], 'deadbandpower')
+		self.assertEqual(self._system_calc._deadbands['/Dc/FuelCell/Power'], 'deadbandpower')
+
+		# Overridden by path, every change of the soc is published
+		self.assertNotIn('/Dc/Battery/Soc', self._system_calc._deadbands)
+		self._monitor.set_value('com.victronenergy.vebus.ttyO1', '/Soc', 53.25)
+		self._update_values()
+		self._check_values({'/Dc/Battery/Soc': 53.25})
+
+		# Or in settings, which win over both
+		self._add_device('com.victronenergy.grid.ttyUSB1', {
+			'/Ac/L1/Power': 1230,
+			'/Ac/L1/Current': 5.3})
+		self._update_values()
+		self._set_setting('/Settings/SystemSetup/PublishDeadband/Paths',
+			'/Ac/Grid/L1/Power=10, /Dc/Battery/Soc=1 /Ac/Grid/L1/Current=x')
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB1', '/Ac/L1/Power', 1235)
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB1', '/Ac/L1/Current', 5.5)
+		self._monitor.set_value('com.victronenergy.vebus.ttyO1', '/Soc', 53.5)
+		self._update_values()
+		self._check_values({
+			'/Ac/Grid/L1/Power': 1230,
+			'/Ac/Grid/L1/Current': 5.5, # Not a number, the deadband for amps applies
+			'/Dc/Battery/Soc': 53.25})
+
+		self._set_setting('/Settings/SystemSetup/PublishDeadband/Paths', '/Ac/Grid/L1/Power=0')
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB1', '/Ac/L1/Power', 1235.5)
+		self._update_values()
+		self._check_values({
+			'/Ac/Grid/L1/Power': 1235.5,
+			'/Dc/Battery/Soc': 53.5})
+
+	def test_adaptive_tick(self):
+		self._add_device('com.victronenergy.grid.ttyUSB1', {
+			'/Ac/L1/Power': 1230,
+			'/Ac/L1/Current': 5.3})
+		self._update_values()
+		self._check_values({'/Debug/TickInterval': 1000})
+
+		# A grid meter change is published within a fast tick
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB1', '/Ac/L1/Power', 1330)
+		self._check_values({'/Debug/TickInterval': 200})
+		self._update_values(200)
+		self._check_values({'/Ac/Grid/L1/Power': 1330})
+		self._update_values(1000)
+		self._check_values({'/Debug/TickInterval': 1000})
+
+		# When nothing changes, ticks back off
+		self._update_values(10000)
+		self._check_values({'/Debug/TickInterval': 4000})
+
+		# Until something changes again
+		self._monitor.set_value('com.victronenergy.grid.ttyUSB1', '/Ac/L1/Current', 5)
+		self._check_values({'/Debug/TickInterval': 1000})
+		self._update_values(1000)
+		self._check_values({'/Ac/Grid/L1/Current': 5})
+
+	def test_service_changes_coalesced(self):
+		calls = []
+		f = self._system_calc._handleservicechange
+		self._system_calc._handleservicechange = lambda: calls.append(1) or f()
+		self._update_values()
+		folded = self._service['/Debug/ServiceChangesFolded']
+		del calls[:]
+
+		for i in range(5):
+			self._add_device('com.victronenergy.battery.ttyO{}'.format(i),
+				product_name='battery',
+				values={
+					'/Dc/0/Voltage': 12.3,
+					'/DeviceInstance': i})
+		self.assertEqual(calls, [])
+		self._update_values()
+		self.assertEqual(calls, [1])
+		self._check_values({
+			'/ActiveBatteryService': 'com.victronenergy.battery/0',
+			'/Debug/ServiceChangesFolded': folded + 4})
+
+	def test_delegate_profile(self):
+		self._update_values(10000)
+		self.assertIsNotNone(self._service['/Debug/Delegates/Dvcc/UpdateValues/P99'])
+		self.assertIsNotNone(self._service['/Debug/Delegates/BatteryData/Timer/Max'])
+
+		self._set_setting('/Settings/SystemSetup/ProfileDelegates', 0)
+		self.assertIsNone(self._service['/Debug/Delegates/Dvcc/UpdateValues/P99'])
+		self._update_values(10000)
+		self.assertIsNone(self._service['/Debug/Delegates/Dvcc/UpdateValues/P99'])
+
+	def test_delegate_profile_batched(self):
+		from unittest.mock import patch
+		service = type(self._service)
+		enter, exit, setitem = service.__enter__, service.__exit__, service.__setitem__
+		depth = [0]
+		unbatched = []
+
+		def _enter(s):
+			depth[0] += 1
+			return enter(s)
+		def _exit(s, *exc):
+			depth[0] -= 1
+			return exit(s, *exc)
+		def _setitem(s, path, value):
+			if depth[0] == 0 and path.startswith('/Debug/Delegates/'):
+				unbatched.append(path)
+			setitem(s, path, value)
+
+		with patch.object(service, '__enter__', _enter), \
+				patch.object(service, '__exit__', _exit), \
+				patch.object(service, '__setitem__', _setitem):
+			self._update_values(10000)
+			self.assertIsNotNone(self._service['/Debug/Delegates/Dvcc/UpdateValues/P99'])
+			self._set_setting('/Settings/SystemSetup/ProfileDelegates', 0)
+		self.assertEqual(unbatched, [])
+
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+
+# This adapts sys.path to include all relevant packages
+import context
+
+# Testing tools
+from mock_gobject import timer_manager
+from mock_dbus_monitor import MockDbusMonitor
+from mock_dbus_service import MockDbusService
+
+# Monkey patching for unit tests
+import patches
+
+from writequeue import WriteQueue, REFRESH
+
+# Time travel patch
+WriteQueue._get_time = lambda *a: timer_manager.time / 1000.0
+
+SERVICE = 'com.victronenergy.solarcharger.ttyO1'
+
+class TestWriteQueue(unittest.TestCase):
+	def setUp(self):
+		timer_manager.reset()
+		self.monitor = MockDbusMonitor({SERVICE: ['/Link/ChargeVoltage', '/Link/NetworkMode']})
+		self.monitor.add_service(SERVICE, {
+			'/Link/ChargeVoltage': None,
+			'/Link/NetworkMode': None})
+		self.writes = []
+		set_value_async = self.monitor.set_value_async
+		def record(service, path, value, **kwargs):
+			self.writes.append((path, value))
+			return set_value_async(service, path, value, **kwargs)
+		self.monitor.set_value_async = record
+
+		self.service = MockDbusService('com.victronenergy.system')
+		self.queue = WriteQueue(self.monitor, self.service)
+
+	def test_coalesce(self):
+		self.queue.write(SERVICE, '/Link/ChargeVoltage', 55.2)
+		self.queue.write(SERVICE, '/Link/ChargeVoltage', 56.0)
+		self.assertEqual(self.queue.get_value(SERVICE, '/Link/ChargeVoltage'), 56.0)
+		self.assertEqual(self.writes, [])
+		self.queue.flush()
+		self.assertEqual(self.writes, [('/Link/ChargeVoltage', 56.0)])
+		self.assertEqual(self.monitor.get_value(SERVICE, '/Link/ChargeVoltage'), 56.0)
+		self.assertEqual(self.service['/Debug/WriteQueue/Sent'], 1)
+		self.assertEqual(self.service['/Debug/WriteQueue/Suppressed'], 1)
+
+	def test_deduplicate(self):
+		for _ in range(3):
+			self.queue.write(SERVICE, '/Link/NetworkMode', 5)
+			self.queue.flush()
+		self.assertEqual(self.writes, [('/Link/NetworkMode', 5)])
+
+		# Written again if the service reports something else
+		self.monitor.set_value(SERVICE, '/Link/NetworkMode', 1)
+		self.queue.write(SERVICE, '/Link/NetworkMode', 5)
+		self.queue.flush()
+		self.assertEqual(len(self.writes), 2)
+
+		# And after the refresh interval
+		timer_manager.run(REFRESH * 1000)
+		self.queue.write(SERVICE, '/Link/NetworkMode', 5)
+		self.queue.flush()
+		self.assertEqual(len(self.writes), 3)
+		self.assertEqual(self.queue.sent, 3)
+		self.assertEqual(self.queue.suppressed, 2)
+
+		# Everything is written once the service comes back
+		self.queue.forget(SERVICE)
+		self.queue.write(SERVICE, '/Link/NetworkMode', 5)
+		self.queue.flush()
+		self.assertEqual(len(self.writes), 4)
+
+	def test_deadband(self):
+		self.queue.write(SERVICE, '/Link/ChargeVoltage', 55.2, 0.1)
+		self.queue.flush()
+		self.queue.write(SERVICE, '/Link/ChargeVoltage', 55.25, 0.1)
+		self.queue.flush()
+		self.assertEqual(self.writes, [('/Link/ChargeVoltage', 55.2)])
+
+		# The deadband is relative to what was last sent
+		self.queue.write(SERVICE, '/Link/ChargeVoltage', 55.35, 0.1)
+		self.queue.flush()
+		self.assertEqual(self.writes[-1], ('/Link/ChargeVoltage', 55.35))
+
+		# Refreshed with the latest value
+		timer_manager.run(REFRESH * 1000)
+		self.queue.write(SERVICE, '/Link/ChargeVoltage', 55.4, 0.1)
+		self.queue.flush()
+		self.assertEqual(self.writes[-1], ('/Link/ChargeVoltage', 55.4))
+
+		# None is not within any deadband
+		self.queue.write(SERVICE, '/Link/ChargeVoltage', None, 0.1)
+		self.queue.flush()
+		self.assertEqual(self.writes[-1], ('/Link/ChargeVoltage', None))
+		self.assertEqual(self.queue.counts(['/Link/ChargeVoltage']), (4, 1))
+
+	def test_failed(self):
+		self.queue.write('com.victronenergy.vecan.can0', '/Link/ChargeVoltage', 55.2)
+		self.queue.flush()
+		self.queue.write('com.victronenergy.vecan.can0', '/Link/ChargeVoltage', 55.2)
+		self.queue.flush()
+		self.assertEqual(self.queue.sent, 2)
+
+	def test_idle(self):
+		self.queue.write(SERVICE, '/Link/ChargeVoltage', 55.2)
+		timer_manager.run(10)
+		self.assertEqual(self.writes, [('/Link/ChargeVoltage', 55.2)])
+
+if __name__ == '__main__':
+	unittest.main()
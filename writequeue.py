@@ -0,0 +1,126 @@
+import logging
+import time
+from gi.repository import GLib
+from dbus.exceptions import DBusException
+
+logger = logging.getLogger(__name__)
+
+# Unchanged values are written again after this many seconds. Some devices
+# let remotely written values, such as /Link/ChargeVoltage on the solar
+# chargers, expire if they are not refreshed.
+REFRESH = 10
+
+class WriteQueue(object):
+	""" Collects the values the delegates write to other services, and
+	    sends them to the bus once per tick. Of several writes to the same
+	    path within a tick, only the last one is sent. A value equal to the
+	    last one sent, that the service still reports, is not sent again
+	    until REFRESH seconds have passed. A write may pass a deadband, then
+	    a value that differs less than that from the last one sent is also
+	    held back until REFRESH seconds have passed. Writes made outside of a
+	    tick are flushed when the mainloop is idle. The number of sent and
+	    suppressed writes is kept per path, and the totals are published
+	    under /Debug/WriteQueue if a dbus service is passed. """
+	instance = None
+
+	_get_time = lambda s: time.monotonic()
+
+	def __init__(self, dbusmonitor=None, dbusservice=None):
+		WriteQueue.instance = self
+		self.dbusmonitor = dbusmonitor
+		self._dbusservice = dbusservice
+		self._pending = {} # (service, path) -> (value, deadband)
+		self._sent = {} # (service, path) -> (value, time)
+		self._counts = {} # path -> [sent, suppressed]
+		self._idle = None
+		self.sent = 0
+		self.suppressed = 0
+		if dbusservice is not None:
+			dbusservice.add_path('/Debug/WriteQueue/Sent', value=0)
+			dbusservice.add_path('/Debug/WriteQueue/Suppressed', value=0)
+
+	def write(self, service, path, value, deadband=None):
+		key = (service, path)
+		if key in self._pending:
+			self._count(path, 1) # Coalesced with an earlier write
+		self._pending[key] = (value, deadband)
+		if self._idle is None:
+			self._idle = GLib.idle_add(self._on_idle)
+
+	def get_value(self, service, path):
+		""" Returns the value that will be written to path, or the value
+		    the service reports if there is no pending write. """
+		try:
+			return self._pending[(service, path)][0]
+		except KeyError:
+			return self.dbusmonitor.get_value(service, path)
+
+	def forget(self, service):
+		""" Drops everything known about service, so that it is written to
+		    in full when it comes back. """
+		for d in (self._pending, self._sent):
+			for key in [k for k in d if k[0] == service]:
+				del d[key]
+
+	def counts(self, paths):
+		""" Returns the number of sent and suppressed writes to any of
+		    paths. """
+		sent = suppressed = 0
+		for path in paths:
+			c = self._counts.get(path, (0, 0))
+			sent += c[0]
+			suppressed += c[1]
+		return sent, suppressed
+
+	def _count(self, path, i):
+		if i:
+			self.suppressed += 1
+		else:
+			self.sent += 1
+		self._counts.setdefault(path, [0, 0])[i] += 1
+
+	@staticmethod
+	def _unchanged(value, last, deadband):
+		if value == last:
+			return True
+		try:
+			return abs(value - last) < deadband
+		except TypeError:
+			return False
+
+	def _on_idle(self):
+		self._idle = None
+		self.flush()
+		return False
+
+	def flush(self):
+		if self._idle is not None:
+			GLib.source_remove(self._idle)
+			self._idle = None
+
+		pending, self._pending = self._pending, {}
+		now = self._get_time()
+		for key, (value, deadband) in pending.items():
+			last = self._sent.get(key)
+			if last is not None and now - last[1] < REFRESH and \
+					self._unchanged(value, last[0], deadband) and \
+					self.dbusmonitor.get_value(*key) == last[0]:
+				self._count(key[1], 1)
+				continue
+
+			self._sent[key] = (value, now)
+			self._count(key[1], 0)
+			try:
+				self.dbusmonitor.set_value_async(key[0], key[1], value,
+					error_handler=lambda e, key=key: self._failed(key, e))
+			except DBusException as e:
+				self._failed(key, e)
+
+		if self._dbusservice is not None and pending:
+			self._dbusservice['/Debug/WriteQueue/Sent'] = self.sent
+			self._dbusservice['/Debug/WriteQueue/Suppressed'] = self.suppressed
+
+	def _failed(self, key, e):
+		# Don't suppress the next attempt
+		self._sent.pop(key, None)
+		logger.debug('Writing %s%s failed: %s', key[0], key[1], e)